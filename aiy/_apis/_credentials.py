@@ -0,0 +1,138 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Keeps the access tokens of the speech APIs fresh.
+
+The gRPC auth plugin refreshes a token when it has expired, before sending
+the request that found it expired, so the user waits for the OAuth round
+trip. Refreshing on a background thread well before expiry means requests
+always find a valid token.
+"""
+
+import datetime
+import logging
+import random
+import threading
+
+import google.auth.exceptions
+import google.auth.transport.requests
+
+logger = logging.getLogger('speech')
+
+_refreshers = {}
+_refreshers_lock = threading.Lock()
+
+
+def get_refresher(credentials):
+    """Returns the started refresher of credentials, shared by everything that
+    uses them, so that only one thread refreshes them."""
+
+    with _refreshers_lock:
+        refresher = _refreshers.get(credentials)
+        if not refresher:
+            refresher = _refreshers[credentials] = CredentialRefresher(credentials)
+            refresher.start()
+        return refresher
+
+
+class CredentialRefresher(object):
+
+    """Refreshes google.auth credentials on a background thread.
+
+    Tokens are renewed margin_s before they expire, less up to jitter_s at
+    random, so several processes don't all refresh at once. Short-lived tokens
+    are renewed halfway through their life instead, and never more often than
+    every min_retry_s. A failed refresh is retried after min_retry_s, doubling
+    up to max_retry_s, while the old token is still valid.
+    """
+
+    def __init__(self, credentials, margin_s=600, jitter_s=120,
+                 min_retry_s=5, max_retry_s=300):
+        self.credentials = credentials
+        self.margin_s = margin_s
+        self.jitter_s = jitter_s
+        self.min_retry_s = min_retry_s
+        self.max_retry_s = max_retry_s
+
+        self.refreshes = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if not self._thread:
+            self._thread = threading.Thread(target=self._run, name='refresh-credentials',
+                                            daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def ensure_valid(self):
+        """Refreshes the credentials now if they have no valid token, eg
+        before the first request. Raises google.auth errors."""
+        with self._lock:
+            if not self.credentials.valid:
+                self._refresh()
+
+    def get_stats(self):
+        return {
+            'refreshes': self.refreshes,
+            'failures': self.failures,
+            'expires_in_s': self._expires_in_s(),
+        }
+
+    def _run(self):
+        retry_s = self.min_retry_s
+        retrying = False
+        while not self._stop.is_set():
+            if not retrying:
+                expires_in_s = self._expires_in_s()
+                if expires_in_s is None:
+                    return
+                lead_s = self.margin_s + random.uniform(0, self.jitter_s)
+                wait_s = max(expires_in_s - lead_s, expires_in_s / 2, self.min_retry_s)
+                if self._stop.wait(wait_s):
+                    return
+
+            try:
+                with self._lock:
+                    self._refresh()
+                retry_s = self.min_retry_s
+                retrying = False
+            except (google.auth.exceptions.GoogleAuthError, OSError):
+                self.failures += 1
+                logger.warning('refreshing credentials failed, retrying in %d s',
+                               retry_s, exc_info=True)
+                if self._stop.wait(retry_s * random.uniform(0.8, 1.2)):
+                    return
+                retry_s = min(2 * retry_s, self.max_retry_s)
+                retrying = True
+
+    def _refresh(self):
+        self.credentials.refresh(google.auth.transport.requests.Request())
+        self.refreshes += 1
+        logger.info('refreshed credentials, valid for %d s', self._expires_in_s() or 0)
+
+    def _expires_in_s(self):
+        """Returns how long the token is valid for, 0 if there is none, or
+        None if it doesn't expire."""
+        if not self.credentials.token:
+            return 0
+        if not self.credentials.expiry:
+            return None
+        # google.auth keeps expiry as a naive UTC datetime.
+        now = datetime.datetime.now(datetime.timezone.utc).replace(tzinfo=None)
+        return (self.credentials.expiry - now).total_seconds()
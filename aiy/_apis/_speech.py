@@ -15,10 +15,15 @@
 """Classes for speech interaction."""
 
 from abc import abstractmethod
+import asyncio
 import collections
+import concurrent.futures
+import functools
 import logging
 import os
 import tempfile
+import threading
+import time
 import wave
 
 import google.auth
@@ -31,6 +36,15 @@ from google.assistant.embedded.v1alpha1 import embedded_assistant_pb2
 import grpc
 from six.moves import queue
 
+try:
+    import grpc.aio
+except ImportError:
+    # grpcio before 1.32 has no asyncio API; only the blocking requests work.
+    pass
+
+import aiy._apis._credentials
+import aiy._apis._uplink
+import aiy._drivers._graph
 import aiy.i18n
 
 logger = logging.getLogger('speech')
@@ -48,28 +62,204 @@ class Error(Exception):
 
 class _ChannelFactory(object):
 
-    """Creates gRPC channels with a given configuration."""
+    """Keeps a long-lived gRPC channel to an API host.
+
+    The channel sends keepalive pings, so it stays connected between requests
+    instead of paying for TLS and HTTP/2 setup on each one. It is replaced
+    when it fails, or when a request finds it unavailable. Tokens are
+    refreshed on a background thread, ahead of expiry, so requests don't wait
+    for them. Requests get a factory from get_shared(), so those to one host
+    with the same credentials share the channel.
+    """
+
+    KEEPALIVE_S = 30
+    CONNECT_TIMEOUT_S = 10
+
+    _FAILED = (grpc.ChannelConnectivity.TRANSIENT_FAILURE,
+               grpc.ChannelConnectivity.SHUTDOWN)
+
+    _shared = {}
+    _shared_lock = threading.Lock()
 
     def __init__(self, api_host, credentials):
         self._api_host = api_host
         self._credentials = credentials
+        self._refresher = aiy._apis._credentials.get_refresher(credentials)
+
+        self._lock = threading.Lock()
+        self._channel = None
+        self._state = None
+        self.channels_created = 0
+
+    @classmethod
+    def get_shared(cls, api_host, credentials):
+        """Returns the factory of this class for api_host and credentials."""
+
+        key = (cls, api_host, credentials)
+        with _ChannelFactory._shared_lock:
+            factory = _ChannelFactory._shared.get(key)
+            if not factory:
+                factory = _ChannelFactory._shared[key] = cls(api_host, credentials)
+            return factory
+
+    def get_channel(self):
+        """Returns a connected channel, creating one if there is none or the
+        last one failed."""
+
+        with self._lock:
+            if self._channel and self._state in self._FAILED:
+                logger.info('reconnecting to %s after %s', self._api_host, self._state)
+                self._close()
+            if not self._channel:
+                self._channel = self._make_channel()
+                self._state = None
+                self._channel.subscribe(functools.partial(self._on_state, self._channel),
+                                        try_to_connect=True)
+            channel = self._channel
+        grpc.channel_ready_future(channel).result(timeout=self.CONNECT_TIMEOUT_S)
+        return channel
+
+    def get_credential_stats(self):
+        return self._refresher.get_stats()
 
-        self._checked = False
+    def reset(self):
+        """Drops the channel, so the next request reconnects."""
+        with self._lock:
+            self._close()
 
-    def make_channel(self):
+    def _make_channel(self):
         """Creates a secure channel."""
 
         request = google.auth.transport.requests.Request()
         target = self._api_host + ':443'
 
-        if not self._checked:
-            # Refresh now, to catch any errors early. Otherwise, they'll be
-            # raised and swallowed somewhere inside gRPC.
-            self._credentials.refresh(request)
-            self._checked = True
+        # Refresh now if the background refresher hasn't yet, to catch any
+        # errors early. Otherwise, they'll be raised and swallowed somewhere
+        # inside gRPC.
+        self._refresher.ensure_valid()
 
+        self.channels_created += 1
         return google.auth.transport.grpc.secure_authorized_channel(
-            self._credentials, request, target)
+            self._credentials, request, target, options=self._channel_options())
+
+    def _channel_options(self):
+        return [
+            ('grpc.keepalive_time_ms', self.KEEPALIVE_S * 1000),
+            ('grpc.keepalive_timeout_ms', 10000),
+            ('grpc.keepalive_permit_without_calls', 1),
+            ('grpc.http2.max_pings_without_data', 0),
+        ]
+
+    def _on_state(self, channel, state):
+        with self._lock:
+            if channel is self._channel:
+                self._state = state
+
+    def _close(self):
+        if self._channel:
+            self._channel.close()
+            self._channel = None
+            self._state = None
+
+
+class _AsyncChannelFactory(_ChannelFactory):
+
+    """Keeps a long-lived grpc.aio channel to an API host, for requests made
+    from an event loop. Its methods must be called from that loop. The
+    channel belongs to the loop that made it, so it is replaced when
+    requests come from another loop, eg after a second asyncio.run().
+    """
+
+    def __init__(self, api_host, credentials):
+        super().__init__(api_host, credentials)
+        # Created on first use from each loop, so that they belong to it.
+        self._loop = None
+        self._async_lock = None
+
+    async def get_channel(self):
+        """Returns a connected channel, creating one if there is none or the
+        last one failed."""
+
+        loop = asyncio.get_running_loop()
+        if loop is not self._loop:
+            # The old channel can't be closed from this loop, and its own may
+            # be gone; it's just dropped.
+            self._loop = loop
+            self._async_lock = asyncio.Lock()
+            self._channel = None
+        async with self._async_lock:
+            if self._channel and self._channel.get_state() in self._FAILED:
+                logger.info('reconnecting to %s after %s', self._api_host,
+                            self._channel.get_state())
+                self._close()
+            if not self._channel:
+                # Refreshing blocks, so keep it off the event loop.
+                await asyncio.get_running_loop().run_in_executor(
+                    None, self._refresher.ensure_valid)
+                self._channel = self._make_channel()
+            channel = self._channel
+        await asyncio.wait_for(channel.channel_ready(), self.CONNECT_TIMEOUT_S)
+        return channel
+
+    def _make_channel(self):
+        plugin = google.auth.transport.grpc.AuthMetadataPlugin(
+            self._credentials, google.auth.transport.requests.Request())
+        channel_credentials = grpc.composite_channel_credentials(
+            grpc.ssl_channel_credentials(), grpc.metadata_call_credentials(plugin))
+        self.channels_created += 1
+        return grpc.aio.secure_channel(self._api_host + ':443', channel_credentials,
+                                       options=self._channel_options())
+
+    def _close(self):
+        if self._channel:
+            asyncio.ensure_future(self._channel.close())
+            self._channel = None
+
+
+class _AsyncAudioQueue(object):
+
+    """Audio queued by the recorder's thread for a coroutine to send.
+
+    put() can be called from any thread, and get_async() waits without
+    holding up a thread. Like queue.Queue, get(False) takes an item
+    without waiting, or raises queue.Empty.
+    """
+
+    def __init__(self):
+        self._items = collections.deque()
+        self._lock = threading.Lock()
+        self._waiter = None
+
+    def put(self, item):
+        with self._lock:
+            self._items.append(item)
+            waiter, self._waiter = self._waiter, None
+        if waiter:
+            loop, future = waiter
+            loop.call_soon_threadsafe(self._wake, future)
+
+    def get(self, block=True):
+        if block:
+            raise ValueError('use get_async() to wait for an item')
+        with self._lock:
+            if not self._items:
+                raise queue.Empty
+            return self._items.popleft()
+
+    async def get_async(self):
+        while True:
+            with self._lock:
+                if self._items:
+                    return self._items.popleft()
+                loop = asyncio.get_running_loop()
+                future = loop.create_future()
+                self._waiter = (loop, future)
+            await future
+
+    @staticmethod
+    def _wake(future):
+        if not future.done():
+            future.set_result(None)
 
 
 class GenericSpeechRequest(object):
@@ -81,14 +271,49 @@ class GenericSpeechRequest(object):
 
     DEADLINE_SECS = 185
 
+    # As a stage of the recorder's audio graph, requests get 100 ms frames of
+    # 16-bit samples, the size recommended for streaming recognition. Each
+    # frame is sent in one gRPC message.
+    FRAME_S = 0.1
+    DTYPE = aiy._drivers._graph.BYTES
+
+    _CHANNEL_FACTORY = _ChannelFactory
+
     def __init__(self, api_host, credentials):
         self.dialog_follow_on = False
         self._audio_queue = queue.Queue()
         self._phrases = []
-        self._channel_factory = _ChannelFactory(api_host, credentials)
+        self._channel_factory = self._CHANNEL_FACTORY.get_shared(api_host, credentials)
         self._endpointer_cb = None
         self._audio_logging_enabled = False
         self._request_log_wav = None
+        # The capture thread (local endpointer) and the gRPC thread (server
+        # endpoint or error) can both end the audio.
+        self._audio_ended_lock = threading.Lock()
+        self._audio_ended = False
+        self._uplink = aiy._apis._uplink.Uplink('LINEAR16', AUDIO_SAMPLE_RATE_HZ)
+        self._encoder = aiy._apis._uplink.Linear16Encoder()
+
+        # A request started early by prewarm(), for do_request() to use.
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._prewarmed = None
+        self._on_config_sent = None
+
+        # Endpoint times of the current request, and running totals of how
+        # much earlier the local endpointer was than the server.
+        self._request_start_time = None
+        self._local_endpoint_time = None
+        self._server_endpoint_time = None
+        self._endpoint_count = 0
+        self._endpoint_saving_s = 0.0
+
+        # How long requests waited for a connected channel, and then streamed.
+        self._connect_time = 0.0
+        self._new_channel = False
+        self._stream_start_time = 0.0
+        self._request_count = 0
+        self._total_connect_s = 0.0
+        self._total_stream_s = 0.0
 
     def add_phrases(self, phrases):
         """Makes the recognition more likely to recognize the given phrase(s).
@@ -106,6 +331,12 @@ class GenericSpeechRequest(object):
         """Callback to invoke on end of speech."""
         self._endpointer_cb = cb
 
+    def set_uplink_encoding(self, encoding):
+        """Sets how audio is sent: 'LINEAR16', 'FLAC', or 'auto' to switch to
+        FLAC when the connection is too slow for raw audio.
+        """
+        self._uplink = aiy._apis._uplink.Uplink(encoding, AUDIO_SAMPLE_RATE_HZ)
+
     def set_audio_logging_enabled(self, audio_logging_enabled=True):
         self._audio_logging_enabled = audio_logging_enabled
 
@@ -114,6 +345,10 @@ class GenericSpeechRequest(object):
             self._audio_log_ix = 0
 
     def reset(self):
+        self._audio_ended = False
+        self._local_endpoint_time = None
+        self._server_endpoint_time = None
+
         while True:
             try:
                 self._audio_queue.get(False)
@@ -122,11 +357,61 @@ class GenericSpeechRequest(object):
 
         self.dialog_follow_on = False
 
+    def prewarm(self, on_config_sent=None):
+        """Starts opening the channel and the next request in the background,
+        so they overlap with whatever happens before do_request(), like the
+        trigger sound. Call it after reset().
+
+        The config request is sent as soon as the call starts; on_config_sent
+        is called then, from a gRPC thread.
+        """
+        self._on_config_sent = on_config_sent
+        self._prewarmed = self._executor.submit(self._open_response_stream)
+
     def add_data(self, data):
-        self._audio_queue.put(data)
+        # The recorder reuses its buffers, so keep a copy until it's sent.
+        self._audio_queue.put((time.monotonic(), bytes(data)))
 
     def end_audio(self):
-        self.add_data(None)
+        self._audio_queue.put(None)
+
+    def local_endpoint(self, end_audio=True):
+        """Tells the request that a local endpointer heard the user stop.
+
+        If end_audio is True, the request stops sending audio right away
+        instead of waiting for the server to endpoint. Otherwise the time is
+        only recorded, so it can be compared with the server's endpoint.
+        """
+        self._local_endpoint_time = time.monotonic()
+        if end_audio:
+            self._end_audio_request()
+
+    def get_endpoint_stats(self):
+        """Returns how the local endpointer compared to the server's.
+
+        mean_saving_s is the average time by which the local endpoint came
+        before the server's, over the requests where both were seen.
+        """
+        return {
+            'count': self._endpoint_count,
+            'mean_saving_s': (self._endpoint_saving_s / self._endpoint_count
+                              if self._endpoint_count else None),
+        }
+
+    def get_connection_stats(self):
+        """Returns how many channels were created for how many requests, how
+        the credentials have been refreshed, and the mean time requests
+        waited for a connected channel (connect_s) and then took from opening
+        the stream to its end (stream_s).
+        """
+        count = self._request_count
+        return {
+            'requests': count,
+            'channels': self._channel_factory.channels_created,
+            'credentials': self._channel_factory.get_credential_stats(),
+            'mean_connect_s': self._total_connect_s / count if count else None,
+            'mean_stream_s': self._total_stream_s / count if count else None,
+        }
 
     def _get_speech_context(self):
         """Return a SpeechContext instance to bias recognition towards certain
@@ -162,18 +447,37 @@ class GenericSpeechRequest(object):
         """Yields a config request followed by requests constructed from the
         audio queue.
         """
+        self._encoder = self._uplink.new_encoder()
         yield self._create_config_request()
+        # Time spent connecting, or before the stream started taking audio,
+        # doesn't count as lag: it says nothing about the uplink's throughput.
+        stream_start = time.monotonic()
+        if self._on_config_sent:
+            self._on_config_sent()
+            self._on_config_sent = None
 
         while True:
-            data = self._audio_queue.get()
+            item = self._audio_queue.get()
 
-            if not data:
-                return
+            if not item:
+                break
 
+            queued_time, data = item
             if self._request_log_wav:
                 self._request_log_wav.writeframes(data)
 
-            yield self._create_audio_request(data)
+            encoded = self._encoder.encode(data)
+            start = time.monotonic()
+            if encoded:
+                yield self._create_audio_request(encoded)
+            # gRPC asks for the next request once this one has been sent.
+            self._uplink.record_send(len(data), len(encoded),
+                                     time.monotonic() - start,
+                                     start - max(queued_time, stream_start))
+
+        encoded = self._encoder.flush()
+        if encoded:
+            yield self._create_audio_request(encoded)
 
     @abstractmethod
     def _create_response_stream(self, service, request_stream, deadline):
@@ -200,24 +504,34 @@ class GenericSpeechRequest(object):
         return
 
     def _end_audio_request(self):
+        with self._audio_ended_lock:
+            if self._audio_ended:
+                return
+            self._audio_ended = True
+
         self.end_audio()
         if self._endpointer_cb:
             self._endpointer_cb()
 
     def _handle_response_stream(self, response_stream):
         for resp in response_stream:
-            if resp.error.code != error_code.OK:
-                self._end_audio_request()
-                raise Error('Server error: ' + resp.error.message)
-
-            if self._stop_sending_audio(resp):
-                self._end_audio_request()
-
-            self._handle_response(resp)
+            self._process_response(resp)
 
         # Server has closed the connection
         return self._finish_request() or ''
 
+    def _process_response(self, resp):
+        if resp.error.code != error_code.OK:
+            self._end_audio_request()
+            raise Error('Server error: ' + resp.error.message)
+
+        if self._stop_sending_audio(resp):
+            if self._server_endpoint_time is None:
+                self._server_endpoint_time = time.monotonic()
+            self._end_audio_request()
+
+        self._handle_response(resp)
+
     def _start_logging_request(self):
         """Open a WAV file to log the request audio."""
         self._audio_log_ix += 1
@@ -237,8 +551,24 @@ class GenericSpeechRequest(object):
         if self._request_log_wav:
             self._request_log_wav.close()
 
+        self._log_endpoint_times()
+        self._uplink.finish_request()
+
         return _Result(None, None)
 
+    def _log_endpoint_times(self):
+        local = self._local_endpoint_time
+        server = self._server_endpoint_time
+        if local is None or server is None:
+            return
+
+        self._endpoint_count += 1
+        self._endpoint_saving_s += server - local
+        logger.info('endpoint: local at %.3f s, server at %.3f s (%+d ms)',
+                    local - self._request_start_time,
+                    server - self._request_start_time,
+                    (server - local) * 1000)
+
     def do_request(self):
         """Establishes a connection and starts sending audio to the cloud
         endpoint. Responses are handled by the subclass until one returns a
@@ -251,22 +581,55 @@ class GenericSpeechRequest(object):
 
         Raises speech.Error on error.
         """
+        self._request_start_time = time.monotonic()
+        prewarmed, self._prewarmed = self._prewarmed, None
         try:
-            service = self._make_service(self._channel_factory.make_channel())
-
-            response_stream = self._create_response_stream(
-                service, self._request_stream(), self.DEADLINE_SECS)
+            if prewarmed:
+                response_stream = prewarmed.result()
+            else:
+                response_stream = self._open_response_stream()
 
             if self._audio_logging_enabled:
                 self._start_logging_request()
 
-            return self._handle_response_stream(response_stream)
-        except (
-                google.auth.exceptions.GoogleAuthError,
-                grpc.RpcError,
-        ) as exc:
+            result = self._handle_response_stream(response_stream)
+            self._log_connection_times()
+            return result
+        except grpc.RpcError as exc:
+            if isinstance(exc, grpc.Call) and exc.code() == grpc.StatusCode.UNAVAILABLE:
+                self._channel_factory.reset()
+            raise Error('Exception in speech request') from exc
+        except grpc.FutureTimeoutError as exc:
+            self._channel_factory.reset()
+            raise Error('Timed out connecting for speech request') from exc
+        except google.auth.exceptions.GoogleAuthError as exc:
             raise Error('Exception in speech request') from exc
 
+    def _open_response_stream(self):
+        # This may run ahead of do_request(), from prewarm(), so it records
+        # the timings that are logged when the request is done.
+        start = time.monotonic()
+        channels_created = self._channel_factory.channels_created
+        channel = self._channel_factory.get_channel()
+        self._connected(start, channels_created)
+        service = self._make_service(channel)
+        return self._create_response_stream(
+            service, self._request_stream(), self.DEADLINE_SECS)
+
+    def _connected(self, start, channels_created):
+        self._stream_start_time = time.monotonic()
+        self._connect_time = self._stream_start_time - start
+        self._new_channel = self._channel_factory.channels_created > channels_created
+
+    def _log_connection_times(self):
+        stream_s = time.monotonic() - self._stream_start_time
+        self._request_count += 1
+        self._total_connect_s += self._connect_time
+        self._total_stream_s += stream_s
+        logger.info('connect %d ms on a %s channel, stream %d ms',
+                    self._connect_time * 1000,
+                    'new' if self._new_channel else 'kept-alive', stream_s * 1000)
+
 
 class CloudSpeechRequest(GenericSpeechRequest):
 
@@ -278,9 +641,15 @@ class CloudSpeechRequest(GenericSpeechRequest):
 
     SCOPE = 'https://www.googleapis.com/auth/cloud-platform'
 
+    # Credentials by file, so that requests using one file share a channel.
+    _credentials_by_file = {}
+
     def __init__(self, credentials_file):
         os.environ['GOOGLE_APPLICATION_CREDENTIALS'] = credentials_file
-        credentials, _ = google.auth.default(scopes=[self.SCOPE])
+        credentials = self._credentials_by_file.get(credentials_file)
+        if not credentials:
+            credentials, _ = google.auth.default(scopes=[self.SCOPE])
+            self._credentials_by_file[credentials_file] = credentials
 
         super().__init__('speech.googleapis.com', credentials)
 
@@ -302,7 +671,7 @@ class CloudSpeechRequest(GenericSpeechRequest):
         recognition_config = cloud_speech.RecognitionConfig(
             # There are a bunch of config options you can specify. See
             # https://goo.gl/KPZn97 for the full list.
-            encoding='LINEAR16',  # raw 16-bit signed LE samples
+            encoding=self._encoder.ENCODING,  # eg LINEAR16 or FLAC
             sample_rate=AUDIO_SAMPLE_RATE_HZ,
             # For a list of supported languages see:
             # https://cloud.google.com/speech/docs/languages.
@@ -368,7 +737,7 @@ class AssistantSpeechRequest(GenericSpeechRequest):
 
     def _create_config_request(self):
         audio_in_config = embedded_assistant_pb2.AudioInConfig(
-            encoding='LINEAR16',
+            encoding=self._encoder.ENCODING,
             sample_rate_hertz=AUDIO_SAMPLE_RATE_HZ,
         )
         audio_out_config = embedded_assistant_pb2.AudioOutConfig(
@@ -439,6 +808,130 @@ class AssistantSpeechRequest(GenericSpeechRequest):
         response_wav.writeframes(frames)
         response_wav.close()
 
+
+class _AsyncRequestMixin(object):
+
+    """Runs requests on grpc.aio, so several sessions, each its own request
+    object, can share one event loop and thread.
+
+    Requests are built and responses handled by the same hooks as the
+    blocking requests, like _create_config_request() and _handle_response().
+    Audio comes from add_data(), which the recorder can still call from its
+    thread, or from an async iterable passed to do_request_async(). Sessions
+    created with the same credentials share a channel and token refresher.
+    """
+
+    _CHANNEL_FACTORY = _AsyncChannelFactory
+
+    def __init__(self, *args, **kwargs):
+        if not hasattr(grpc, 'aio'):
+            raise RuntimeError('async speech requests need grpcio 1.32 or later')
+        super().__init__(*args, **kwargs)
+        self._audio_queue = _AsyncAudioQueue()
+
+    def prewarm(self, on_config_sent=None):
+        raise TypeError('async requests start with do_request_async()')
+
+    def do_request(self):
+        raise TypeError('use do_request_async() for async requests')
+
+    async def do_request_async(self, audio=None, on_result=None):
+        """Connects and sends audio to the cloud endpoint, until the
+        subclass handles a result.
+
+        Args:
+            audio: optionally, an async iterable of 16-bit mono audio chunks
+                to send, after which the audio ends. Otherwise audio is
+                taken from add_data().
+            on_result: optionally, a function or coroutine function to call
+                with the result.
+
+        Returns the result, like do_request(). Raises speech.Error on error.
+        """
+        self._request_start_time = time.monotonic()
+        feeder = asyncio.ensure_future(self._feed_audio(audio)) if audio else None
+        try:
+            start = time.monotonic()
+            channels_created = self._channel_factory.channels_created
+            channel = await self._channel_factory.get_channel()
+            self._connected(start, channels_created)
+            response_stream = self._create_response_stream(
+                self._make_service(channel), self._request_stream_async(),
+                self.DEADLINE_SECS)
+
+            if self._audio_logging_enabled:
+                self._start_logging_request()
+
+            async for resp in response_stream:
+                self._process_response(resp)
+            result = self._finish_request() or ''
+            self._log_connection_times()
+        except grpc.aio.AioRpcError as exc:
+            if exc.code() == grpc.StatusCode.UNAVAILABLE:
+                self._channel_factory.reset()
+            raise Error('Exception in speech request') from exc
+        except asyncio.TimeoutError as exc:
+            self._channel_factory.reset()
+            raise Error('Timed out connecting for speech request') from exc
+        except google.auth.exceptions.GoogleAuthError as exc:
+            raise Error('Exception in speech request') from exc
+        finally:
+            if feeder:
+                feeder.cancel()
+
+        if on_result:
+            handled = on_result(result)
+            if asyncio.iscoroutine(handled):
+                await handled
+        return result
+
+    async def _feed_audio(self, audio):
+        async for data in audio:
+            self.add_data(data)
+        self.end_audio()
+
+    async def _request_stream_async(self):
+        """Yields a config request followed by requests constructed from the
+        audio queue, like _request_stream().
+        """
+        self._encoder = self._uplink.new_encoder()
+        yield self._create_config_request()
+        stream_start = time.monotonic()
+
+        while True:
+            item = await self._audio_queue.get_async()
+
+            if not item:
+                break
+
+            queued_time, data = item
+            if self._request_log_wav:
+                self._request_log_wav.writeframes(data)
+
+            encoded = self._encoder.encode(data)
+            start = time.monotonic()
+            if encoded:
+                yield self._create_audio_request(encoded)
+            self._uplink.record_send(len(data), len(encoded),
+                                     time.monotonic() - start,
+                                     start - max(queued_time, stream_start))
+
+        encoded = self._encoder.flush()
+        if encoded:
+            yield self._create_audio_request(encoded)
+
+
+class AsyncCloudSpeechRequest(_AsyncRequestMixin, CloudSpeechRequest):
+
+    """A transcription request to the Cloud Speech API, made from an event
+    loop with do_request_async()."""
+
+
+class AsyncAssistantSpeechRequest(_AsyncRequestMixin, AssistantSpeechRequest):
+
+    """A request to the Assistant API, made from an event loop with
+    do_request_async()."""
+
 if __name__ == '__main__':
     logging.basicConfig(level=logging.INFO)
 
@@ -0,0 +1,161 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Encoders for the audio sent to the speech APIs.
+
+An encoder turns chunks of 16-bit mono PCM into the bytes sent in audio
+requests, and names the encoding to put in the config request. The encoding
+can't change during a request, so Uplink picks one per request from the send
+throughput measured on earlier requests.
+"""
+
+import io
+import logging
+
+import numpy as np
+
+try:
+    import soundfile
+except ImportError:
+    soundfile = None
+
+logger = logging.getLogger('speech')
+
+
+class Linear16Encoder(object):
+
+    """Sends raw 16-bit signed little-endian samples."""
+
+    ENCODING = 'LINEAR16'
+
+    def encode(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+class FlacEncoder(object):
+
+    """Compresses the audio into a single FLAC stream with libsndfile.
+
+    FLAC is lossless and usually halves the size of speech. libFLAC emits
+    audio a block at a time, so encoded data lags the input by up to one
+    block (256 ms at 16 kHz).
+    """
+
+    ENCODING = 'FLAC'
+
+    def __init__(self, sample_rate_hz):
+        if soundfile is None:
+            raise ImportError('soundfile is needed for FLAC encoding')
+
+        self._buf = io.BytesIO()
+        self._sent = 0
+        self._file = soundfile.SoundFile(
+            self._buf, 'w', samplerate=sample_rate_hz, channels=1,
+            format='FLAC', subtype='PCM_16')
+
+    def _take_output(self):
+        # The header is rewritten in place when the file is closed, so only
+        # ever take the bytes that were appended.
+        end = self._buf.seek(0, io.SEEK_END)
+        data = self._buf.getbuffer()[self._sent:end].tobytes()
+        self._sent = end
+        return data
+
+    def encode(self, data):
+        self._file.write(np.frombuffer(data, dtype=np.int16))
+        return self._take_output()
+
+    def flush(self):
+        self._file.close()
+        return self._take_output()
+
+
+class Uplink(object):
+
+    """Chooses the encoder for each request from the measured send rate.
+
+    encoding is 'LINEAR16', 'FLAC' or 'auto'. With 'auto', requests start with
+    LINEAR16 and switch to FLAC once a request couldn't send faster than
+    SLOW_FACTOR times the PCM data rate, or its audio queued up for longer
+    than MAX_LAG_S. They switch back once a request sent at more than
+    FAST_FACTOR times the PCM rate.
+    """
+
+    SLOW_FACTOR = 1.5
+    FAST_FACTOR = 4.0
+    MAX_LAG_S = 0.3
+
+    def __init__(self, encoding='auto', sample_rate_hz=16000, sample_size=2):
+        if encoding not in ('auto', 'LINEAR16', 'FLAC'):
+            raise ValueError('unknown uplink encoding: %s' % encoding)
+        if encoding != 'LINEAR16' and soundfile is None:
+            logger.warning('soundfile not installed, sending LINEAR16 audio')
+            encoding = 'LINEAR16'
+
+        self._encoding = encoding
+        self._sample_rate_hz = sample_rate_hz
+        self._pcm_rate = sample_rate_hz * sample_size
+        self._use_flac = encoding == 'FLAC'
+
+        self._start_request()
+
+    def _start_request(self):
+        self.bytes_in = 0
+        self.bytes_sent = 0
+        self.send_time_s = 0.0
+        self.max_lag_s = 0.0
+
+    def new_encoder(self):
+        """Returns the encoder for the next request."""
+        self._start_request()
+        if self._use_flac:
+            return FlacEncoder(self._sample_rate_hz)
+        return Linear16Encoder()
+
+    def record_send(self, bytes_in, bytes_sent, send_time_s, lag_s):
+        """Records one audio request: bytes_in of PCM sent as bytes_sent
+        encoded bytes, which took send_time_s to hand to gRPC, after waiting
+        lag_s in the audio queue since the stream started taking audio.
+        """
+        self.bytes_in += bytes_in
+        self.bytes_sent += bytes_sent
+        self.send_time_s += send_time_s
+        self.max_lag_s = max(self.max_lag_s, lag_s)
+
+    def finish_request(self):
+        """Logs the request's numbers and updates the choice of encoder."""
+
+        if not self.bytes_in:
+            return
+
+        # Sending rate in terms of the PCM it carried.
+        rate = self.bytes_in / self.send_time_s if self.send_time_s else float('inf')
+        logger.info('uplink: %d bytes for %d bytes of audio, %.0f kB/s of'
+                    ' audio, max lag %.0f ms',
+                    self.bytes_sent, self.bytes_in, rate / 1000, self.max_lag_s * 1000)
+
+        if self._encoding != 'auto':
+            return
+
+        slow = rate < self.SLOW_FACTOR * self._pcm_rate or self.max_lag_s > self.MAX_LAG_S
+        fast = rate > self.FAST_FACTOR * self._pcm_rate and self.max_lag_s < self.MAX_LAG_S
+        if slow and not self._use_flac:
+            logger.info('uplink is slow, switching to FLAC')
+            self._use_flac = True
+        elif fast and self._use_flac:
+            logger.info('uplink is fast, switching to LINEAR16')
+            self._use_flac = False
@@ -0,0 +1,218 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Mixers that turn multi-microphone audio into one channel.
+
+A mixer has a process(samples, out) method, where samples is an (n, channels)
+int16 array of one chunk and out is an int16 array of n samples to fill. The
+Recorder uses one when it captures from more than one microphone, so that
+processors still get mono audio.
+
+To measure how fast the mixers run on this machine:
+    python3 -m aiy._drivers._beamform
+"""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger('recorder')
+
+SPEED_OF_SOUND_M_S = 343.0
+
+
+class DelayAndSum(object):
+
+    """Steers a two-microphone array at the loudest source and averages.
+
+    The delay between the microphones is estimated for each chunk with
+    GCC-PHAT, limited to what the microphone spacing allows, and only updated
+    from chunks where the correlation peak is clear. The lagging channel is
+    then delayed by that many samples, with history carried over from the
+    previous chunk, and the two are averaged. Speech from the steered
+    direction adds up while uncorrelated noise and reverberation partly
+    cancel.
+    """
+
+    def __init__(self, sample_rate_hz=16000, mic_spacing_m=0.06, min_peak=0.15):
+        self.max_lag = max(1, int(np.ceil(mic_spacing_m / SPEED_OF_SOUND_M_S *
+                                          sample_rate_hz)))
+        self.min_peak = min_peak
+        self.delay = 0
+        self._history = None
+
+    def estimate_delay(self, x0, x1):
+        """Returns (delay, peak): x0 lags x1 by delay samples."""
+
+        n = 2 * len(x0)
+        spectrum = np.fft.rfft(x0, n) * np.conj(np.fft.rfft(x1, n))
+        spectrum /= np.abs(spectrum) + 1e-9
+        cc = np.fft.irfft(spectrum, n)
+
+        lags = np.concatenate((cc[-self.max_lag:], cc[:self.max_lag + 1]))
+        best = int(np.argmax(lags))
+        return best - self.max_lag, float(lags[best])
+
+    def process(self, samples, out):
+        x = samples.astype(np.float32)
+        lag = self.max_lag
+        if self._history is None:
+            self._history = np.zeros((lag, 2), dtype=np.float32)
+
+        delay, peak = self.estimate_delay(x[:, 0], x[:, 1])
+        if peak >= self.min_peak:
+            self.delay = delay
+
+        # Delay the channel that leads by the measured delay.
+        full = np.concatenate((self._history, x))
+        shift0, shift1 = (0, self.delay) if self.delay >= 0 else (-self.delay, 0)
+        n = len(x)
+        mixed = 0.5 * (full[lag - shift0:lag - shift0 + n, 0] +
+                       full[lag - shift1:lag - shift1 + n, 1])
+        self._history = full[-lag:]
+
+        np.rint(mixed, out=mixed)
+        out[:] = mixed
+
+
+class BestChannel(object):
+
+    """Picks, for each frame, the microphone with the best signal-to-noise.
+
+    Each channel's noise floor follows its quietest frames and rises slowly.
+    The other channel is only picked once its SNR is hysteresis_db better,
+    and switches are crossfaded over one frame to avoid clicks.
+    """
+
+    def __init__(self, sample_rate_hz=16000, frame_s=0.02, hysteresis_db=3.0,
+                 noise_rise_db=0.1):
+        self.frame_len = int(sample_rate_hz * frame_s)
+        self.hysteresis_db = hysteresis_db
+        self.noise_rise_db = noise_rise_db
+        self.channel = 0
+        self._last_choice = 0.0
+        self._noise_db = None
+        self._ramp = np.linspace(0, 1, self.frame_len, endpoint=False,
+                                 dtype=np.float32)
+
+    def process(self, samples, out):
+        n = len(samples)
+        count = n // self.frame_len
+        if not count:
+            out[:] = samples[:, self.channel]
+            return
+
+        x = samples.astype(np.float32)
+        frames = x[:count * self.frame_len].reshape(count, self.frame_len, -1)
+        energy_db = 10 * np.log10(np.mean(frames * frames, axis=1) + 1.0)
+
+        if self._noise_db is None:
+            self._noise_db = energy_db.min(axis=0)
+        self._noise_db = np.minimum(self._noise_db + self.noise_rise_db,
+                                    energy_db.min(axis=0))
+        advantage = (energy_db - self._noise_db) @ np.array([-1.0, 1.0])
+
+        # The choice carries over from frame to frame, so this part runs per
+        # frame on scalars.
+        choice = np.empty(count, dtype=np.float32)
+        for i in range(count):
+            if self.channel == 0 and advantage[i] > self.hysteresis_db:
+                self.channel = 1
+            elif self.channel == 1 and advantage[i] < -self.hysteresis_db:
+                self.channel = 0
+            choice[i] = self.channel
+
+        # Weight of channel 1 for each sample, ramping where the choice changed.
+        starts = np.concatenate(([self._last_choice], choice[:-1]))
+        weight = starts[:, None] + (choice - starts)[:, None] * self._ramp
+        weight = np.concatenate((weight.ravel(),
+                                 np.full(n - count * self.frame_len, choice[-1],
+                                         dtype=np.float32)))
+        self._last_choice = choice[-1]
+
+        mixed = x[:, 0] + weight * (x[:, 1] - x[:, 0])
+        np.rint(mixed, out=mixed)
+        out[:] = mixed
+
+
+class Mean(object):
+
+    """Averages the channels."""
+
+    def __init__(self, sample_rate_hz=16000):
+        pass
+
+    def process(self, samples, out):
+        out[:] = np.rint(samples.mean(axis=1))
+
+
+MIXERS = {
+    'beamform': DelayAndSum,
+    'best': BestChannel,
+    'mean': Mean,
+}
+
+
+def make_mixer(name, sample_rate_hz=16000):
+    """Creates a mixer by name: 'beamform', 'best' or 'mean'."""
+    if name not in MIXERS:
+        raise ValueError('unknown mixer: %s' % name)
+    return MIXERS[name](sample_rate_hz)
+
+
+def _main():
+    import time
+
+    sample_rate_hz = 16000
+    chunk = int(0.1 * sample_rate_hz)
+    seconds = 60
+    rng = np.random.RandomState(0)
+
+    # A source that talks for a second, then pauses for one, 2 samples closer
+    # to the second microphone, in independent noise.
+    n = seconds * sample_rate_hz
+    source = rng.randn(n + 2) * 3000
+    source *= (np.arange(n + 2) // sample_rate_hz) % 2
+
+    def snr_db(mono):
+        # Compare against the source as heard by either microphone.
+        best = -np.inf
+        for shift in range(3):
+            clean = source[shift:shift + n]
+            residual = mono - clean
+            best = max(best, 10 * np.log10(np.mean(clean ** 2) / np.mean(residual ** 2)))
+        return best
+
+    print('%d s of stereo audio in %d ms chunks' % (seconds, chunk * 1000 // sample_rate_hz))
+    for scenario, noise_levels in (('equal noise', (1500, 1500)),
+                                   ('first mic noisy', (4500, 1500))):
+        noise = rng.randn(n, 2) * noise_levels
+        stereo = np.stack((source[:-2], source[2:]), axis=1) + noise
+        stereo = np.clip(stereo, -32768, 32767).astype(np.int16)
+
+        print('%s: first mic SNR %.1f dB' % (scenario, snr_db(stereo[:, 0])))
+        for name in sorted(MIXERS):
+            mixer = make_mixer(name, sample_rate_hz)
+            out = np.empty(len(stereo), dtype=np.int16)
+            start = time.perf_counter()
+            for pos in range(0, len(stereo), chunk):
+                mixer.process(stereo[pos:pos + chunk], out[pos:pos + chunk])
+            elapsed = time.perf_counter() - start
+            print('  %-8s %6.1f ms per second of audio (%5.0fx real time),'
+                  ' SNR %.1f dB' % (name, elapsed / seconds * 1000,
+                                    seconds / elapsed, snr_db(out)))
+
+
+if __name__ == '__main__':
+    _main()
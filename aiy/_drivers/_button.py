@@ -14,9 +14,9 @@
 
 """Button driver for the VoiceHat."""
 
-import time
+import threading
 
-import RPi.GPIO as GPIO
+import aiy._drivers._gpio as gpio
 
 
 class Button(object):
@@ -24,48 +24,49 @@ class Button(object):
 
     def __init__(self,
                  channel,
-                 polarity=GPIO.FALLING,
-                 pull_up_down=GPIO.PUD_UP,
-                 debounce_time=0.08):
+                 polarity=gpio.FALLING,
+                 pull_up_down=gpio.PUD_UP,
+                 debounce_time=0.08,
+                 backend=None):
         """A simple GPIO-based button driver.
 
         This driver supports a simple GPIO-based button. It works by detecting
-        edges on the given GPIO channel. Debouncing is automatic.
+        edges on the given GPIO channel. Debouncing is automatic, with a timer
+        started from the time of the edge.
 
         Args:
           channel: the GPIO pin number to use (BCM mode)
-          polarity: the GPIO polarity to detect; either GPIO.FALLING or
-            GPIO.RISING.
+          polarity: the GPIO polarity to detect; either gpio.FALLING or
+            gpio.RISING (GPIO.FALLING and GPIO.RISING work too).
           pull_up_down: whether the port should be pulled up or down; defaults to
-            GPIO.PUD_UP.
+            gpio.PUD_UP.
           debounce_time: the time used in debouncing the button in seconds.
+          backend: the aiy._drivers._gpio backend to use; defaults to the
+            shared one from gpio.get_backend().
         """
 
-        if polarity not in [GPIO.FALLING, GPIO.RISING]:
-            raise ValueError(
-                'polarity must be one of: GPIO.FALLING or GPIO.RISING')
-
         self.channel = int(channel)
         self.polarity = polarity
-        self.expected_value = polarity == GPIO.RISING
+        self.expected_value = gpio.pressed_value(polarity)
         self.debounce_time = debounce_time
 
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(channel, GPIO.IN, pull_up_down=pull_up_down)
+        self.backend = backend or gpio.get_backend()
+        self.debouncer = gpio.Debouncer(debounce_time, self._settled)
+        self.backend.watch(self.channel, pull_up_down, self.debouncer.edge)
+        self.debouncer.value = self.backend.read(self.channel)
 
         self.callback = None
+        self._pressed = threading.Event()
 
     def wait_for_press(self):
         """Waits for the button to be pressed.
 
-        This method blocks until the button is pressed.
+        This method blocks until the button is pressed. It cancels any callback
+        set with on_press().
         """
-        GPIO.add_event_detect(self.channel, self.polarity)
-        while True:
-            if GPIO.event_detected(self.channel) and self._debounce():
-                GPIO.remove_event_detect(self.channel)
-                return
-            time.sleep(0.02)
+        self.callback = None
+        self._pressed.clear()
+        self._pressed.wait()
 
     def on_press(self, callback):
         """Calls the callback whenever the button is pressed.
@@ -80,25 +81,12 @@ class Button(object):
               print "button pressed: channel = %d" % channel
           my_button.on_press(MyButtonPressHandler)
         """
-        GPIO.remove_event_detect(self.channel)
-        if callback is not None:
-            self.callback = callback
-            GPIO.add_event_detect(
-                self.channel, self.polarity, callback=self._debounce_and_callback)
-
-    def _debounce_and_callback(self, _):
-        if self._debounce():
-            self.callback()
-
-    def _debounce(self):
-        """Debounces the GPIO signal.
-
-        Check that the input holds the expected value for the debounce
-        period, to avoid false trigger on short pulses.
-        """
-        start = time.time()
-        while time.time() < start + self.debounce_time:
-            if GPIO.input(self.channel) != self.expected_value:
-                return False
-            time.sleep(0.01)
-        return True
+        self.callback = callback
+
+    def _settled(self, value, _):
+        if value != self.expected_value:
+            return
+        self._pressed.set()
+        callback = self.callback
+        if callback:
+            callback(self.channel)
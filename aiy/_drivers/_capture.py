@@ -0,0 +1,196 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Capture sources that the Recorder reads audio from.
+
+A capture source has open() and close() methods, and either readinto(buf) or
+read(size) to get audio. Both return no data at end-of-stream, which happens
+after close() or if the device goes away. Calling open() again restarts
+capture, releasing whatever the previous open() acquired.
+
+Sources may also have release(), which the reading thread calls to close the
+device while capture is idle; open() then reopens it.
+"""
+
+import logging
+import select
+import subprocess
+
+import aiy._drivers._alsa
+
+logger = logging.getLogger('recorder')
+
+try:
+    import alsaaudio
+except ImportError:
+    alsaaudio = None
+
+
+class ArecordSource(object):
+
+    """Captures audio by running arecord and reading from its stdout."""
+
+    def __init__(self, input_device, channels, bytes_per_sample, sample_rate_hz,
+                 period_size=None, buffer_size=None):
+        self._cmd = [
+            'arecord',
+            '-q',
+            '-t', 'raw',
+            '-D', input_device,
+            '-c', str(channels),
+            '-f', aiy._drivers._alsa.sample_width_to_string(bytes_per_sample),
+            '-r', str(sample_rate_hz),
+        ]
+        if period_size:
+            self._cmd.append('--period-size=%d' % period_size)
+        if buffer_size:
+            self._cmd.append('--buffer-size=%d' % buffer_size)
+
+        self._arecord = None
+
+    @property
+    def pid(self):
+        """The arecord process, so it can be given the capture priority."""
+        return self._arecord.pid if self._arecord else None
+
+    def open(self):
+        self._reap()
+        # Unbuffered, so that readinto() goes straight from the pipe to the ring.
+        self._arecord = subprocess.Popen(self._cmd, stdout=subprocess.PIPE, bufsize=0)
+
+    def readinto(self, buf):
+        return self._arecord.stdout.readinto(buf)
+
+    def close(self):
+        if self._arecord:
+            self._arecord.kill()
+
+    def release(self):
+        self._reap()
+
+    def _reap(self):
+        if self._arecord:
+            self._arecord.kill()
+            self._arecord.wait()
+            self._arecord.stdout.close()
+            self._arecord = None
+
+
+class AlsaSource(object):
+
+    """Captures audio in-process through pyalsaaudio.
+
+    The PCM is opened in non-blocking mode and read when poll() says a period
+    is ready, so there is one wakeup per period and no pipe in between.
+    overruns counts the times the capture buffer overflowed and ALSA dropped
+    audio.
+    """
+
+    # How often a blocked read checks whether the source was closed.
+    POLL_TIMEOUT_MS = 200
+
+    def __init__(self, input_device, channels, bytes_per_sample, sample_rate_hz,
+                 period_size=None, buffer_size=None):
+        if alsaaudio is None:
+            raise ImportError('pyalsaaudio is needed for the alsa capture backend')
+
+        self._device = input_device
+        self._channels = channels
+        self._rate = sample_rate_hz
+        self._format = {
+            1: alsaaudio.PCM_FORMAT_S8,
+            2: alsaaudio.PCM_FORMAT_S16_LE,
+            4: alsaaudio.PCM_FORMAT_S32_LE,
+        }[bytes_per_sample]
+        self._period_size = period_size or int(sample_rate_hz * 0.1)
+        if buffer_size:
+            self._periods = max(2, buffer_size // self._period_size)
+        else:
+            self._periods = 4
+
+        self._pcm = None
+        self._poll = None
+        self._pending = b''
+        self._closed = False
+        self.overruns = 0
+
+    def open(self):
+        self.release()
+        self._pcm = alsaaudio.PCM(
+            type=alsaaudio.PCM_CAPTURE,
+            mode=alsaaudio.PCM_NONBLOCK,
+            device=self._device,
+            channels=self._channels,
+            rate=self._rate,
+            format=self._format,
+            periodsize=self._period_size,
+            periods=self._periods)
+
+        self._poll = select.poll()
+        for fd, mask in self._pcm.polldescriptors():
+            self._poll.register(fd, mask)
+
+    def read(self, size):
+        """Returns up to size bytes, waiting for the next period if needed."""
+
+        while not self._pending:
+            if self._closed:
+                # Only the reading thread touches the PCM, so release it here.
+                if self._pcm:
+                    self._pcm.close()
+                    self._pcm = None
+                return b''
+
+            length, data = self._pcm.read()
+            if length > 0:
+                self._pending = memoryview(data)
+            elif length < 0:
+                # -EPIPE: the capture buffer overran and ALSA dropped frames.
+                self.overruns += 1
+                logger.warning('ALSA capture overrun (%d, %d so far)',
+                               length, self.overruns)
+            else:
+                self._poll.poll(self.POLL_TIMEOUT_MS)
+
+        data = self._pending[:size]
+        self._pending = self._pending[size:]
+        return data
+
+    def close(self):
+        self._closed = True
+
+    def release(self):
+        self._pending = b''
+        if self._pcm:
+            self._pcm.close()
+            self._pcm = None
+
+
+def make_source(backend, *args, **kwargs):
+    """Creates a capture source for the given backend name.
+
+    'auto' uses the in-process ALSA backend when pyalsaaudio is installed, and
+    falls back to arecord otherwise.
+    """
+
+    if backend == 'arecord':
+        return ArecordSource(*args, **kwargs)
+    if backend == 'alsa':
+        return AlsaSource(*args, **kwargs)
+    if backend == 'auto':
+        if alsaaudio is not None:
+            return AlsaSource(*args, **kwargs)
+        logger.info('pyalsaaudio not installed, capturing with arecord')
+        return ArecordSource(*args, **kwargs)
+    raise ValueError('unknown capture backend: %s' % backend)
@@ -0,0 +1,220 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Delivers recorded audio chunks to processors.
+
+Processors are kept in a tuple that is replaced, never modified, when one is
+added or removed, so the capture thread can iterate it without a lock while
+other threads change the set of processors.
+
+A processor is either called directly on the capture thread, or through a
+bounded queue with its own worker thread, so that a slow processor can't stall
+capture for the others.
+"""
+
+import logging
+import threading
+import time
+
+import queue
+
+logger = logging.getLogger('recorder')
+
+# What a queued processor does when its queue is full.
+DROP_OLDEST = 'drop-oldest'  # discard the oldest queued chunk
+DROP_NEWEST = 'drop-newest'  # discard the new chunk
+BLOCK = 'block'  # make the capture thread wait (backpressure)
+
+POLICIES = (DROP_OLDEST, DROP_NEWEST, BLOCK)
+
+
+class _DirectProcessor(object):
+
+    """Calls a processor on the capture thread."""
+
+    def __init__(self, processor):
+        self.processor = processor
+        self.chunks = 0
+        self.errors = 0
+        self.busy_s = 0.0
+        self.max_call_s = 0.0
+
+    def add_data(self, data):
+        start = time.monotonic()
+        try:
+            self.processor.add_data(data)
+        except Exception:  # pylint: disable=broad-except
+            self.errors += 1
+            # Don't flood the log with a traceback ten times a second.
+            if self.errors % 100 == 1:
+                logger.exception('audio processor %r failed (%d errors)',
+                                 self.processor, self.errors)
+        elapsed = time.monotonic() - start
+        self.chunks += 1
+        self.busy_s += elapsed
+        self.max_call_s = max(self.max_call_s, elapsed)
+
+    def stop(self):
+        pass
+
+    def get_stats(self):
+        return {
+            'chunks': self.chunks,
+            'errors': self.errors,
+            'busy_s': self.busy_s,
+            'max_call_s': self.max_call_s,
+        }
+
+
+class _QueuedProcessor(_DirectProcessor):
+
+    """Calls a processor on its own worker thread through a bounded queue."""
+
+    def __init__(self, processor, queue_size, policy):
+        super().__init__(processor)
+
+        if policy not in POLICIES:
+            raise ValueError('policy must be one of: ' + ', '.join(POLICIES))
+
+        self._policy = policy
+        self._queue = queue.Queue(maxsize=queue_size)
+        self.enqueued = 0
+        self.dropped = 0
+        self.max_lag = 0
+        self.blocked_s = 0.0
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def add_data(self, data):
+        """Queues a chunk for the worker; runs on the capture thread."""
+
+        if isinstance(data, memoryview):
+            # The recorder's views into its ring can be overwritten while they
+            # wait in the queue, or while the worker is still processing them.
+            data = bytes(data)
+        if self._policy == BLOCK:
+            start = time.monotonic()
+            self._queue.put(data)
+            self.blocked_s += time.monotonic() - start
+        else:
+            try:
+                self._queue.put_nowait(data)
+            except queue.Full:
+                self.dropped += 1
+                if self._policy == DROP_NEWEST:
+                    return
+                try:
+                    self._queue.get_nowait()
+                except queue.Empty:
+                    pass
+                self._queue.put_nowait(data)
+
+        self.enqueued += 1
+        self.max_lag = max(self.max_lag, self._queue.qsize())
+
+    def _run(self):
+        while True:
+            data = self._queue.get()
+            if data is None:
+                return
+            super().add_data(data)
+
+    def stop(self):
+        """Lets the worker finish the queued chunks and exit."""
+        self._queue.put(None)
+
+    def get_stats(self):
+        stats = super().get_stats()
+        stats.update({
+            'enqueued': self.enqueued,
+            'dropped': self.dropped,
+            'lag': self._queue.qsize(),
+            'max_lag': self.max_lag,
+            'blocked_s': self.blocked_s,
+        })
+        return stats
+
+
+def wrap(processor, queue_size=0, policy=DROP_OLDEST):
+    """Returns an object whose add_data() passes data on to processor, on the
+    calling thread, or with a queue_size, through a queue with its own worker
+    thread. It counts calls and errors in get_stats(), and stop() lets a
+    queued worker exit.
+    """
+    if queue_size:
+        return _QueuedProcessor(processor, queue_size, policy)
+    return _DirectProcessor(processor)
+
+
+class Dispatcher(object):
+
+    """Sends audio chunks to a copy-on-write set of processors."""
+
+    def __init__(self):
+        self._entries = ()
+
+        # Serializes changes to the set of processors, and orders them with
+        # respect to the chunks being dispatched.
+        self._lock = threading.Lock()
+        self.chunks_dispatched = 0
+
+    def add(self, processor, queue_size=0, policy=DROP_OLDEST, preroll=None):
+        """Adds a processor, first passing it the chunks in preroll.
+
+        preroll is a callable that gets the number of chunks dispatched so far
+        and returns the chunks recorded before it.
+        """
+        entry = wrap(processor, queue_size, policy)
+
+        with self._lock:
+            if preroll:
+                for chunk in preroll(self.chunks_dispatched):
+                    entry.add_data(chunk)
+            self._entries += (entry,)
+
+    def remove(self, processor):
+        """Removes a processor. Returns False if it wasn't added."""
+
+        with self._lock:
+            for entry in self._entries:
+                if entry.processor is processor:
+                    self._entries = tuple(e for e in self._entries if e is not entry)
+                    break
+            else:
+                return False
+
+        entry.stop()
+        return True
+
+    def dispatch(self, chunk):
+        """Sends a chunk to every processor."""
+
+        with self._lock:
+            entries = self._entries
+            self.chunks_dispatched += 1
+
+        for entry in entries:
+            entry.add_data(chunk)
+
+    def skip(self):
+        """Counts a chunk that isn't sent to the processors, so that pre-roll
+        still lines up with the chunks recorded.
+        """
+        with self._lock:
+            self.chunks_dispatched += 1
+
+    def get_stats(self):
+        """Returns a dict of counters for each processor."""
+        return {entry.processor: entry.get_stats() for entry in self._entries}
@@ -0,0 +1,342 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Noise suppression and automatic gain control for recorded speech.
+
+Both are audio processors that pass 16-bit mono audio on to a target
+processor, like the VAD gate:
+
+    profile = NoiseProfile()
+    recorder.add_processor(profile, queue_size=4)  # learns while idle
+    stage = NoiseSuppressor(Agc(recognizer), profile)
+
+To enhance a WAV file and time it:
+    python3 -m aiy._drivers._enhance in.wav out.wav
+"""
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger('enhance')
+
+FULL_SCALE = 32768.0
+
+
+class _Stft(object):
+
+    """Splits a stream into 50% overlapping windowed frames and back.
+
+    A square-root Hann window is used for both analysis and synthesis, so
+    overlap-adding the frames reconstructs the input exactly when nothing is
+    changed, delayed by one hop.
+    """
+
+    def __init__(self, frame_len):
+        self.frame_len = frame_len
+        self.hop = frame_len // 2
+        self.window = np.sqrt(np.hanning(frame_len + 1)[:frame_len]).astype(np.float32)
+        self.reset()
+
+    def reset(self):
+        self._input = np.zeros(self.hop, dtype=np.float32)
+        self._tail = np.zeros(self.hop, dtype=np.float32)
+
+    def analyze(self, samples):
+        """Returns the spectra of the frames completed by samples."""
+
+        data = np.concatenate((self._input, samples))
+        count = len(data) // self.hop - 1
+        if count < 1:
+            self._input = data
+            return None
+
+        hops = data[:(count + 1) * self.hop].reshape(count + 1, self.hop)
+        self._input = data[count * self.hop:]
+        frames = np.concatenate((hops[:-1], hops[1:]), axis=1)
+        return np.fft.rfft(frames * self.window, axis=1)
+
+    def synthesize(self, spectra):
+        """Overlap-adds frames from analyze() and returns the finished audio."""
+
+        frames = np.fft.irfft(spectra, self.frame_len, axis=1) * self.window
+        tails = np.concatenate((self._tail[None, :], frames[:-1, self.hop:]))
+        self._tail = frames[-1, self.hop:]
+        return (frames[:, :self.hop] + tails).ravel()
+
+
+class NoiseProfile(object):
+
+    """Tracks the power spectrum of the background noise.
+
+    The profile starts from the first frames it sees, which should be
+    background noise. After that, frames whose power is within speech_ratio
+    of the profile are treated as noise and averaged in. If the noise gets
+    louder and no frame qualifies, the profile rises by rise_db per second
+    until it catches up.
+
+    A profile is itself an audio processor, so it can be added to the
+    Recorder to learn the noise all the time, including between requests
+    while nobody is speaking. That needs the ALWAYS power mode, as processors
+    don't run while capture is idle in the others.
+    """
+
+    def __init__(self, sample_rate_hz=16000, frame_len=512, speech_ratio=2.5,
+                 time_constant_s=0.5, rise_db=3.0):
+        self.frame_len = frame_len
+        self.speech_ratio = speech_ratio
+        hop_s = frame_len / 2 / sample_rate_hz
+        self._decay = np.exp(-hop_s / time_constant_s)
+        self._rise = 10 ** (rise_db * hop_s / 10)
+
+        # Replaced, never changed in place, so readers on other threads
+        # always see a whole profile.
+        self.power = None
+        self._stft = _Stft(frame_len)
+
+    def add_data(self, data):
+        samples = np.frombuffer(data, dtype=np.int16).astype(np.float32)
+        spectra = self._stft.analyze(samples)
+        if spectra is not None:
+            self.update(np.abs(spectra) ** 2)
+
+    def update(self, power):
+        """Updates the profile from a (frames, bins) array of powers."""
+
+        if self.power is None:
+            self.power = power.mean(axis=0) + 1e-3
+            return
+
+        noise = np.mean(power / self.power, axis=1) < self.speech_ratio
+        count = int(np.count_nonzero(noise))
+        if count:
+            weight = self._decay ** count
+            self.power = weight * self.power + (1 - weight) * power[noise].mean(axis=0)
+        else:
+            self.power = self.power * self._rise ** len(power)
+
+
+class NoiseSuppressor(object):
+
+    """An audio processor that removes stationary background noise.
+
+    Each 32 ms frame's power spectrum has over_subtraction times the noise
+    profile subtracted from it, and is kept at least floor_db below its
+    original level to avoid the warbling of bins switching on and off. Gains
+    may rise at once but fall by at most release_db per frame, which keeps
+    the ends of words. Output lags input by half a frame (16 ms).
+
+    Without a profile, the suppressor tracks the noise in the audio it gets
+    itself. A profile that is added to the Recorder is only read.
+    """
+
+    def __init__(self, target, profile=None, sample_rate_hz=16000,
+                 over_subtraction=2.0, floor_db=-15.0, release_db=3.0):
+        self._target = target
+        self._own_profile = profile is None
+        self.profile = profile or NoiseProfile(sample_rate_hz)
+        self.over_subtraction = over_subtraction
+        self._floor = 10 ** (floor_db / 20)
+        self._release = 10 ** (-release_db / 20)
+
+        self._stft = _Stft(self.profile.frame_len)
+        self.latency_s = self._stft.hop / sample_rate_hz
+        self.bytes_in = 0
+        self.frames = 0
+        self.reset()
+
+    def reset(self):
+        """Starts a new stream. The noise profile is kept."""
+        self._stft.reset()
+        self._gain = None
+
+    def get_stats(self):
+        mean_gain = float(np.mean(self._gain)) if self._gain is not None else None
+        return {
+            'bytes_in': self.bytes_in,
+            'frames': self.frames,
+            'mean_gain': mean_gain,
+        }
+
+    def add_data(self, data):
+        self.bytes_in += len(data)
+        samples = np.frombuffer(data, dtype=np.int16).astype(np.float32)
+        spectra = self._stft.analyze(samples)
+        if spectra is None:
+            return
+
+        power = np.abs(spectra) ** 2
+        if self._own_profile or self.profile.power is None:
+            self.profile.update(power)
+        gains = np.sqrt(np.maximum(
+            1 - self.over_subtraction * self.profile.power / (power + 1e-3),
+            self._floor ** 2))
+
+        # Limit how fast gains fall from frame to frame; this carries over
+        # between frames, so it runs per frame on whole spectra.
+        for i in range(len(gains)):
+            if self._gain is not None:
+                np.maximum(gains[i], self._gain * self._release, out=gains[i])
+            self._gain = gains[i]
+
+        self.frames += len(gains)
+        out = self._stft.synthesize(spectra * gains)
+        self._target.add_data(_to_int16(out))
+
+
+class Agc(object):
+
+    """An audio processor that brings speech to a steady level.
+
+    The level is measured in blocks of block_s seconds. The gain moves
+    towards the one that would bring a block to target_dbfs, quickly
+    (attack_s) when it has to come down and slowly (release_s) when it has
+    to go up, and stays between min_gain_db and max_gain_db. Blocks quieter
+    than gate_dbfs, or less than gate_snr_db above the tracked noise floor,
+    hold the gain, so pauses aren't pumped up to speech level.
+    Gains are interpolated across each block, and peaks that would still
+    clip are limited. There is no lookahead, so it adds no latency.
+    """
+
+    def __init__(self, target, sample_rate_hz=16000, target_dbfs=-20.0,
+                 max_gain_db=24.0, min_gain_db=-6.0, gate_dbfs=-50.0,
+                 gate_snr_db=10.0, block_s=0.01, attack_s=0.02, release_s=0.5):
+        self._target = target
+        self.block_len = int(sample_rate_hz * block_s)
+        self.target_dbfs = target_dbfs
+        self.max_gain_db = max_gain_db
+        self.min_gain_db = min_gain_db
+        self.gate_dbfs = gate_dbfs
+        self.gate_snr_db = gate_snr_db
+        # The noise floor falls towards quieter blocks with a 0.2 s time
+        # constant, so single quiet blocks don't drag it down, and rises by
+        # 3 dB per second.
+        self._floor_fall = 1 - np.exp(-block_s / 0.2)
+        self._floor_rise_db = 3 * block_s
+        self._attack = 1 - np.exp(-block_s / attack_s)
+        self._release = 1 - np.exp(-block_s / release_s)
+
+        self.gain_db = 0.0
+        self.noise_dbfs = None
+        self.clipped = 0
+
+    def reset(self):
+        """Starts a new stream. The gain carries over as a starting point."""
+        pass
+
+    def get_stats(self):
+        return {
+            'gain_db': self.gain_db,
+            'noise_dbfs': self.noise_dbfs,
+            'clipped': self.clipped,
+        }
+
+    def add_data(self, data):
+        samples = np.frombuffer(data, dtype=np.int16).astype(np.float32)
+        n = len(samples)
+        if not n:
+            return
+
+        # Level of each block, the last one possibly partial.
+        ends = np.append(np.arange(self.block_len, n, self.block_len), n)
+        squares = np.concatenate(([0.0], np.cumsum(samples * samples, dtype=np.float64)))
+        starts = np.concatenate(([0], ends[:-1]))
+        power = (squares[ends] - squares[starts]) / (ends - starts)
+        level_dbfs = 10 * np.log10(power / FULL_SCALE ** 2 + 1e-10)
+        wanted = np.clip(self.target_dbfs - level_dbfs,
+                         self.min_gain_db, self.max_gain_db)
+
+        # The gain and noise floor carry over from block to block, so this
+        # part runs per block on scalars.
+        gains = np.empty(len(ends))
+        gain_db = self.gain_db
+        noise_dbfs = self.noise_dbfs
+        if noise_dbfs is None:
+            noise_dbfs = float(np.median(level_dbfs))
+        for i in range(len(ends)):
+            if level_dbfs[i] < noise_dbfs:
+                noise_dbfs += self._floor_fall * (level_dbfs[i] - noise_dbfs)
+            else:
+                noise_dbfs = min(noise_dbfs + self._floor_rise_db, float(level_dbfs[i]))
+            if (level_dbfs[i] > self.gate_dbfs and
+                    level_dbfs[i] > noise_dbfs + self.gate_snr_db):
+                rate = self._attack if wanted[i] < gain_db else self._release
+                gain_db += rate * (wanted[i] - gain_db)
+            gains[i] = gain_db
+
+        # Ramp from the previous gain to each block's gain over the block.
+        gain = np.interp(np.arange(1, n + 1), np.append(0, ends),
+                         10 ** (np.append(self.gain_db, gains) / 20))
+        self.gain_db = float(gain_db)
+        self.noise_dbfs = float(noise_dbfs)
+
+        out = samples * gain
+        self.clipped += int(np.count_nonzero(np.abs(out) >= FULL_SCALE))
+        self._target.add_data(_to_int16(out))
+
+
+def _to_int16(samples):
+    return np.clip(np.rint(samples), -FULL_SCALE, FULL_SCALE - 1).astype(np.int16).tobytes()
+
+
+def _main():
+    import argparse
+    import time
+    import wave
+
+    parser = argparse.ArgumentParser(description='Denoise and level a WAV file')
+    parser.add_argument('input', help='16-bit mono WAV file')
+    parser.add_argument('output', help='WAV file to write')
+    parser.add_argument('--no-agc', action='store_true', help='Only remove noise')
+    args = parser.parse_args()
+
+    with wave.open(args.input, 'rb') as wav:
+        rate = wav.getframerate()
+        if wav.getnchannels() != 1 or wav.getsampwidth() != 2:
+            parser.error('%s is not 16-bit mono' % args.input)
+        data = wav.readframes(wav.getnframes())
+
+    class Collector(object):
+        def __init__(self):
+            self.chunks = []
+
+        def add_data(self, data):
+            self.chunks.append(data)
+
+    collector = Collector()
+    stage = collector if args.no_agc else Agc(collector, rate)
+    suppressor = NoiseSuppressor(stage, sample_rate_hz=rate)
+
+    chunk = int(0.1 * rate) * 2
+    start = time.perf_counter()
+    for pos in range(0, len(data), chunk):
+        suppressor.add_data(data[pos:pos + chunk])
+    elapsed = time.perf_counter() - start
+
+    seconds = len(data) / 2 / rate
+    print('%.1f s of audio in %.0f ms (%.0fx real time), %.0f ms latency' % (
+        seconds, elapsed * 1000, seconds / elapsed, suppressor.latency_s * 1000))
+    print('suppressor: %s' % suppressor.get_stats())
+    if stage is not collector:
+        print('agc: %s' % stage.get_stats())
+
+    with wave.open(args.output, 'wb') as wav:
+        wav.setnchannels(1)
+        wav.setsampwidth(2)
+        wav.setframerate(rate)
+        wav.writeframes(b''.join(collector.chunks))
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,437 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Edge events from GPIO input lines, and debouncing them.
+
+A backend watches input lines and calls a function with (value, timestamp_s)
+on every edge, rising or falling, from its own thread. Timestamps are on the
+time.monotonic() clock. There are three backends:
+- CdevBackend: the Linux GPIO character device (/dev/gpiochip0), which
+  timestamps edges in the kernel, with one thread waiting on all lines
+- RpiGpioBackend: RPi.GPIO, which timestamps edges when its thread sees them
+- SimulatedBackend: lines driven by set_value() or press(), for testing
+  without hardware
+
+A Debouncer turns edges into steady levels with a timer, instead of polling
+the line in the callback. Lines are numbered as on the chip, which for
+/dev/gpiochip0 on a Raspberry Pi is the BCM numbering.
+
+To print debounced presses of the button on GPIO 23:
+    python3 -m aiy._drivers._gpio --line 23
+Or of a simulated bouncy button:
+    python3 -m aiy._drivers._gpio --backend sim
+"""
+
+import ctypes
+import fcntl
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+try:
+    import RPi.GPIO as GPIO
+except ImportError:
+    GPIO = None
+
+logger = logging.getLogger('gpio')
+
+FALLING = 'falling'
+RISING = 'rising'
+
+PUD_UP = 'up'
+PUD_DOWN = 'down'
+PUD_OFF = 'off'
+
+# RPi.GPIO's constants are accepted too, for existing callers.
+_EDGES = {FALLING: FALLING, RISING: RISING}
+_PULLS = {PUD_UP: PUD_UP, PUD_DOWN: PUD_DOWN, PUD_OFF: PUD_OFF}
+if GPIO:
+    _EDGES.update({GPIO.FALLING: FALLING, GPIO.RISING: RISING})
+    _PULLS.update({GPIO.PUD_UP: PUD_UP, GPIO.PUD_DOWN: PUD_DOWN, GPIO.PUD_OFF: PUD_OFF})
+
+
+def pressed_value(polarity):
+    """Returns the level of a line after an edge of the given polarity."""
+    if polarity not in _EDGES:
+        raise ValueError('polarity must be FALLING or RISING')
+    return _EDGES[polarity] == RISING
+
+
+def _pull(pull_up_down):
+    if pull_up_down not in _PULLS:
+        raise ValueError('pull_up_down must be PUD_UP, PUD_DOWN or PUD_OFF')
+    return _PULLS[pull_up_down]
+
+
+# From linux/gpio.h, version 1 of the character device ABI.
+class _EventRequest(ctypes.Structure):
+    _fields_ = [
+        ('lineoffset', ctypes.c_uint32),
+        ('handleflags', ctypes.c_uint32),
+        ('eventflags', ctypes.c_uint32),
+        ('consumer_label', ctypes.c_char * 32),
+        ('fd', ctypes.c_int),
+    ]
+
+
+def _iowr(nr, size):
+    return (3 << 30) | (size << 16) | (0xB4 << 8) | nr
+
+
+_GET_LINEEVENT_IOCTL = _iowr(0x04, ctypes.sizeof(_EventRequest))
+_GET_LINE_VALUES_IOCTL = _iowr(0x08, 64)
+_HANDLE_REQUEST_INPUT = 1 << 0
+_HANDLE_BIAS = {PUD_UP: 1 << 5, PUD_DOWN: 1 << 6, PUD_OFF: 1 << 7}
+_EVENT_BOTH_EDGES = 3
+_EVENT_RISING_EDGE = 1
+# struct gpioevent_data: the timestamp in ns and the event id, padded.
+_EVENT = struct.Struct('=QI4x')
+
+
+class CdevBackend(object):
+
+    """Watches lines through the Linux GPIO character device.
+
+    The kernel timestamps each edge when it happens, so debouncing and
+    latency measurements don't depend on how quickly a thread wakes up.
+    Since Linux 5.7 these timestamps are on the monotonic clock; on older
+    kernels, edges are timestamped when they are read instead.
+    """
+
+    def __init__(self, chip='/dev/gpiochip0'):
+        self.chip = chip
+        self._chip_fd = os.open(chip, os.O_RDONLY | os.O_CLOEXEC)
+        self._lock = threading.Lock()
+        self._lines = {}  # line -> (fd, callback)
+        self._wake_r, self._wake_w = os.pipe()
+        self._closed = False
+        self._thread = None
+        self.kernel_timestamps = None
+
+    def watch(self, line, pull_up_down, callback):
+        pull = _pull(pull_up_down)
+        request = _EventRequest(lineoffset=line, eventflags=_EVENT_BOTH_EDGES,
+                                consumer_label=b'voice-recognizer')
+        request.handleflags = _HANDLE_REQUEST_INPUT | _HANDLE_BIAS[pull]
+        try:
+            fcntl.ioctl(self._chip_fd, _GET_LINEEVENT_IOCTL, request)
+        except OSError:
+            # Bias flags need Linux 5.5; leave the pull as it is.
+            logger.warning('could not set the pull of GPIO %d to %s', line, pull)
+            request.handleflags = _HANDLE_REQUEST_INPUT
+            fcntl.ioctl(self._chip_fd, _GET_LINEEVENT_IOCTL, request)
+
+        with self._lock:
+            self._unwatch(line)
+            self._lines[line] = (request.fd, callback)
+            if not self._thread:
+                self._thread = threading.Thread(target=self._run, name='gpio', daemon=True)
+                self._thread.start()
+        os.write(self._wake_w, b'x')
+
+    def unwatch(self, line):
+        with self._lock:
+            self._unwatch(line)
+        os.write(self._wake_w, b'x')
+
+    def _unwatch(self, line):
+        if line in self._lines:
+            os.close(self._lines.pop(line)[0])
+
+    def read(self, line):
+        with self._lock:
+            fd = self._lines[line][0]
+            values = bytearray(64)
+            fcntl.ioctl(fd, _GET_LINE_VALUES_IOCTL, values)
+        return bool(values[0])
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            for line in list(self._lines):
+                self._unwatch(line)
+        os.write(self._wake_w, b'x')
+        if self._thread:
+            self._thread.join()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+        os.close(self._chip_fd)
+
+    def _run(self):
+        while True:
+            with self._lock:
+                if self._closed:
+                    return
+                lines = dict(self._lines)
+            fds = {fd: callback for fd, callback in lines.values()}
+            ready, _, _ = select.select(list(fds) + [self._wake_r], [], [])
+            for fd in ready:
+                if fd == self._wake_r:
+                    os.read(self._wake_r, 64)
+                    continue
+                try:
+                    data = os.read(fd, 16 * _EVENT.size)
+                except OSError:
+                    # Unwatched while we waited.
+                    continue
+                for offset in range(0, len(data) - _EVENT.size + 1, _EVENT.size):
+                    timestamp_ns, event_id = _EVENT.unpack_from(data, offset)
+                    fds[fd](event_id == _EVENT_RISING_EDGE, self._timestamp(timestamp_ns))
+
+    def _timestamp(self, timestamp_ns):
+        now = time.monotonic()
+        timestamp_s = timestamp_ns / 1e9
+        if self.kernel_timestamps is None:
+            self.kernel_timestamps = 0 <= now - timestamp_s < 10
+            if not self.kernel_timestamps:
+                logger.warning('GPIO event timestamps are not on the monotonic clock')
+        return timestamp_s if self.kernel_timestamps else now
+
+
+class RpiGpioBackend(object):
+
+    """Watches lines with RPi.GPIO. Edges are timestamped, and the line read,
+    when RPi.GPIO's thread calls back, so a bounce may be missed.
+    """
+
+    _PUD = {PUD_UP: 'PUD_UP', PUD_DOWN: 'PUD_DOWN', PUD_OFF: 'PUD_OFF'}
+
+    def __init__(self):
+        if not GPIO:
+            raise RuntimeError('RPi.GPIO is not installed')
+        GPIO.setmode(GPIO.BCM)
+
+    def watch(self, line, pull_up_down, callback):
+        GPIO.setup(line, GPIO.IN, pull_up_down=getattr(GPIO, self._PUD[_pull(pull_up_down)]))
+        GPIO.remove_event_detect(line)
+        GPIO.add_event_detect(
+            line, GPIO.BOTH,
+            callback=lambda channel: callback(bool(GPIO.input(channel)), time.monotonic()))
+
+    def unwatch(self, line):
+        GPIO.remove_event_detect(line)
+
+    def read(self, line):
+        return bool(GPIO.input(line))
+
+    def close(self):
+        pass
+
+
+class SimulatedBackend(object):
+
+    """Lines that are driven by calling set_value() or press().
+
+    Lines start at the level their pull gives them, or low without one.
+    Callbacks run on the thread that changes the line.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._values = {}
+        self._callbacks = {}
+
+    def watch(self, line, pull_up_down, callback):
+        with self._lock:
+            self._values.setdefault(line, _pull(pull_up_down) == PUD_UP)
+            self._callbacks[line] = callback
+
+    def unwatch(self, line):
+        with self._lock:
+            self._callbacks.pop(line, None)
+
+    def read(self, line):
+        with self._lock:
+            return self._values.get(line, False)
+
+    def close(self):
+        pass
+
+    def set_value(self, line, value, timestamp_s=None):
+        """Drives a line, calling its callback if the level changes."""
+        with self._lock:
+            if self._values.get(line) == bool(value):
+                return
+            self._values[line] = bool(value)
+            callback = self._callbacks.get(line)
+        if callback:
+            callback(bool(value), time.monotonic() if timestamp_s is None else timestamp_s)
+
+    def press(self, line, hold_s=0.2, bounces=3, bounce_s=0.002, pressed=False):
+        """Presses a button on a line for hold_s seconds, with contact bounce
+        at both ends, on a new thread. Returns the thread.
+        """
+        def run():
+            for value in (pressed, not pressed):
+                for _ in range(bounces):
+                    self.set_value(line, value)
+                    time.sleep(bounce_s)
+                    self.set_value(line, not value)
+                    time.sleep(bounce_s)
+                self.set_value(line, value)
+                if value == pressed:
+                    time.sleep(hold_s)
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+
+BACKENDS = {
+    'cdev': CdevBackend,
+    'rpi': RpiGpioBackend,
+    'sim': SimulatedBackend,
+}
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def set_backend(name):
+    """Chooses the backend get_backend() creates: 'cdev', 'rpi', 'sim', or
+    'auto' for the character device if there is one, else RPi.GPIO.
+
+    This has to be called before the first call to get_backend().
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is not None:
+            raise RuntimeError('the GPIO backend has already been created')
+        _backend = _create_backend(name)
+
+
+def _create_backend(name):
+    if name == 'auto':
+        name = 'cdev' if os.path.exists('/dev/gpiochip0') else 'rpi'
+    if name not in BACKENDS:
+        raise ValueError('unknown GPIO backend: %s' % name)
+    logger.info('using the %s GPIO backend', name)
+    return BACKENDS[name]()
+
+
+def get_backend():
+    """Returns the backend shared by the buttons and triggers of this
+    process."""
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            _backend = _create_backend('auto')
+        return _backend
+
+
+class Debouncer(object):
+
+    """Turns the edges of a line into steady levels.
+
+    Pass edge() as the backend's callback. When a level has held for
+    debounce_s after the edge that started it, measured from the edge's
+    timestamp, callback is called with (value, timestamp_s) from a timer
+    thread. Levels that are already reported, or don't last, are not; if
+    edges settle back to the reported level, on_noise is called instead.
+    """
+
+    def __init__(self, debounce_s, callback, value=None, on_noise=None):
+        self.debounce_s = debounce_s
+        self.callback = callback
+        self.on_noise = on_noise
+        self.value = value
+        self.bounces = 0
+        self._lock = threading.Lock()
+        self._timer = None
+        self._pending = None
+
+    def edge(self, value, timestamp_s):
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+                self._timer = None
+                self.bounces += 1
+            elif value == self.value:
+                return
+            self._pending = (value, timestamp_s)
+            delay = max(0.0, timestamp_s + self.debounce_s - time.monotonic())
+            self._timer = threading.Timer(delay, self._settle, [self._pending])
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _settle(self, pending):
+        with self._lock:
+            if pending is not self._pending:
+                return
+            self._timer = None
+            self._pending = None
+            noise = pending[0] == self.value
+            self.value = pending[0]
+        if not noise:
+            self.callback(*pending)
+        elif self.on_noise:
+            self.on_noise()
+
+    def cancel(self):
+        with self._lock:
+            if self._timer:
+                self._timer.cancel()
+            self._timer = None
+            self._pending = None
+
+
+def _main():
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Print debounced GPIO presses')
+    parser.add_argument('--backend', default='auto', choices=['auto'] + sorted(BACKENDS))
+    parser.add_argument('--line', type=int, default=23, help='Line (BCM GPIO) number')
+    parser.add_argument('--debounce', type=float, default=0.05,
+                        help='Seconds a level has to hold')
+    args = parser.parse_args()
+
+    set_backend(args.backend)
+    backend = get_backend()
+    first_edge = []
+
+    def on_level(value, timestamp_s):
+        delay = time.monotonic() - (first_edge[0] if first_edge else timestamp_s)
+        print('%s, %.1f ms after the first edge, %d bounces so far' % (
+            'released' if value else 'pressed', delay * 1000, debouncer.bounces))
+        first_edge[:] = []
+
+    def on_edge(value, timestamp_s):
+        if not first_edge:
+            first_edge.append(timestamp_s)
+        debouncer.edge(value, timestamp_s)
+
+    debouncer = Debouncer(args.debounce, on_level)
+    backend.watch(args.line, PUD_UP, on_edge)
+    debouncer.value = backend.read(args.line)
+    try:
+        if isinstance(backend, SimulatedBackend):
+            for _ in range(3):
+                backend.press(args.line).join()
+                time.sleep(args.debounce * 2)
+        else:
+            print('Press the button on GPIO %d' % args.line)
+            while True:
+                time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        backend.close()
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,205 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Feeds audio to stages in the frame size and sample type each one wants.
+
+A stage is an audio processor that can declare, as class attributes:
+- FRAME_S: the length of the frames it gets, in seconds, or None for the
+  recorder's chunks
+- DTYPE: BYTES for a memoryview of 16-bit samples, like plain processors
+  get, INT16 for a NumPy int16 array, or FLOAT32 for a NumPy float32 array
+  scaled to [-1, 1)
+
+    graph = recorder.get_graph()
+    graph.add_stage(my_stage)
+
+Stages run on the capture thread unless they are added with a queue_size,
+which runs them on a worker thread of their own, so that a slow stage can't
+delay capture.
+
+The samples of each chunk are converted to each type at most once, and
+shared by all stages that want that type. Frames that fit within a chunk
+are views of it; only frames that straddle two chunks are copied.
+"""
+
+import collections
+import logging
+import threading
+
+import numpy as np
+
+import aiy._drivers._dispatch
+
+logger = logging.getLogger('recorder')
+
+BYTES = 'bytes'
+INT16 = 'int16'
+FLOAT32 = 'float32'
+
+DTYPES = (BYTES, INT16, FLOAT32)
+
+
+class _Chunk(object):
+
+    """A chunk of int16 samples, converted to float32 when first asked."""
+
+    def __init__(self, data):
+        self.int16 = np.frombuffer(data, dtype=np.int16)
+        self._float32 = None
+
+    def get(self, dtype):
+        if dtype == FLOAT32:
+            if self._float32 is None:
+                self._float32 = self.int16.astype(np.float32)
+                self._float32 *= 1 / 32768
+            return self._float32
+        return self.int16
+
+
+class _Stage(object):
+
+    """Cuts a stage's frames out of the chunks and calls it with each one,
+    directly or through a queue of queue_size frames.
+    """
+
+    def __init__(self, processor, frame_samples, dtype, queue_size=0,
+                 policy=aiy._drivers._dispatch.DROP_OLDEST):
+        self.processor = processor
+        self.frame_samples = frame_samples
+        self.dtype = dtype
+        self.queue_size = queue_size
+        self._target = aiy._drivers._dispatch.wrap(processor, queue_size, policy)
+        self._pending = None
+
+    def feed(self, chunk):
+        samples = chunk.get(self.dtype)
+        n = self.frame_samples
+        if not n:
+            self._deliver(samples)
+            return
+
+        if self._pending is not None:
+            samples = np.concatenate((self._pending, samples))
+        count = len(samples) // n
+        for i in range(count):
+            self._deliver(samples[i * n:(i + 1) * n])
+        rest = samples[count * n:]
+        self._pending = rest.copy() if len(rest) else None
+
+    def _deliver(self, frame):
+        if self.queue_size and self.dtype != BYTES:
+            # Frames are views of the recorder's ring, which may be reused
+            # before a queued frame is processed. The queue copies byte frames.
+            frame = frame.copy()
+        if self.dtype == BYTES:
+            frame = memoryview(frame).cast('B')
+        self._target.add_data(frame)
+
+    def stop(self):
+        self._target.stop()
+
+    def get_stats(self):
+        return self._target.get_stats()
+
+
+class AudioGraph(object):
+
+    """An audio processor that passes the audio on to a set of stages.
+
+    It keeps the last history_chunks chunks it got, as views into the
+    recorder's ring, to give new stages pre-roll. That's only safe while it
+    runs on the capture thread, so it must not be added with a queue.
+    """
+
+    def __init__(self, sample_rate_hz=16000, chunk_s=0.1, history_chunks=18):
+        self.sample_rate_hz = sample_rate_hz
+        self.chunk_s = chunk_s
+        self._history = collections.deque(maxlen=history_chunks)
+
+        # Held while a chunk is passed on, so stages are added between chunks.
+        # Stages may add or remove stages from add_data, eg when a trigger
+        # fires, so it's reentrant.
+        self._lock = threading.RLock()
+        self._stages = ()
+
+    def add_stage(self, processor, frame_s=None, dtype=None, preroll_s=0,
+                  queue_size=0, policy=aiy._drivers._dispatch.DROP_OLDEST):
+        """Adds a stage.
+
+        frame_s and dtype default to the processor's FRAME_S and DTYPE. If
+        preroll_s is given, the stage first gets the last preroll_s seconds of
+        audio from before it was added. With a queue_size, the stage runs on
+        its own worker thread, behind a queue of that many frames that
+        handles a full queue by policy (see aiy._drivers._dispatch).
+        """
+        if frame_s is None:
+            frame_s = getattr(processor, 'FRAME_S', None)
+        if dtype is None:
+            dtype = getattr(processor, 'DTYPE', BYTES)
+        if dtype not in DTYPES:
+            raise ValueError('dtype must be one of: ' + ', '.join(DTYPES))
+
+        frame_samples = int(round(frame_s * self.sample_rate_hz)) if frame_s else 0
+        stage = _Stage(processor, frame_samples, dtype, queue_size, policy)
+
+        with self._lock:
+            if preroll_s > 0:
+                count = min(int(round(preroll_s / self.chunk_s)), len(self._history))
+                for data in list(self._history)[len(self._history) - count:]:
+                    stage.feed(_Chunk(data))
+            self._stages += (stage,)
+
+    def remove_stage(self, processor):
+        """Removes a stage. Returns False if it wasn't added."""
+
+        with self._lock:
+            removed = [s for s in self._stages if s.processor is processor]
+            if not removed:
+                return False
+            self._stages = tuple(s for s in self._stages if s.processor is not processor)
+        for stage in removed:
+            stage.stop()
+        return True
+
+    def record(self, data):
+        """Keeps a chunk for pre-roll without passing it to the stages."""
+        with self._lock:
+            self._history.append(data)
+
+    def clear_history(self):
+        """Forgets the chunks kept for pre-roll, eg after a gap in capture."""
+        with self._lock:
+            self._history.clear()
+
+    def add_data(self, data):
+        with self._lock:
+            self._history.append(data)
+            if not self._stages:
+                return
+
+            chunk = _Chunk(data)
+            for stage in self._stages:
+                stage.feed(chunk)
+
+    def get_stats(self):
+        """Returns a dict from each stage to its counters."""
+        stats = {}
+        for stage in self._stages:
+            stats[stage.processor] = stage.get_stats()
+            stats[stage.processor].update({
+                'frame_samples': stage.frame_samples,
+                'dtype': stage.dtype,
+                'queue_size': stage.queue_size,
+            })
+        return stats
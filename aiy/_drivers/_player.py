@@ -65,9 +65,17 @@ class Player(object):
           wav_path: path to the wav file
         """
 
-        with wave.open(wav_path, 'r') as wav:
-            if wav.getnchannels() != 1:
-                raise ValueError(wav_path + ' is not a mono file')
+        self.play_bytes(*read_wav(wav_path))
 
-            frames = wav.readframes(wav.getnframes())
-            self.play_bytes(frames, wav.getframerate(), wav.getsampwidth())
+
+def read_wav(wav_path):
+    """Returns the frames, sample rate and sample width of a mono WAV file,
+    the arguments of Player.play_bytes(), so it can be loaded once and played
+    many times.
+    """
+    with wave.open(wav_path, 'r') as wav:
+        if wav.getnchannels() != 1:
+            raise ValueError(wav_path + ' is not a mono file')
+
+        frames = wav.readframes(wav.getnframes())
+        return frames, wav.getframerate(), wav.getsampwidth()
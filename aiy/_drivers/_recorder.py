@@ -16,14 +16,25 @@
 
 import logging
 import os
-import subprocess
 import threading
+import time
 import wave
 
-import aiy._drivers._alsa
+import aiy._drivers._beamform
+import aiy._drivers._capture
+import aiy._drivers._dispatch
+import aiy._drivers._graph
+import aiy._drivers._ringbuffer
 
 logger = logging.getLogger('recorder')
 
+# Capture power modes: what the recorder does while capture isn't acquired.
+ALWAYS = 'always'  # capture and run processors all the time
+STANDBY = 'standby'  # keep the device open, but don't run processors
+ON_DEMAND = 'on-demand'  # close the device
+
+POWER_MODES = (ALWAYS, STANDBY, ON_DEMAND)
+
 
 class Recorder(threading.Thread):
 
@@ -33,16 +44,35 @@ class Recorder(threading.Thread):
     callbacks. It reads audio in a configurable format from the microphone,
     then converts it to a known format before passing it to the processors.
 
-    This driver accumulates input (audio samples) in a local buffer. Once the
-    buffer contains more than CHUNK_S seconds, it passes the chunk to all
-    processors. An audio processor defines a 'add_data' method that receives
-    the chunk of audio samples to process.
+    This driver reads input (audio samples) straight into a preallocated ring
+    of CHUNK_S second frames. Once a frame is full, it passes a memoryview of
+    it to all processors. An audio processor defines a 'add_data' method that
+    receives the chunk of audio samples to process.
     """
 
     CHUNK_S = 0.1
 
+    # Number of chunks kept in the ring. Views passed to processors stay valid
+    # for RING_CHUNKS - 1 chunks, and up to RING_CHUNKS - 2 chunks are
+    # available as pre-roll.
+    RING_CHUNKS = 20
+
+    # Delays between attempts to restart a capture source that stopped,
+    # doubling from the first to the second. A restart only counts as
+    # successful once a full chunk has been read.
+    RESTART_DELAY_S = (0.01, 5.0)
+    # While restarts keep failing, errors are logged at most this often.
+    RESTART_LOG_INTERVAL_S = 60.0
+
+    # Time from acquire_capture() to the first chunk for processors, above
+    # which a warning is logged.
+    ACTIVATION_TARGET_S = 0.25
+
     def __init__(self, input_device='default',
-                 channels=1, bytes_per_sample=2, sample_rate_hz=16000):
+                 channels=1, bytes_per_sample=2, sample_rate_hz=16000,
+                 backend='auto', period_size=None, buffer_size=None,
+                 source=None, realtime_priority=None, cpus=None, mix='beamform',
+                 power_mode=ALWAYS):
         """Create a Recorder with the given audio format.
 
         The Recorder will not start until start() is called. start() is called
@@ -52,27 +82,99 @@ class Recorder(threading.Thread):
         - channels: number of channels in audio read from the mic
         - bytes_per_sample: sample width in bytes (eg 2 for 16-bit audio)
         - sample_rate_hz: sample rate in hertz
+        - backend: 'alsa' to capture in-process with pyalsaaudio, 'arecord' to
+          read from an arecord subprocess, or 'auto' to use 'alsa' when it is
+          available and fall back to 'arecord'
+        - period_size: ALSA period size in frames (default: one chunk)
+        - buffer_size: ALSA buffer size in frames (default: four periods)
+        - source: a capture source to read instead of the backend (see
+          aiy._drivers._capture), eg to replay recorded audio
+        - realtime_priority: if given, run capture (the recording thread and
+          any arecord process) under SCHED_FIFO at this priority (1-99), so
+          that other work can't delay it long enough to overrun the buffer.
+          This needs root or CAP_SYS_NICE; without it, capture runs at normal
+          priority and a warning is logged.
+        - cpus: if given, a set of CPU numbers to pin capture to
+        - mix: how audio from more than one channel is mixed down to the mono
+          audio that processors get: 'beamform' for delay-and-sum
+          beamforming, 'best' to pick the channel with the best SNR for each
+          frame, or 'mean' (see aiy._drivers._beamform). Only 16-bit audio
+          can be mixed, and only 'mean' takes more than two channels.
+        - power_mode: ALWAYS to capture all the time, or, to save power while
+          nobody needs audio, STANDBY to keep the device open but only run
+          processors while capture is acquired (see acquire_capture()), or
+          ON_DEMAND to also close the device. STANDBY keeps pre-roll;
+          ON_DEMAND has none, and takes the device's open time to start.
         """
+        if power_mode not in POWER_MODES:
+            raise ValueError('power_mode must be one of: ' + ', '.join(POWER_MODES))
 
         super().__init__()
 
-        self._processors = []
-
-        self._chunk_bytes = int(self.CHUNK_S * sample_rate_hz) * channels * bytes_per_sample
-
-        self._cmd = [
-            'arecord',
-            '-q',
-            '-t', 'raw',
-            '-D', input_device,
-            '-c', str(channels),
-            '-f', aiy._drivers._alsa.sample_width_to_string(bytes_per_sample),
-            '-r', str(sample_rate_hz),
-        ]
-        self._arecord = None
+        self._dispatcher = aiy._drivers._dispatch.Dispatcher()
+
+        self._sample_rate_hz = sample_rate_hz
+        self._chunk_bytes = int(self.CHUNK_S * sample_rate_hz) * bytes_per_sample
+        self._ring = aiy._drivers._ringbuffer.RingBuffer(
+            self._chunk_bytes * channels, self.RING_CHUNKS)
+
+        # Multi-channel audio is mixed into a second, mono ring, which is what
+        # processors and pre-roll see.
+        self._channels = channels
+        self._mixer = None
+        self._out_ring = self._ring
+        if channels > 1:
+            if bytes_per_sample != 2:
+                raise ValueError('only 16-bit audio can be mixed down to mono')
+            if channels > 2 and mix != 'mean':
+                raise ValueError("mix must be 'mean' for more than two channels")
+            self._mixer = aiy._drivers._beamform.make_mixer(mix, sample_rate_hz)
+            self._out_ring = aiy._drivers._ringbuffer.RingBuffer(
+                self._chunk_bytes, self.RING_CHUNKS)
+
+        # Only fall back to arecord for sources made here from the backend.
+        self._backend = backend if source is None else None
+        self._source_args = (input_device, channels, bytes_per_sample, sample_rate_hz)
+        self._source_kwargs = {'period_size': period_size, 'buffer_size': buffer_size}
+        self._source = source or aiy._drivers._capture.make_source(
+            backend, *self._source_args, **self._source_kwargs)
+        self._realtime_priority = realtime_priority
+        self._cpus = cpus
+        self._realtime = False
+
+        self._first_chunk_latency_s = None
+        self._timer = aiy._drivers._ringbuffer.ChunkTimer(self.CHUNK_S)
         self._closed = False
-
-    def add_processor(self, processor):
+        self._stopped = threading.Event()
+
+        self._last_chunk_time = None
+        self._restarts = 0
+        # Backoff of the restarts since the last full chunk: the next delay,
+        # or None while capture is working, and the failed attempts so far.
+        self._restart_delay_s = None
+        self._restart_attempts = 0
+        self._restart_log_time = None
+        self._last_gap_s = None
+        self._total_gap_s = 0.0
+        self._shm_publishers = []
+
+        self._power_mode = power_mode
+        self._power_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._acquired = 0
+        self._acquire_time = None
+        self._activations = 0
+        self._last_activation_s = None
+        self._max_activation_s = 0.0
+
+        # Added up front, so that its history has pre-roll for the first
+        # stage that asks for it.
+        self._graph = aiy._drivers._graph.AudioGraph(
+            sample_rate_hz, self.CHUNK_S, self.RING_CHUNKS - 2)
+        self.add_processor(self._graph)
+
+    def add_processor(self, processor, preroll_s=0, queue_size=0,
+                      policy=aiy._drivers._dispatch.DROP_OLDEST):
         """Adds an audio processor.
 
         An audio processor is an object that has an 'add_data' method with the
@@ -85,52 +187,359 @@ class Recorder(threading.Thread):
             # processes the chunk of data here.
 
         The added processor may be called multiple times with chunks of audio data.
+        The data is a memoryview into the recorder's ring buffer; use
+        numpy.frombuffer(data, dtype=numpy.int16) to get the samples without a
+        copy. Processors that keep the data after add_data returns must copy it,
+        eg with bytes(data).
+
+        If preroll_s is given, the processor first receives the last preroll_s
+        seconds of audio recorded before it was added, so that speech which
+        started before eg a trigger isn't lost.
+
+        Processors are called on the capture thread by default, so they should
+        return quickly. If queue_size is given, the processor instead gets its
+        own worker thread fed through a queue of up to queue_size chunks, and
+        policy says what happens when that queue is full: DROP_OLDEST or
+        DROP_NEWEST discard a chunk, BLOCK makes capture wait. Queued chunks
+        are copies, so they stay valid however long they wait.
         """
-        self._processors.append(processor)
+        preroll = None
+        if preroll_s > 0:
+            count = int(round(preroll_s / self.CHUNK_S))
+            preroll = lambda end: self._out_ring.recent_frames(count, end)
+
+        self._dispatcher.add(processor, queue_size, policy, preroll)
 
     def remove_processor(self, processor):
         """Removes an added audio processor."""
 
-        try:
-            self._processors.remove(processor)
-        except ValueError:
-            logger.warn("processor was not found in the list")
+        if not self._dispatcher.remove(processor):
+            logger.warning("processor was not found in the list")
+
+    def get_graph(self):
+        """Returns the audio graph.
+
+        Stages added to the graph get audio in the frame size and sample type
+        they ask for (see aiy._drivers._graph).
+        """
+        return self._graph
+
+    def acquire_capture(self):
+        """Says that audio is needed, eg because a button is being pressed.
+
+        Outside ALWAYS mode, processors only run between acquire_capture()
+        and the matching release_capture(). Calls nest.
+        """
+        with self._power_lock:
+            self._acquired += 1
+            if self._acquired == 1:
+                if self._power_mode != ALWAYS:
+                    self._acquire_time = time.monotonic()
+                self._wake.set()
+
+    def release_capture(self):
+        """Says that audio acquired with acquire_capture() isn't needed any more."""
+        with self._power_lock:
+            if not self._acquired:
+                raise RuntimeError('release_capture() without acquire_capture()')
+            self._acquired -= 1
+
+    def _idle(self):
+        return self._power_mode != ALWAYS and not self._acquired
+
+    def _wait_until_needed(self):
+        """Waits while capture is idle in ON_DEMAND mode. Returns False if the
+        recorder was closed.
+        """
+        while True:
+            with self._power_lock:
+                if self._closed:
+                    return False
+                if self._power_mode != ON_DEMAND or self._acquired:
+                    return True
+                self._wake.clear()
+            self._wake.wait()
+
+    def publish_shared_memory(self, name, num_frames=50):
+        """Publishes the audio to other processes through shared memory.
+
+        Creates a shared memory block called name holding a ring of num_frames
+        chunks, which processes can read with
+        aiy._drivers._shm.SharedMemoryReader(name). The block is removed when
+        the recorder is closed. Returns the publisher, which reports how far
+        behind each reader is.
+        """
+        import aiy._drivers._shm
+        publisher = aiy._drivers._shm.SharedMemoryPublisher(
+            name, self._chunk_bytes, num_frames)
+        self._shm_publishers.append(publisher)
+        self.add_processor(publisher)
+        return publisher
 
     def run(self):
-        """Reads data from arecord and passes to processors."""
+        """Reads data from the capture source and passes to processors."""
+
+        self._realtime = self._set_scheduling(0)
+        if not self._wait_until_needed():
+            return
 
-        self._arecord = subprocess.Popen(self._cmd, stdout=subprocess.PIPE)
+        open_time = time.monotonic()
+        try:
+            self._open_source()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Failed to start capture')
+            if not self._source_ended():
+                return
         logger.info("started recording")
 
         # Check for race-condition when __exit__ is called at the same time as
-        # the process is started by the background thread
+        # the source is opened by the background thread
         if self._closed:
-            self._arecord.kill()
+            self._source.close()
             return
 
-        this_chunk = b''
-
+        gap_start = None
         while True:
-            input_data = self._arecord.stdout.read(self._chunk_bytes)
-            if not input_data:
-                break
+            if self._power_mode == ON_DEMAND and self._idle():
+                if not self._suspend():
+                    break
+                continue
+
+            try:
+                chunk = self._ring.read_frame(self._source)
+            except Exception:  # pylint: disable=broad-except
+                if not self._closed:
+                    logger.exception('Failed to read from the capture source')
+                chunk = None
+
+            if chunk is None:
+                if self._closed or not self._source_ended():
+                    break
+                if gap_start is None:
+                    gap_start = self._last_chunk_time
+                continue
+
+            now = time.monotonic()
+            if self._first_chunk_latency_s is None:
+                self._first_chunk_latency_s = now - open_time
+                logger.info('first chunk %.1f ms after opening the source',
+                            self._first_chunk_latency_s * 1000)
+            if gap_start is not None:
+                self._record_gap(now - gap_start)
+                self._timer.restart()
+                gap_start = None
+            if self._restart_delay_s is not None:
+                logger.info('capture restarted after %d attempt(s)', self._restart_attempts)
+                self._restart_delay_s = None
+                self._restart_attempts = 0
+                self._restart_log_time = None
+            self._last_chunk_time = now
+            self._timer.add(now)
+
+            self._handle_chunk(chunk)
+
+    def _suspend(self):
+        """Closes the device until capture is acquired again, then reopens
+        it. Returns False if the recorder was closed in the meantime.
+        """
+        # Audio from before the device is closed isn't pre-roll for what
+        # comes after it's reopened.
+        self._ring.discard_history()
+        self._out_ring.discard_history()
+        self._graph.clear_history()
 
-            this_chunk += input_data
-            if len(this_chunk) >= self._chunk_bytes:
-                self._handle_chunk(this_chunk[:self._chunk_bytes])
-                this_chunk = this_chunk[self._chunk_bytes:]
+        release = getattr(self._source, 'release', None)
+        if release:
+            release()
+        logger.info('capture idle')
 
-        if not self._closed:
-            logger.error('Microphone recorder died unexpectedly, aborting...')
-            # sys.exit doesn't work from background threads, so use os._exit as
-            # an emergency measure.
-            logging.shutdown()
-            os._exit(1)  # pylint: disable=protected-access
+        if not self._wait_until_needed():
+            return False
+
+        start = time.monotonic()
+        try:
+            self._open_source()
+        except Exception:  # pylint: disable=broad-except
+            logger.exception('Failed to reopen capture')
+            if not self._source_ended():
+                return False
+        logger.info('capture reopened in %.1f ms', (time.monotonic() - start) * 1000)
+        self._timer.restart()
+        return True
+
+    def _source_ended(self):
+        """Called when the capture source stops without being closed.
+
+        Restarts the source, retrying with exponential backoff, and returns
+        True once it is open again, or False if the recorder was closed in
+        the meantime. Processors stay attached, and just see a gap in the
+        audio. The backoff carries over until a full chunk has been read, so
+        a source that opens but ends right away, like arecord on a busy
+        device, counts as a failed attempt too.
+        """
+        self._ring.discard_partial()
+
+        if self._restart_delay_s is None:
+            self._restart_delay_s = self.RESTART_DELAY_S[0]
+        else:
+            self._restart_attempts += 1
+            self._next_restart_delay()
+        if self._should_log_restart():
+            logger.error('Microphone recorder died unexpectedly (%d failed'
+                         ' restart(s)), restarting in %.2f s',
+                         self._restart_attempts, self._restart_delay_s)
+
+        while not self._stopped.wait(self._restart_delay_s):
+            try:
+                self._open_source()
+            except Exception as e:  # pylint: disable=broad-except
+                self._restart_attempts += 1
+                self._next_restart_delay()
+                if self._should_log_restart():
+                    logger.warning('Failed to restart capture (attempt %d): %s,'
+                                   ' retrying in %.2f s', self._restart_attempts, e,
+                                   self._restart_delay_s)
+                continue
+
+            if self._closed:
+                self._source.close()
+                break
+            self._restarts += 1
+            return True
+        return False
+
+    def _next_restart_delay(self):
+        self._restart_delay_s = min(self._restart_delay_s * 2, self.RESTART_DELAY_S[1])
+
+    def _should_log_restart(self):
+        now = time.monotonic()
+        if (self._restart_log_time is not None and
+                now - self._restart_log_time < self.RESTART_LOG_INTERVAL_S):
+            return False
+        self._restart_log_time = now
+        return True
+
+    def _record_gap(self, gap_s):
+        self._last_gap_s = gap_s
+        self._total_gap_s += gap_s
+        logger.warning('audio capture resumed after a %.0f ms gap', gap_s * 1000)
+
+    def _open_source(self):
+        try:
+            self._source.open()
+        except Exception:  # pylint: disable=broad-except
+            if self._backend != 'auto' or isinstance(
+                    self._source, aiy._drivers._capture.ArecordSource):
+                raise
+            logger.exception('Failed to open ALSA capture, falling back to arecord')
+            self._source = aiy._drivers._capture.ArecordSource(
+                *self._source_args, **self._source_kwargs)
+            self._source.open()
+
+        pid = getattr(self._source, 'pid', None)
+        if pid:
+            self._set_scheduling(pid)
+
+    def _set_scheduling(self, pid):
+        """Applies the capture priority and CPU affinity to a process or, with
+        pid 0, the calling thread. Returns True if it now runs in real time.
+        """
+        if self._cpus:
+            try:
+                os.sched_setaffinity(pid, self._cpus)
+            except (AttributeError, OSError) as e:
+                logger.warning('Could not pin capture to CPUs %s: %s',
+                               sorted(self._cpus), e)
+
+        if not self._realtime_priority:
+            return False
+        try:
+            os.sched_setscheduler(pid, os.SCHED_FIFO,
+                                  os.sched_param(self._realtime_priority))
+        except (AttributeError, OSError) as e:
+            logger.warning('Could not give capture real-time priority, running'
+                           ' at normal priority: %s', e)
+            return False
+        logger.info('capturing at SCHED_FIFO priority %d', self._realtime_priority)
+        return True
+
+    def get_stats(self):
+        """Returns counters for the audio read so far.
+
+        copied_bytes_per_sec is the rate at which audio is copied between
+        buffers on its way to the processors, which is zero when the capture
+        source supports readinto(). restarts counts how often the capture source
+        was restarted after it stopped, and last_gap_s and total_gap_s are how
+        much audio those restarts lost, measured from the last chunk before each
+        failure to the first one after it.
+
+        realtime says whether capture got its real-time priority. overruns is
+        the number of capture buffer overruns reported by the ALSA backend
+        (arecord doesn't report them). The interval_* entries and late_chunks
+        describe the jitter in when chunks arrived, and deficit_s estimates the
+        audio lost since the last restart (see ChunkTimer).
+
+        Outside ALWAYS mode, activations counts the times capture was acquired,
+        and last_activation_s and max_activation_s how long it took from
+        acquire_capture() to the first chunk for processors.
+        """
+        stats = self._timer.get_stats()
+        stats.update({
+            'bytes_read': self._ring.bytes_read,
+            'chunks': self._ring.frames_written,
+            'bytes_copied': self._ring.bytes_copied.total,
+            'copied_bytes_per_sec': self._ring.bytes_copied.rate(),
+            'first_chunk_latency_s': self._first_chunk_latency_s,
+            'restarts': self._restarts,
+            'last_gap_s': self._last_gap_s,
+            'total_gap_s': self._total_gap_s,
+            'realtime': self._realtime,
+            'overruns': getattr(self._source, 'overruns', None),
+            'power_mode': self._power_mode,
+            'activations': self._activations,
+            'last_activation_s': self._last_activation_s,
+            'max_activation_s': self._max_activation_s,
+        })
+        return stats
+
+    def get_processor_stats(self):
+        """Returns a dict from each processor to its counters.
+
+        All processors report the number of chunks handled, errors raised and
+        time spent in add_data. Queued processors also report the chunks
+        dropped, the current and maximum queue lag in chunks, and the time
+        capture spent blocked on them.
+        """
+        return self._dispatcher.get_stats()
 
     def _handle_chunk(self, chunk):
         """Send audio chunk to all processors."""
-        for p in self._processors:
-            p.add_data(chunk)
+        if self._mixer:
+            samples = self._ring.frame_samples(chunk).reshape(-1, self._channels)
+            self._mixer.process(samples, self._out_ring.frame_samples(
+                self._out_ring.claim_frame()))
+            chunk = self._out_ring.commit_frame()
+
+        if self._idle():
+            # Standby: keep the chunk for pre-roll, but don't run processors.
+            self._dispatcher.skip()
+            self._graph.record(chunk)
+            return
+
+        if self._acquire_time is not None:
+            self._record_activation(time.monotonic() - self._acquire_time)
+        self._dispatcher.dispatch(chunk)
+
+    def _record_activation(self, latency_s):
+        self._acquire_time = None
+        self._activations += 1
+        self._last_activation_s = latency_s
+        self._max_activation_s = max(self._max_activation_s, latency_s)
+        if latency_s > self.ACTIVATION_TARGET_S:
+            logger.warning('capture took %.0f ms to start, target is %.0f ms',
+                           latency_s * 1000, self.ACTIVATION_TARGET_S * 1000)
+        else:
+            logger.info('capture started in %.0f ms', latency_s * 1000)
 
     def __enter__(self):
         self.start()
@@ -138,5 +547,10 @@ class Recorder(threading.Thread):
 
     def __exit__(self, *args):
         self._closed = True
-        if self._arecord:
-            self._arecord.kill()
+        self._stopped.set()
+        self._wake.set()
+        self._source.close()
+        for publisher in self._shm_publishers:
+            self.remove_processor(publisher)
+            publisher.close()
+        self._shm_publishers = []
@@ -0,0 +1,232 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A recorder that replays audio files instead of using the microphone.
+
+This lets the audio pipeline run, and be profiled, on a machine without the
+VoiceHat:
+
+    recorder = aiy._drivers._replay.ReplayRecorder(['visitors/'], speed=4)
+    with recorder:
+        recorder.add_processor(my_processor)
+        recorder.wait()
+"""
+
+import logging
+import os
+import threading
+import time
+import wave
+
+import aiy._drivers._recorder
+
+logger = logging.getLogger('recorder')
+
+AUDIO_EXTENSIONS = ('.wav', '.raw')
+
+
+def _expand_paths(paths):
+    """Returns the audio files in paths, listing directories recursively."""
+    files = []
+    for path in paths:
+        if not os.path.isdir(path):
+            files.append(path)
+            continue
+        for root, dirs, names in os.walk(path):
+            dirs.sort()
+            files.extend(os.path.join(root, name) for name in sorted(names)
+                         if name.lower().endswith(AUDIO_EXTENSIONS))
+    return files
+
+
+class ReplaySource(object):
+
+    """A capture source that reads WAV or raw files at a steady pace.
+
+    Raw files must already be in the recorder's format. WAV files must match
+    it too; they aren't converted. Audio is released at speed times real
+    time, scheduled from when the source was opened so that pacing errors
+    don't add up. A speed of 0 replays as fast as possible. gap_s seconds of
+    silence are inserted between files, and loop starts over at the end.
+    """
+
+    def __init__(self, paths, channels=1, bytes_per_sample=2, sample_rate_hz=16000,
+                 speed=1.0, loop=False, gap_s=0.0):
+        self._files = _expand_paths(paths)
+        if not self._files:
+            raise ValueError('no audio files in %s' % ', '.join(paths))
+
+        self._format = (channels, bytes_per_sample, sample_rate_hz)
+        self.byte_rate = channels * bytes_per_sample * sample_rate_hz
+        self._frame_bytes = channels * bytes_per_sample
+        self._speed = speed
+        self._loop = loop
+        self._gap_bytes = int(gap_s * sample_rate_hz) * self._frame_bytes
+
+        self._closed = False
+        self._current = None
+        self.max_late_s = 0.0
+
+    def open(self):
+        self._next = 0
+        self._current = None
+        self._silence = 0
+        self._position = 0
+        self._start_time = time.monotonic()
+
+    def _open_next(self):
+        """Opens the next file. Returns False at the end of the list."""
+
+        if self._current:
+            self._current.close()
+            self._current = None
+            self._silence = self._gap_bytes
+
+        if self._next == len(self._files):
+            if not self._loop:
+                return False
+            self._next = 0
+
+        path = self._files[self._next]
+        self._next += 1
+        logger.info('replaying %s', path)
+
+        if path.lower().endswith('.wav'):
+            wav = wave.open(path, 'rb')
+            fmt = (wav.getnchannels(), wav.getsampwidth(), wav.getframerate())
+            if fmt != self._format:
+                wav.close()
+                raise ValueError('%s has channels, sample width and rate %r,'
+                                 ' expected %r' % (path, fmt, self._format))
+            self._current = wav
+            self._read_current = lambda size: wav.readframes(size // self._frame_bytes)
+        else:
+            raw = open(path, 'rb')
+            self._current = raw
+            self._read_current = raw.read
+        return True
+
+    def read(self, size):
+        size -= size % self._frame_bytes
+
+        while True:
+            if self._closed:
+                return b''
+
+            if self._silence:
+                count = min(size, self._silence)
+                self._silence -= count
+                data = bytes(count)
+                break
+
+            data = self._read_current(size) if self._current else b''
+            if data:
+                break
+            if not self._open_next():
+                return b''
+
+        self._position += len(data)
+        self._pace()
+        return data
+
+    def _pace(self):
+        """Waits until the audio read so far would have been recorded."""
+
+        if self._speed <= 0:
+            return
+
+        due = self._start_time + self._position / (self.byte_rate * self._speed)
+        delay = due - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            self.max_late_s = max(self.max_late_s, -delay)
+
+    def close(self):
+        self._closed = True
+
+
+class ReplayRecorder(aiy._drivers._recorder.Recorder):
+
+    """A Recorder that streams audio files instead of the microphone.
+
+    It has the same processor and context-manager API as Recorder. When the
+    files run out, it stops and wait() returns.
+    """
+
+    def __init__(self, paths, speed=1.0, loop=False, gap_s=0.0,
+                 channels=1, bytes_per_sample=2, sample_rate_hz=16000, mix='beamform'):
+        self.replay_source = ReplaySource(
+            paths, channels, bytes_per_sample, sample_rate_hz, speed, loop, gap_s)
+        super().__init__(channels=channels, bytes_per_sample=bytes_per_sample,
+                         sample_rate_hz=sample_rate_hz, source=self.replay_source,
+                         mix=mix)
+        self._replay_done = threading.Event()
+
+    def _source_ended(self):
+        logger.info('replay finished')
+        self._replay_done.set()
+        return False
+
+    def wait(self, timeout=None):
+        """Waits until all files have been replayed."""
+        return self._replay_done.wait(timeout)
+
+    def __exit__(self, *args):
+        super().__exit__(*args)
+        self._replay_done.set()
+
+
+def _main():
+    import argparse
+
+    import aiy._drivers._vad
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(
+        description='Replay audio files through the recorder and report timings')
+    parser.add_argument('paths', nargs='+', help='WAV/raw files or directories')
+    parser.add_argument('--speed', type=float, default=0,
+                        help='Times real time, or 0 for as fast as possible')
+    parser.add_argument('--vad', action='store_true',
+                        help='Run the VAD gate on the audio')
+    args = parser.parse_args()
+
+    class NullProcessor(object):
+        def add_data(self, data):
+            pass
+
+    recorder = ReplayRecorder(args.paths, speed=args.speed)
+    processor = NullProcessor()
+    if args.vad:
+        processor = aiy._drivers._vad.VadGate(processor)
+    recorder.add_processor(processor)
+
+    start = time.monotonic()
+    with recorder:
+        recorder.wait()
+    elapsed = time.monotonic() - start
+
+    stats = recorder.get_stats()
+    audio_s = stats['bytes_read'] / recorder.replay_source.byte_rate
+    print('%.1f s of audio in %.2f s (%.1fx real time), max %.1f ms late' % (
+        audio_s, elapsed, audio_s / elapsed, recorder.replay_source.max_late_s * 1000))
+    print('recorder:', stats)
+    for proc, proc_stats in recorder.get_processor_stats().items():
+        print('%s: %s' % (type(proc).__name__, proc_stats))
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,243 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""A preallocated ring of fixed-size audio frames."""
+
+import threading
+import time
+
+import numpy as np
+
+
+class RateCounter(object):
+
+    """Counts bytes and reports the rate over the last interval."""
+
+    def __init__(self, interval_s=1.0):
+        self._interval_s = interval_s
+        self._lock = threading.Lock()
+        self.total = 0
+        self._window_start = time.monotonic()
+        self._window_count = 0
+        self._rate = 0.0
+
+    def add(self, count):
+        with self._lock:
+            self.total += count
+            self._window_count += count
+            self._roll(time.monotonic())
+
+    def rate(self):
+        """Returns the count per second over the last complete interval."""
+        with self._lock:
+            self._roll(time.monotonic())
+            return self._rate
+
+    def _roll(self, now):
+        elapsed = now - self._window_start
+        if elapsed >= self._interval_s:
+            self._rate = self._window_count / elapsed
+            self._window_start = now
+            self._window_count = 0
+
+
+class ChunkTimer(object):
+
+    """Tracks when chunks of a fixed duration arrive.
+
+    Reports the mean, standard deviation and extremes of the intervals between
+    chunks, and how many arrived late (more than half a chunk after they were
+    due). deficit_s is how far the audio received has fallen behind the wall
+    clock since the first chunk, beyond the best it has been. Buffering makes
+    chunks arrive unevenly, but audio that ALSA drops never shows up, so a
+    deficit that steps up and stays up means frames were lost. It also creeps
+    by the difference between the sound card and system clocks, which is
+    usually tens of ppm.
+    """
+
+    def __init__(self, chunk_s):
+        self.chunk_s = chunk_s
+        self._lock = threading.Lock()
+        self.restart()
+        self.intervals = 0
+        self.late = 0
+        self.min_interval_s = None
+        self.max_interval_s = None
+        self._mean = 0.0
+        self._m2 = 0.0
+
+    def restart(self):
+        """Starts a new baseline, eg after a gap in capture."""
+        self._first = None
+        self._last = None
+        self._count = 0
+        self._min_lag = 0.0
+        self.deficit_s = 0.0
+
+    def add(self, now):
+        with self._lock:
+            if self._last is not None:
+                self._add_interval(now - self._last)
+            else:
+                self._first = now
+            self._last = now
+
+            # How far the wall clock is ahead of the audio received.
+            lag = (now - self._first) - self._count * self.chunk_s
+            self._count += 1
+            self._min_lag = min(self._min_lag, lag)
+            self.deficit_s = lag - self._min_lag
+
+    def _add_interval(self, interval):
+        # Welford's algorithm, so the variance is accurate without keeping
+        # every interval.
+        self.intervals += 1
+        delta = interval - self._mean
+        self._mean += delta / self.intervals
+        self._m2 += delta * (interval - self._mean)
+
+        if self.min_interval_s is None or interval < self.min_interval_s:
+            self.min_interval_s = interval
+        if self.max_interval_s is None or interval > self.max_interval_s:
+            self.max_interval_s = interval
+        if interval > 1.5 * self.chunk_s:
+            self.late += 1
+
+    def get_stats(self):
+        with self._lock:
+            stdev = (self._m2 / self.intervals) ** 0.5 if self.intervals else None
+            return {
+                'interval_mean_s': self._mean if self.intervals else None,
+                'interval_stdev_s': stdev,
+                'interval_min_s': self.min_interval_s,
+                'interval_max_s': self.max_interval_s,
+                'late_chunks': self.late,
+                'deficit_s': self.deficit_s,
+            }
+
+
+class RingBuffer(object):
+
+    """A ring of fixed-size frames that is filled directly by readinto().
+
+    Completed frames are handed out as memoryviews into the ring, so no audio
+    is copied between reading it from the source and passing it on. A view
+    stays valid until the ring wraps around, which is num_frames - 1 frames
+    later. Consumers that keep audio for longer must copy it.
+
+    frame_samples() returns a NumPy int16 view of a frame, which is also a
+    view and not a copy.
+    """
+
+    def __init__(self, frame_bytes, num_frames):
+        if num_frames < 2:
+            raise ValueError('a ring needs at least two frames')
+
+        self.frame_bytes = frame_bytes
+        self.num_frames = num_frames
+
+        self._buf = bytearray(frame_bytes * num_frames)
+        self._view = memoryview(self._buf)
+
+        # Number of frames completed since creation; the frame being filled is
+        # at index self.frames_written % self.num_frames.
+        self.frames_written = 0
+        self._fill = 0
+
+        # Frames before this one are left out of recent_frames().
+        self._history_start = 0
+
+        self.bytes_read = 0
+        self.bytes_copied = RateCounter()
+
+    def _frame_view(self, seq):
+        start = (seq % self.num_frames) * self.frame_bytes
+        return self._view[start:start + self.frame_bytes]
+
+    @staticmethod
+    def frame_samples(frame):
+        """Returns an int16 NumPy view of a frame returned by read_frame()."""
+        return np.frombuffer(frame, dtype=np.int16)
+
+    def read_frame(self, reader):
+        """Reads from reader until the current frame is full.
+
+        Returns a memoryview of the completed frame, or None if the reader hit
+        end-of-file first. A partial frame is kept and completed by the next
+        call.
+
+        reader should provide readinto(), which lets the source write straight
+        into the ring. Readers that only provide read() are supported, but the
+        audio is then copied into the ring and counted in bytes_copied.
+        """
+        frame = self._frame_view(self.frames_written)
+        readinto = getattr(reader, 'readinto', None)
+
+        while self._fill < self.frame_bytes:
+            dest = frame[self._fill:]
+            if readinto:
+                count = readinto(dest) or 0
+            else:
+                data = reader.read(len(dest))
+                count = len(data)
+                dest[:count] = data
+                self.bytes_copied.add(count)
+
+            if not count:
+                return None
+
+            self._fill += count
+            self.bytes_read += count
+
+        self._fill = 0
+        self.frames_written += 1
+        return frame
+
+    def claim_frame(self):
+        """Returns a view of the next frame, for the caller to fill in full.
+        Call commit_frame() once it is filled.
+        """
+        return self._frame_view(self.frames_written)
+
+    def commit_frame(self):
+        """Completes the frame returned by claim_frame() and returns it."""
+        frame = self._frame_view(self.frames_written)
+        self.bytes_read += self.frame_bytes
+        self.frames_written += 1
+        return frame
+
+    def discard_partial(self):
+        """Drops the partly filled frame, eg after the source was restarted,
+        so that audio from before and after a gap isn't spliced into one frame.
+        """
+        self._fill = 0
+
+    def discard_history(self):
+        """Drops the partly filled frame, and leaves the frames before it out
+        of recent_frames(), eg when capture resumes after being stopped.
+        """
+        self._fill = 0
+        self._history_start = self.frames_written
+
+    def recent_frames(self, count, end=None):
+        """Returns views of up to count completed frames before frame number
+        end (default: all completed frames), oldest first.
+        """
+        if end is None:
+            end = self.frames_written
+        # Leave out the frame being filled, and the one after it in case end
+        # lags frames_written by one.
+        oldest = max(self._history_start, self.frames_written - (self.num_frames - 2))
+        first = max(end - count, oldest)
+        return [self._frame_view(seq) for seq in range(first, end)]
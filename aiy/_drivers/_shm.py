@@ -0,0 +1,260 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Shares recorded audio with other processes through shared memory.
+
+The publisher is a Recorder processor that copies each chunk into a ring of
+slots in a named shared memory block. Readers in other processes attach to
+the block by name and get memoryviews of the slots, so each consumer can run
+on its own core without copying the audio again.
+
+Layout of the block:
+    header: magic, version, max readers, frame bytes, slot count, and the
+            number of frames published so far
+    reader cursors: for each reader id, 1 + the next frame it will read, or
+            0 if unused
+    slots: each is the sequence number of the frame it holds, then the frame
+
+A slot's sequence number is invalidated while it's being written, so a reader
+that has fallen a full ring behind sees the mismatch instead of torn audio.
+"""
+
+import logging
+import struct
+import time
+
+from multiprocessing import shared_memory
+
+logger = logging.getLogger('recorder')
+
+MAGIC = b'AIYA'
+VERSION = 1
+MAX_READERS = 8
+
+_HEADER = struct.Struct('<4sHHIIQ')
+_SEQ = struct.Struct('<Q')
+_CURSORS_OFFSET = _HEADER.size
+_SLOTS_OFFSET = 128
+_INVALID = 2 ** 64 - 1
+
+# Index of the published-frames counter in _HEADER.
+_PUBLISHED_OFFSET = _HEADER.size - _SEQ.size
+
+
+class SharedMemoryPublisher(object):
+
+    """An audio processor that publishes chunks to a shared memory ring."""
+
+    # How often, in frames, to check reader cursors for slow readers.
+    LAG_CHECK_FRAMES = 10
+
+    def __init__(self, name, frame_bytes, num_frames=50):
+        self.name = name
+        self.frame_bytes = frame_bytes
+        self.num_frames = num_frames
+        self._slot_bytes = _SEQ.size + frame_bytes
+
+        self._shm = shared_memory.SharedMemory(
+            name=name, create=True, size=_SLOTS_OFFSET + num_frames * self._slot_bytes)
+        self._buf = self._shm.buf
+        self._buf[:_SLOTS_OFFSET] = bytes(_SLOTS_OFFSET)
+        for slot in range(num_frames):
+            _SEQ.pack_into(self._buf, self._slot_offset(slot), _INVALID)
+        _HEADER.pack_into(self._buf, 0, MAGIC, VERSION, MAX_READERS,
+                          frame_bytes, num_frames, 0)
+
+        self.published = 0
+        self._slow_readers = set()
+
+    def _slot_offset(self, slot):
+        return _SLOTS_OFFSET + slot * self._slot_bytes
+
+    def add_data(self, data):
+        if len(data) != self.frame_bytes:
+            raise ValueError('expected %d bytes, got %d' % (self.frame_bytes, len(data)))
+
+        seq = self.published
+        offset = self._slot_offset(seq % self.num_frames)
+        _SEQ.pack_into(self._buf, offset, _INVALID)
+        self._buf[offset + _SEQ.size:offset + self._slot_bytes] = data
+        _SEQ.pack_into(self._buf, offset, seq)
+
+        self.published = seq + 1
+        _SEQ.pack_into(self._buf, _PUBLISHED_OFFSET, self.published)
+
+        if self.published % self.LAG_CHECK_FRAMES == 0:
+            self._check_readers()
+
+    def get_reader_lags(self):
+        """Returns a dict from reader id to how many frames it is behind."""
+        lags = {}
+        for reader_id in range(MAX_READERS):
+            cursor, = _SEQ.unpack_from(self._buf, _CURSORS_OFFSET + reader_id * _SEQ.size)
+            if cursor:
+                lags[reader_id] = self.published - (cursor - 1)
+        return lags
+
+    def _check_readers(self):
+        for reader_id, lag in self.get_reader_lags().items():
+            slow = lag > self.num_frames // 2
+            if slow and reader_id not in self._slow_readers:
+                logger.warning('shared memory reader %d is %d frames behind',
+                               reader_id, lag)
+                self._slow_readers.add(reader_id)
+            elif not slow:
+                self._slow_readers.discard(reader_id)
+
+    def close(self):
+        """Removes the shared memory block."""
+        self._buf = None
+        self._shm.close()
+        self._shm.unlink()
+
+
+class SharedMemoryReader(object):
+
+    """Reads frames published by a SharedMemoryPublisher in another process.
+
+    read() returns (seq, frame), where frame is a memoryview of the slot in
+    shared memory. It stays valid until the publisher wraps around; call
+    is_valid(seq) after processing it to find out whether it was overwritten
+    in the meantime.
+
+    A reader that falls more than a ring behind skips ahead to the oldest
+    frame still available, and counts the frames it missed in dropped. Give
+    a reader_id (0 to MAX_READERS - 1) to let the publisher track its lag.
+    """
+
+    def __init__(self, name, reader_id=None, poll_interval_s=0.005):
+        self._shm = _attach(name)
+        self._buf = self._shm.buf
+        magic, version, max_readers, self.frame_bytes, self.num_frames, published = (
+            _HEADER.unpack_from(self._buf, 0))
+        if magic != MAGIC or version != VERSION:
+            raise ValueError('%s is not an audio ring (version %d)' % (name, VERSION))
+
+        if reader_id is not None and not 0 <= reader_id < max_readers:
+            raise ValueError('reader_id must be between 0 and %d' % (max_readers - 1))
+
+        self._slot_bytes = _SEQ.size + self.frame_bytes
+        self._reader_id = reader_id
+        self._poll_interval_s = poll_interval_s
+
+        # Start with the next frame to be published.
+        self.next = published
+        self.dropped = 0
+        self._update_cursor()
+
+    def _published(self):
+        return _SEQ.unpack_from(self._buf, _PUBLISHED_OFFSET)[0]
+
+    def _slot_offset(self, seq):
+        return _SLOTS_OFFSET + (seq % self.num_frames) * self._slot_bytes
+
+    def _update_cursor(self):
+        if self._reader_id is not None:
+            _SEQ.pack_into(self._buf, _CURSORS_OFFSET + self._reader_id * _SEQ.size,
+                           self.next + 1)
+
+    @property
+    def lag(self):
+        """Number of published frames not read yet."""
+        return self._published() - self.next
+
+    def read(self, timeout=None):
+        """Waits for the next frame. Returns (seq, frame), or None on timeout."""
+
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            published = self._published()
+            if self.next < published:
+                # Frames older than this may already be overwritten.
+                oldest = published - self.num_frames + 1
+                if self.next < oldest:
+                    self.dropped += oldest - self.next
+                    self.next = oldest
+
+                seq = self.next
+                if self.is_valid(seq):
+                    self.next += 1
+                    self._update_cursor()
+                    offset = self._slot_offset(seq) + _SEQ.size
+                    return seq, self._buf[offset:offset + self.frame_bytes]
+
+                # Overwritten while we looked; skip to what's there now.
+                self.dropped += 1
+                self.next += 1
+                continue
+
+            if deadline is not None and time.monotonic() >= deadline:
+                return None
+            time.sleep(self._poll_interval_s)
+
+    def is_valid(self, seq):
+        """Returns True if the slot still holds frame seq."""
+        return _SEQ.unpack_from(self._buf, self._slot_offset(seq))[0] == seq
+
+    def close(self):
+        """Detaches from the block. Frames returned by read() must be released
+        first.
+        """
+        if self._reader_id is not None:
+            _SEQ.pack_into(self._buf, _CURSORS_OFFSET + self._reader_id * _SEQ.size, 0)
+        self._buf = None
+        self._shm.close()
+
+
+def _attach(name):
+    """Attaches to an existing block without taking ownership of it."""
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Before Python 3.13 the resource tracker would unlink the block when
+        # this process exits, so unregister it by hand.
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')  # pylint: disable=protected-access
+        return shm
+
+
+def _main():
+    import argparse
+
+    import numpy as np
+
+    parser = argparse.ArgumentParser(description='Print levels of shared audio')
+    parser.add_argument('name', help='Name of the shared memory block')
+    parser.add_argument('--reader-id', type=int, help='Report lag to the publisher')
+    args = parser.parse_args()
+
+    reader = SharedMemoryReader(args.name, args.reader_id)
+    frame = samples = None
+    try:
+        while True:
+            seq, frame = reader.read()
+            samples = np.frombuffer(frame, dtype=np.int16)
+            level = int(np.abs(samples).max())
+            if reader.is_valid(seq):
+                print('frame %d: peak %5d, lag %d, dropped %d' % (
+                    seq, level, reader.lag, reader.dropped))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # The block can't be closed while views of it are still around.
+        frame = samples = None
+        reader.close()
+
+
+if __name__ == '__main__':
+    _main()
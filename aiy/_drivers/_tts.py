@@ -14,11 +14,16 @@
 
 """Wrapper around a TTS system."""
 
+import collections
 import functools
+import http.client
 import logging
 import os
 import subprocess
 import tempfile
+import threading
+import time
+import urllib.parse
 
 import aiy.i18n
 
@@ -35,17 +40,101 @@ def create_say(player):
     return functools.partial(say, player, lang=lang)
 
 
+class _CloudTts(object):
+
+    """Fetches speech from Google Translate's TTS endpoint.
+
+    Requests share one kept-alive HTTPS connection, and the MP3s of the last
+    CACHE_SIZE phrases are kept, so repeated prompts play right away.
+    """
+
+    HOST = 'translate.google.com'
+    CACHE_SIZE = 32
+    # Servers close idle connections; reconnect ahead of use after this long.
+    IDLE_S = 60
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conn = None
+        self._last_use = 0
+        self._cache = collections.OrderedDict()
+
+    def connect(self):
+        """Opens the connection now, if it isn't open or has been idle."""
+        with self._lock:
+            if self._conn and time.monotonic() - self._last_use > self.IDLE_S:
+                self._close()
+            self._connect()
+
+    def fetch(self, words, lang):
+        """Returns the MP3 audio of words."""
+        key = (words, lang)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+            path = '/translate_tts?' + urllib.parse.urlencode(
+                {'ie': 'UTF-8', 'client': 'tw-ob', 'q': words, 'tl': lang})
+            for retry in (True, False):
+                try:
+                    self._connect()
+                    self._conn.request('GET', path, headers={'User-Agent': 'Mozilla'})
+                    response = self._conn.getresponse()
+                    audio = response.read()
+                    break
+                except (http.client.HTTPException, OSError):
+                    # The server may have closed the kept-alive connection.
+                    self._close()
+                    if not retry:
+                        raise
+            self._last_use = time.monotonic()
+            if response.status != 200:
+                raise IOError('TTS request failed with HTTP %d' % response.status)
+
+            self._cache[key] = audio
+            if len(self._cache) > self.CACHE_SIZE:
+                self._cache.popitem(last=False)
+            return audio
+
+    def _connect(self):
+        if not self._conn:
+            self._conn = http.client.HTTPSConnection(self.HOST, timeout=10)
+            self._conn.connect()
+            self._last_use = time.monotonic()
+
+    def _close(self):
+        if self._conn:
+            self._conn.close()
+            self._conn = None
+
+
+_cloud_tts = _CloudTts()
+
+
+def prewarm(phrases=(), lang='en-US'):
+    """Opens the TTS connection, and fetches the audio of phrases that are
+    likely to be said soon, so saying them doesn't wait on the network.
+    """
+    try:
+        _cloud_tts.connect()
+        for words in phrases:
+            _cloud_tts.fetch(words, lang)
+    except (http.client.HTTPException, OSError):
+        logger.warning('could not prewarm TTS', exc_info=True)
+
+
 def cloud_say(player, msg, lang='en-US'):
     ''' Send the text to Google Cloud Translate, get the audio back and
     play the mp3 using sox play '''
-    gtrans = 'http://translate.google.com/translate_tts'
-    uri = gtrans + '?ie=UTF-8&client=tw-ob&q=%s&tl=%s'%(msg, lang)
-    p1 = subprocess.Popen(['wget', '-q', '-U', 'Mozilla', '-O', '-', uri],
-                          stdout=subprocess.PIPE)
-    p2 = subprocess.Popen(['play', '-t', 'mp3', '-'], stdin=p1.stdout,
-                          stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
-    p1.stdout.close()
-    output = p2.communicate()[0]
+    try:
+        audio = _cloud_tts.fetch(msg, lang)
+    except (http.client.HTTPException, OSError):
+        logger.exception('TTS request failed')
+        return
+    play = subprocess.Popen(['play', '-t', 'mp3', '-'], stdin=subprocess.PIPE,
+                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    play.communicate(audio)
 
 
 def say(player, words, lang='en-US'):
@@ -0,0 +1,270 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Voice activity detection on recorded audio."""
+
+import collections
+import logging
+
+import numpy as np
+
+logger = logging.getLogger('vad')
+
+
+class Vad(object):
+
+    """Classifies short frames of 16-bit mono audio as speech or not.
+
+    Each chunk is split into frames of frame_s seconds, and all frames of a
+    chunk are analysed at once. A frame is speech if its energy is snr_db
+    above the tracked noise floor and its spectrum in the speech band is less
+    flat than noise usually is. The noise floor follows quiet frames quickly
+    and rises slowly, so it adapts to traffic without tracking speech.
+    """
+
+    def __init__(self, sample_rate_hz=16000, frame_s=0.02, snr_db=9.0,
+                 max_flatness=0.5, min_speech_frames=2):
+        self.sample_rate_hz = sample_rate_hz
+        self.frame_len = int(sample_rate_hz * frame_s)
+        self.snr_db = snr_db
+        self.max_flatness = max_flatness
+        self.min_speech_frames = min_speech_frames
+
+        self._window = np.hanning(self.frame_len).astype(np.float32)
+        freqs = np.fft.rfftfreq(self.frame_len, 1.0 / sample_rate_hz)
+        self._band = (freqs >= 300) & (freqs <= 4000)
+
+        self.reset()
+
+    def reset(self):
+        """Forgets the noise floor and the current speech run."""
+        self.noise_db = None
+        self._run = 0
+
+    def frame_features(self, frames):
+        """Returns (energy_db, flatness) arrays for a (n, frame_len) array."""
+
+        frames = frames.astype(np.float32)
+        energy_db = 10 * np.log10(np.mean(frames * frames, axis=1) + 1.0)
+
+        power = np.abs(np.fft.rfft(frames * self._window, axis=1)[:, self._band]) ** 2
+        power += 1e-3
+        flatness = np.exp(np.mean(np.log(power), axis=1)) / np.mean(power, axis=1)
+
+        return energy_db, flatness
+
+    def classify(self, samples):
+        """Returns a bool array with one entry per complete frame in samples."""
+
+        count = len(samples) // self.frame_len
+        if not count:
+            return np.zeros(0, dtype=bool)
+
+        frames = samples[:count * self.frame_len].reshape(count, self.frame_len)
+        energy_db, flatness = self.frame_features(frames)
+
+        if self.noise_db is None:
+            self.noise_db = float(np.min(energy_db))
+
+        loud = (energy_db > self.noise_db + self.snr_db) & (flatness < self.max_flatness)
+
+        # The noise floor and the onset counter carry state from frame to
+        # frame, so this part runs per frame on scalars.
+        speech = np.zeros(count, dtype=bool)
+        for i in range(count):
+            if loud[i]:
+                self._run += 1
+            else:
+                self._run = 0
+                if energy_db[i] < self.noise_db:
+                    self.noise_db = float(energy_db[i])
+                else:
+                    self.noise_db += 0.05 * (energy_db[i] - self.noise_db)
+            speech[i] = self._run >= self.min_speech_frames
+
+        return speech
+
+
+class VadGate(object):
+
+    """An audio processor that only passes speech on to another processor.
+
+    Frames are forwarded from lookback_s before speech is detected until
+    hangover_s after it stops, so word onsets and short pauses are kept.
+    Everything else is dropped. The gate fails open: if no speech is detected
+    within max_wait_s, or the gate stays closed for max_gap_s after speech,
+    all further audio is forwarded so the server can still endpoint.
+    """
+
+    def __init__(self, target, vad=None, lookback_s=0.2, hangover_s=0.6,
+                 max_wait_s=5.0, max_gap_s=2.0, bytes_per_sample=2):
+        self._target = target
+        self._vad = vad or Vad()
+        self._bytes_per_sample = bytes_per_sample
+        self._frame_bytes = self._vad.frame_len * bytes_per_sample
+
+        rate = self._vad.sample_rate_hz
+        frame_s = self._vad.frame_len / rate
+        self._lookback_bytes = int(lookback_s * rate) * bytes_per_sample
+        self._hangover_frames = int(round(hangover_s / frame_s))
+        self._max_wait_frames = int(round(max_wait_s / frame_s))
+        self._max_gap_frames = int(round(max_gap_s / frame_s))
+
+        self.bytes_in = 0
+        self.bytes_forwarded = 0
+        self.reset()
+
+    def reset(self):
+        """Starts a new session."""
+        self._vad.reset()
+        self._lookback = collections.deque()
+        self._lookback_len = 0
+        self._hangover = 0
+        self._closed_frames = 0
+        self._heard_speech = False
+        self._open = False
+        self._last_speech = False
+
+    def get_stats(self):
+        return {
+            'bytes_in': self.bytes_in,
+            'bytes_forwarded': self.bytes_forwarded,
+        }
+
+    def add_data(self, data):
+        data = memoryview(data).cast('B')
+        self.bytes_in += len(data)
+
+        if self._open:
+            self._forward(data)
+            return
+
+        samples = np.frombuffer(data, dtype=np.int16)
+        speech = self._vad.classify(samples)
+
+        # A trailing partial frame goes with the last full frame.
+        frame_bytes = self._frame_bytes
+        frames = max(len(speech), 1)
+        run_start = None
+        for i in range(frames):
+            start = i * frame_bytes
+            end = len(data) if i == frames - 1 else start + frame_bytes
+            is_speech = speech[i] if len(speech) else self._last_speech
+
+            passes = self._passes(is_speech)
+            if self._open:
+                # Failed open; forward the rest of the chunk as is.
+                self._forward(data[start:])
+                return
+
+            if passes:
+                if run_start is None:
+                    run_start = start
+                    self._flush_lookback()
+            else:
+                if run_start is not None:
+                    self._forward(data[run_start:start])
+                    run_start = None
+                self._keep_lookback(data[start:end])
+
+        if run_start is not None:
+            self._forward(data[run_start:])
+
+        if len(speech):
+            self._last_speech = bool(speech[-1])
+
+    def _passes(self, is_speech):
+        """Updates the gate state for a frame; returns True to forward it."""
+
+        if is_speech:
+            self._heard_speech = True
+            self._hangover = self._hangover_frames
+            self._closed_frames = 0
+            return True
+
+        if self._hangover:
+            self._hangover -= 1
+            return True
+
+        self._closed_frames += 1
+        limit = self._max_gap_frames if self._heard_speech else self._max_wait_frames
+        if self._closed_frames >= limit:
+            logger.info('no speech for %d frames, forwarding all audio',
+                        self._closed_frames)
+            self._open = True
+            self._flush_lookback()
+        return False
+
+    def _keep_lookback(self, data):
+        self._lookback.append(bytes(data))
+        self._lookback_len += len(data)
+        while (self._lookback and
+               self._lookback_len - len(self._lookback[0]) >= self._lookback_bytes):
+            self._lookback_len -= len(self._lookback.popleft())
+
+    def _flush_lookback(self):
+        while self._lookback:
+            self._forward(self._lookback.popleft())
+        self._lookback_len = 0
+
+    def _forward(self, data):
+        if len(data):
+            self.bytes_forwarded += len(data)
+            self._target.add_data(data)
+
+
+class Endpointer(object):
+
+    """An audio processor that detects the end of an utterance.
+
+    Audio is passed through to target unchanged. Once at least min_speech_s of
+    speech has been heard, followed by silence_s of non-speech, callback is
+    called once. reset() arms it again for the next utterance.
+    """
+
+    def __init__(self, target, callback, vad=None, silence_s=0.7,
+                 min_speech_s=0.2):
+        self._target = target
+        self._callback = callback
+        self._vad = vad or Vad()
+
+        frame_s = self._vad.frame_len / self._vad.sample_rate_hz
+        self._silence_frames = int(round(silence_s / frame_s))
+        self._min_speech_frames = int(round(min_speech_s / frame_s))
+        self.reset()
+
+    def reset(self):
+        self._vad.reset()
+        self._speech_frames = 0
+        self._silent_frames = 0
+        self._fired = False
+
+    def add_data(self, data):
+        self._target.add_data(data)
+        if self._fired:
+            return
+
+        speech = self._vad.classify(np.frombuffer(data, dtype=np.int16))
+        for is_speech in speech:
+            if is_speech:
+                self._speech_frames += 1
+                self._silent_frames = 0
+            elif self._speech_frames >= self._min_speech_frames:
+                self._silent_frames += 1
+
+        if self._silent_frames >= self._silence_frames:
+            logger.info('end of utterance after %d speech frames',
+                        self._speech_frames)
+            self._fired = True
+            self._callback()
@@ -15,10 +15,12 @@
 
 """Auth helpers for Google Assistant API."""
 
+import datetime
 import json
 import logging
 import os
 import os.path
+import tempfile
 import sys
 
 import google_auth_oauthlib.flow
@@ -54,15 +56,82 @@ def _load_credentials(credentials_path):
             del credentials_data['access_token']
             credentials_data['scopes'] = [_ASSISTANT_OAUTH_SCOPE]
     if migrate:
-        with open(credentials_path, 'w') as f:
-            json.dump(credentials_data, f)
-    credentials = google.oauth2.credentials.Credentials(token=None,
-                                                        **credentials_data)
-    http_request = google.auth.transport.requests.Request()
-    credentials.refresh(http_request)
+        _write_private_json(credentials_path, credentials_data)
+    credentials = _CachedCredentials(token=None, **credentials_data)
+    # Reuse the access token from the last run while it's valid. Otherwise
+    # it's refreshed when first needed, which the speech requests do in the
+    # background.
+    credentials.token_path = _token_path(credentials_path)
+    credentials.load_token()
     return credentials
 
 
+class _CachedCredentials(google.oauth2.credentials.Credentials):
+
+    """OAuth credentials that save each new access token to token_path, so
+    the next process can start without refreshing it."""
+
+    token_path = None
+
+    def refresh(self, request):
+        super().refresh(request)
+        if self.token_path:
+            _save_token(self.token_path, self)
+
+    def load_token(self):
+        """Sets the saved access token, if it's still valid. Returns whether
+        it was."""
+        try:
+            with open(self.token_path, 'r') as f:
+                token_data = json.load(f)
+            if token_data['client_id'] != self.client_id:
+                return False
+            self.token = token_data['token']
+            self.expiry = datetime.datetime.strptime(token_data['expiry'], _EXPIRY_FORMAT)
+        except (OSError, ValueError, KeyError):
+            return False
+        if not self.valid:
+            self.token = None
+            self.expiry = None
+            return False
+        logging.info('Reusing the access token in %s', self.token_path)
+        return True
+
+
+_EXPIRY_FORMAT = '%Y-%m-%dT%H:%M:%S'
+
+
+def _token_path(credentials_path):
+    """Returns where to keep the access token for the given credentials."""
+    return os.path.splitext(credentials_path)[0] + '_token.json'
+
+
+def _save_token(token_path, credentials):
+    try:
+        _write_private_json(token_path, {
+            'token': credentials.token,
+            'expiry': credentials.expiry.strftime(_EXPIRY_FORMAT),
+            'client_id': credentials.client_id,
+        })
+    except OSError:
+        logging.warning('Could not save the access token to %s', token_path,
+                        exc_info=True)
+
+
+def _write_private_json(path, data):
+    """Replaces the file at path with data, readable only by this user."""
+    # mkstemp() creates a new file, readable only by this user, so writers
+    # don't share a temporary file.
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+
 def _credentials_flow_interactive(client_secrets_path):
     flow = google_auth_oauthlib.flow.InstalledAppFlow.from_client_secrets_file(
         client_secrets_path,
@@ -78,14 +147,15 @@ def _save_credentials(credentials_path, credentials):
     config_path = os.path.dirname(credentials_path)
     if not os.path.isdir(config_path):
         os.makedirs(config_path)
-    with open(credentials_path, 'w') as f:
-        json.dump({
-            'refresh_token': credentials.refresh_token,
-            'token_uri': credentials.token_uri,
-            'client_id': credentials.client_id,
-            'client_secret': credentials.client_secret,
-            'scopes': credentials.scopes
-        }, f)
+    _write_private_json(credentials_path, {
+        'refresh_token': credentials.refresh_token,
+        'token_uri': credentials.token_uri,
+        'client_id': credentials.client_id,
+        'client_secret': credentials.client_secret,
+        'scopes': credentials.scopes
+    })
+    if credentials.token and credentials.expiry:
+        _save_token(_token_path(credentials_path), credentials)
 
 
 def _try_to_get_credentials(client_secrets):
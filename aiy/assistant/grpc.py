@@ -47,12 +47,12 @@ class _AssistantRecognizer(object):
         """
         self._request.reset()
         self._request.set_endpointer_cb(self._endpointer_callback)
-        self._recorder.add_processor(self._request)
+        self._recorder.get_graph().add_stage(self._request)
         response = self._request.do_request()
         return response.transcript, response.response_audio
 
     def _endpointer_callback(self):
-        self._recorder.remove_processor(self._request)
+        self._recorder.get_graph().remove_stage(self._request)
 
 
 def get_assistant():
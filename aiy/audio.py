@@ -26,6 +26,7 @@ AUDIO_SAMPLE_RATE_HZ = 16000
 
 # Global variables. They are lazily initialized.
 _voicehat_recorder = None
+_recorder_options = {}
 _voicehat_player = None
 _status_ui = None
 
@@ -44,9 +45,10 @@ class _WaveDump(object):
     def add_data(self, data):
         max_bytes = self._bytes_limit - self._bytes
         data = data[:max_bytes]
-        self._bytes += len(data)
         if data:
             self._wave.writeframes(data)
+        # Counted once written, so the file can be closed when is_done().
+        self._bytes += len(data)
 
     def is_done(self):
         return self._bytes >= self._bytes_limit
@@ -71,6 +73,19 @@ def get_player():
     return _voicehat_player
 
 
+def set_recorder_options(**options):
+    """Sets keyword arguments for the Recorder created by get_recorder().
+
+    For example, to capture in-process with 20 ms ALSA periods:
+        aiy.audio.set_recorder_options(backend='alsa', period_size=320)
+
+    This has to be called before the first call to get_recorder().
+    """
+    if _voicehat_recorder is not None:
+        raise RuntimeError('the recorder has already been created')
+    _recorder_options.update(options)
+
+
 def get_recorder():
     """Returns a driver to control the VoiceHat microphones.
 
@@ -79,7 +94,7 @@ def get_recorder():
     """
     global _voicehat_recorder
     if _voicehat_recorder is None:
-        _voicehat_recorder = aiy._drivers._recorder.Recorder()
+        _voicehat_recorder = aiy._drivers._recorder.Recorder(**_recorder_options)
     return _voicehat_recorder
 
 
@@ -88,7 +103,8 @@ def record_to_wave(filepath, duration):
     recorder = get_recorder()
     dumper = _WaveDump(filepath, duration)
     with recorder, dumper:
-        recorder.add_processor(dumper)
+        # Queued, so a slow SD card doesn't hold up capture.
+        recorder.add_processor(dumper, queue_size=16)
         while not dumper.is_done():
             time.sleep(0.1)
 
@@ -119,6 +135,17 @@ def say(words, lang=None):
     aiy._drivers._tts.say(aiy.audio.get_player(), words, lang=lang)
 
 
+def prewarm_say(phrases=(), lang=None):
+    """Gets the TTS engine ready to say the given phrases without delay.
+
+    This blocks while the phrases are fetched, so call it on a thread of its
+    own to overlap it with something else.
+    """
+    if not lang:
+        lang = aiy.i18n.get_language_code()
+    aiy._drivers._tts.prewarm(phrases, lang=lang)
+
+
 def get_status_ui():
     """Returns a driver to access the StatusUI daemon.
 
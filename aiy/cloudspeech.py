@@ -43,7 +43,7 @@ class _CloudSpeechRecognizer(object):
         """
         self._request.reset()
         self._request.set_endpointer_cb(self._endpointer_callback)
-        self._recorder.add_processor(self._request)
+        self._recorder.get_graph().add_stage(self._request)
         return self._request.do_request().transcript
 
     def expect_phrase(self, phrase):
@@ -60,7 +60,7 @@ class _CloudSpeechRecognizer(object):
         self._request.add_phrase(phrase)
 
     def _endpointer_callback(self):
-        self._recorder.remove_processor(self._request)
+        self._recorder.get_graph().remove_stage(self._request)
 
 
 def get_recognizer():
@@ -16,6 +16,7 @@
 """Main recognizer loop: wait for a trigger then perform and handle
 recognition."""
 
+import collections
 import logging
 import os
 import os.path
@@ -25,6 +26,7 @@ import time
 
 import configargparse
 
+import aiy._drivers._player
 import aiy.audio
 import aiy.i18n
 import auth_helpers
@@ -68,6 +70,8 @@ ASSISTANT_CREDENTIALS = (
 LOCALE_DIR = os.path.realpath(
     os.path.join(os.path.abspath(os.path.dirname(__file__)), '../po'))
 
+TRIGGERS = ['clap', 'gpio', 'keyword', 'knock', 'ok-google']
+
 
 def try_to_get_credentials(client_secrets):
     """Try to get credentials, or print an error and quit on failure."""
@@ -120,7 +124,18 @@ def main():
         default_config_files=CONFIG_FILES,
         description="Act on voice commands using Google's speech recognition")
     parser.add_argument('-T', '--trigger', default='gpio',
-                        choices=['clap', 'gpio', 'ok-google'], help='Trigger to use')
+                        help='Trigger to use: clap, gpio, keyword, knock or'
+                        ' ok-google, or several separated by commas, like'
+                        ' gpio,knock')
+    parser.add_argument('--trigger-window', type=float, default=1.0,
+                        help='Seconds after one of several triggers fires in'
+                        ' which the others are ignored (default: 1.0)')
+    parser.add_argument('--keyword', default='doorman',
+                        help='Wake phrase for --trigger=keyword, with templates'
+                        ' in ~/.config/voice-recognizer/keywords/KEYWORD')
+    parser.add_argument('--keyword-threshold', type=float, default=0.2,
+                        help='Highest template match score that counts as the'
+                        ' keyword (default: 0.2)')
     parser.add_argument('--cloud-speech', action='store_true',
                         help='Use the Cloud Speech API instead of the Assistant API')
     parser.add_argument('-L', '--language', default='en-US',
@@ -145,8 +160,84 @@ def main():
                         'Cloud Speech API')
     parser.add_argument('--trigger-sound', default=None,
                         help='Sound when trigger is activated (WAV format)')
+    parser.add_argument('--capture-backend', default='auto',
+                        choices=['auto', 'alsa', 'arecord'],
+                        help='Read the microphone in-process with pyalsaaudio'
+                        ' (alsa) or through an arecord subprocess (default:'
+                        ' alsa if installed, else arecord)')
+    parser.add_argument('--period-size', type=int,
+                        help='ALSA capture period size in frames')
+    parser.add_argument('--buffer-size', type=int,
+                        help='ALSA capture buffer size in frames')
+    parser.add_argument('--mics', type=int, default=1, choices=[1, 2],
+                        help='Number of microphones to record from (default: 1)')
+    parser.add_argument('--mic-mix', default='beamform',
+                        choices=['beamform', 'best', 'mean'],
+                        help='How to combine two microphones: delay-and-sum'
+                        ' beamforming, the one with the best SNR, or the'
+                        ' average (default: beamform)')
+    parser.add_argument('--capture-power', default='always',
+                        choices=['always', 'standby', 'on-demand'],
+                        help='While waiting for the button, keep capturing'
+                        ' (always), keep the microphone open without'
+                        ' processing audio (standby), or close it'
+                        ' (on-demand); the last two need --trigger=gpio')
+    parser.add_argument('--gpio-backend', default='auto',
+                        choices=['auto', 'cdev', 'rpi', 'sim'],
+                        help='Read the button through the GPIO character device'
+                        ' (cdev), RPi.GPIO (rpi) or a simulated line (sim);'
+                        ' auto uses cdev if /dev/gpiochip0 exists')
+    parser.add_argument('--capture-priority', type=int, metavar='PRIO',
+                        help='Capture audio at this SCHED_FIFO real-time'
+                        ' priority (1-99; needs CAP_SYS_NICE)')
+    parser.add_argument('--capture-cpus', metavar='CPUS',
+                        help='Comma-separated CPUs to pin audio capture to')
+    parser.add_argument('--replay', action='append',
+                        help='Replay this WAV/raw file or directory instead'
+                        ' of recording from the microphone (repeatable)')
+    parser.add_argument('--replay-speed', type=float, default=1.0,
+                        help='Replay speed, as a multiple of real time')
+    parser.add_argument('--shm-audio', metavar='NAME',
+                        help='Publish recorded audio in the shared memory block'
+                        ' NAME for other processes')
+    parser.add_argument('--preroll', type=float, default=0.5,
+                        help='Seconds of audio from before the trigger to send'
+                        ' with each request (default: 0.5)')
+    parser.add_argument('--uplink-encoding', default='auto',
+                        choices=['auto', 'LINEAR16', 'FLAC'],
+                        help='Encoding of audio sent to the cloud; auto sends'
+                        ' FLAC when the network is too slow for raw audio')
+    parser.add_argument('--denoise', action='store_true',
+                        help='Remove steady background noise from the audio'
+                        ' sent to the cloud; needs --capture-power=always')
+    parser.add_argument('--agc', action='store_true',
+                        help='Bring speech sent to the cloud to a steady level')
+    parser.add_argument('--vad', action='store_true',
+                        help='Only send audio to the cloud while someone is'
+                        ' speaking')
+    parser.add_argument('--local-endpointer', default='off',
+                        choices=['off', 'shadow', 'on'],
+                        help='Detect the end of speech locally instead of'
+                        ' waiting for the server (on), or only log how it'
+                        ' compares to the server (shadow)')
+    parser.add_argument('--endpoint-silence', type=float, default=0.7,
+                        help='Seconds of silence after speech that end the'
+                        ' utterance for --local-endpointer (default: 0.7)')
 
     args = parser.parse_args()
+    args.triggers = args.trigger.split(',')
+    for trigger in args.triggers:
+        if trigger not in TRIGGERS:
+            parser.error('unknown trigger: %s (choose from %s)' % (
+                trigger, ', '.join(TRIGGERS)))
+    if 'ok-google' in args.triggers and len(args.triggers) > 1:
+        parser.error('ok-google cannot be combined with other triggers')
+    if args.capture_power != 'always' and args.triggers != ['gpio']:
+        parser.error('--capture-power=%s needs --trigger=gpio' % args.capture_power)
+    if args.capture_power != 'always' and args.denoise:
+        # The noise profile learns from the audio between requests, which it
+        # doesn't get while capture is idle.
+        parser.error('--denoise needs --capture-power=always')
 
     create_pid_file(args.pid_file)
     aiy.i18n.set_locale_dir(LOCALE_DIR)
@@ -168,18 +259,41 @@ def main():
 
     # The ok-google trigger is handled with the Assistant Library, so we need
     # to catch this case early.
-    if args.trigger == 'ok-google':
+    if args.triggers == ['ok-google']:
         if args.cloud_speech:
             print('trigger=ok-google only works with the Assistant, not with '
                   'the Cloud Speech API.')
             sys.exit(1)
         do_assistant_library(args, credentials, player, status_ui)
     else:
-        recorder = aiy.audio.get_recorder()
+        if args.replay:
+            import aiy._drivers._replay
+            recorder = aiy._drivers._replay.ReplayRecorder(
+                args.replay, speed=args.replay_speed, channels=args.mics,
+                mix=args.mic_mix)
+        else:
+            aiy.audio.set_recorder_options(channels=args.mics,
+                                           mix=args.mic_mix,
+                                           backend=args.capture_backend,
+                                           period_size=args.period_size,
+                                           buffer_size=args.buffer_size,
+                                           realtime_priority=args.capture_priority,
+                                           cpus=parse_cpus(args.capture_cpus),
+                                           power_mode=args.capture_power)
+            recorder = aiy.audio.get_recorder()
+        if args.shm_audio:
+            recorder.publish_shared_memory(args.shm_audio)
         with recorder:
             do_recognition(args, recorder, recognizer, player, status_ui)
 
 
+def parse_cpus(cpus):
+    """Parses a list of CPUs like '2,3' into a set, or returns None."""
+    if not cpus:
+        return None
+    return {int(cpu) for cpu in cpus.split(',')}
+
+
 def do_assistant_library(args, credentials, player, status_ui):
     """Run a recognizer using the Google Assistant Library.
 
@@ -232,6 +346,41 @@ installed with:
         for event in assistant.start():
             process_event(event)
 
+def make_trigger(name, args, recorder):
+    """Returns the trigger called name and a prompt for it, or None and None
+    if it can't be set up."""
+
+    if name == 'gpio':
+        import aiy._drivers._gpio
+        import triggers.gpio
+        aiy._drivers._gpio.set_backend(args.gpio_backend)
+        triggerer = triggers.gpio.GpioTrigger(channel=23)
+        # Start opening the microphone on the button edge, while the press is
+        # being debounced.
+        triggerer.set_wake_callback(
+            lambda waking: recorder.acquire_capture() if waking
+            else recorder.release_capture())
+        return triggerer, 'Press the button on GPIO 23'
+    elif name == 'clap':
+        import triggers.clap
+        return triggers.clap.ClapTrigger(recorder), 'Clap your hands'
+    elif name == 'knock':
+        import triggers.knock
+        return triggers.knock.KnockTrigger(recorder), 'Knock on the door'
+    elif name == 'keyword':
+        import triggers.keyword
+        try:
+            triggerer = triggers.keyword.KeywordTrigger(
+                recorder, args.keyword, threshold=args.keyword_threshold)
+        except ValueError as e:
+            logger.error('%s; record some with: python3 -m triggers.keyword'
+                         ' --record 5 %s', e, args.keyword)
+            return None, None
+        return triggerer, 'Say "%s"' % args.keyword
+    logger.error("Unknown trigger '%s'", name)
+    return None, None
+
+
 def do_recognition(args, recorder, recognizer, player, status_ui):
     """Configure and run the recognizer."""
     say = aiy.audio.say
@@ -242,22 +391,53 @@ def do_recognition(args, recorder, recognizer, player, status_ui):
 
     recognizer.add_phrases(actor)
     recognizer.set_audio_logging_enabled(args.audio_logging)
+    recognizer.set_uplink_encoding(args.uplink_encoding)
 
-    if args.trigger == 'gpio':
-        import triggers.gpio
-        triggerer = triggers.gpio.GpioTrigger(channel=23)
-        msg = 'Press the button on GPIO 23'
-    elif args.trigger == 'clap':
-        import triggers.clap
-        triggerer = triggers.clap.ClapTrigger(recorder)
-        msg = 'Clap your hands'
-    else:
-        logger.error("Unknown trigger '%s'", args.trigger)
-        return
+    triggerers = {}
+    msgs = []
+    for name in args.triggers:
+        triggerer, msg = make_trigger(name, args, recorder)
+        if not triggerer:
+            return
+        triggerers[name] = triggerer
+        msgs.append(msg)
+    if len(triggerers) > 1:
+        import triggers.composite
+        triggerer = triggers.composite.CompositeTrigger(
+            triggerers, window_s=args.trigger_window)
+        msg = ', or '.join([msgs[0]] + [m[0].lower() + m[1:] for m in msgs[1:]])
+
+    # Processors between the recorder and the recognizer, built from the
+    # recognizer backwards.
+    audio_stages = []
+
+    def next_stage():
+        return audio_stages[0] if audio_stages else recognizer
+
+    if args.agc:
+        import aiy._drivers._enhance
+        audio_stages.insert(0, aiy._drivers._enhance.Agc(next_stage()))
+    if args.denoise:
+        import aiy._drivers._enhance
+        # The noise profile keeps learning between requests.
+        noise_profile = aiy._drivers._enhance.NoiseProfile()
+        recorder.add_processor(noise_profile, queue_size=4)
+        audio_stages.insert(0, aiy._drivers._enhance.NoiseSuppressor(
+            next_stage(), noise_profile))
+    if args.vad:
+        import aiy._drivers._vad
+        audio_stages.insert(0, aiy._drivers._vad.VadGate(next_stage()))
+    if args.local_endpointer != 'off':
+        import aiy._drivers._vad
+        # The endpointer goes first, as it needs the silence the gate drops.
+        end_audio = args.local_endpointer == 'on'
+        audio_stages.insert(0, aiy._drivers._vad.Endpointer(
+            next_stage(), lambda: recognizer.local_endpoint(end_audio),
+            silence_s=args.endpoint_silence))
 
     mic_recognizer = SyncMicRecognizer(
         actor, recognizer, recorder, player, say, triggerer, status_ui,
-        args.assistant_always_responds)
+        args.assistant_always_responds, args.preroll, audio_stages)
 
     with mic_recognizer:
         if sys.stdout.isatty():
@@ -289,7 +469,9 @@ class StatusUi(object):
             self.led_fifo = None
 
         if trigger_sound and os.path.exists(os.path.expanduser(trigger_sound)):
-            self.trigger_sound = os.path.expanduser(trigger_sound)
+            # Loaded once, so playing it doesn't wait on the SD card.
+            self.trigger_sound = aiy._drivers._player.read_wav(
+                os.path.expanduser(trigger_sound))
         else:
             if trigger_sound:
                 logger.warning(
@@ -304,7 +486,54 @@ class StatusUi(object):
         logger.info('%s...', status)
 
         if status == 'listening' and self.trigger_sound:
-            self.player.play_wav(self.trigger_sound)
+            self.player.play_bytes(*self.trigger_sound)
+
+
+class Timeline(object):
+
+    """Records when the steps after a trigger start and end, to show how
+    much of the pre-warming was hidden behind the trigger sound.
+    """
+
+    def __init__(self):
+        self._start = time.monotonic()
+        self._lock = threading.Lock()
+        self._spans = collections.OrderedDict()
+
+    def begin(self, name):
+        with self._lock:
+            self._spans[name] = [time.monotonic(), None]
+
+    def end(self, name):
+        with self._lock:
+            if name in self._spans and self._spans[name][1] is None:
+                self._spans[name][1] = time.monotonic()
+
+    def overlap(self, name, other):
+        """Returns how many seconds the spans overlapped, so far."""
+        with self._lock:
+            if name not in self._spans or other not in self._spans:
+                return 0.0
+            now = time.monotonic()
+            (start, end), (other_start, other_end) = [
+                (begin, end or now) for begin, end in
+                (self._spans[name], self._spans[other])]
+        return max(0.0, min(end, other_end) - max(start, other_start))
+
+    def summary(self, hidden_by):
+        """Returns the spans in ms since the trigger, and how much of each
+        overlapped the hidden_by span."""
+        with self._lock:
+            spans = list(self._spans.items())
+        steps = ', '.join(
+            '%s %d-%s ms' % (name, (start - self._start) * 1000,
+                             '%d' % ((end - self._start) * 1000) if end else '?')
+            for name, (start, end) in spans)
+        hidden = ', '.join(
+            '%s %d of %d ms' % (name, self.overlap(name, hidden_by) * 1000,
+                                ((end or time.monotonic()) - start) * 1000)
+            for name, (start, end) in spans if name != hidden_by)
+        return '%s; during the %s: %s' % (steps, hidden_by, hidden)
 
 
 class SyncMicRecognizer(object):
@@ -318,7 +547,8 @@ class SyncMicRecognizer(object):
     # pylint: disable=too-many-instance-attributes
 
     def __init__(self, actor, recognizer, recorder, player, say, triggerer,
-                 status_ui, assistant_always_responds):
+                 status_ui, assistant_always_responds, preroll_s=0,
+                 audio_stages=()):
         self.actor = actor
         self.player = player
         self.recognizer = recognizer
@@ -329,8 +559,14 @@ class SyncMicRecognizer(object):
         self.triggerer.set_callback(self.recognize)
         self.status_ui = status_ui
         self.assistant_always_responds = assistant_always_responds
+        self.preroll_s = preroll_s
+        # Processors that filter audio on its way to the recognizer, in order.
+        # The recorder feeds the first one, or the recognizer if there are none.
+        self.audio_stages = list(audio_stages)
+        self.audio_sink = self.audio_stages[0] if audio_stages else recognizer
 
         self.running = False
+        self._timeline = None
 
         self.say('hello')
         self.recognizer_event = threading.Event()
@@ -347,19 +583,54 @@ class SyncMicRecognizer(object):
 
         self.recognizer.end_audio()
 
-    def recognize(self):
+    def recognize(self, preroll=True):
         if self.recognizer_event.is_set():
             # Duplicate trigger (eg multiple button presses)
             return
 
-        self.status_ui.status('listening')
+        # Attach the recognizer before the trigger sound plays, with the audio
+        # from just before the trigger, so the start of the utterance is kept.
+        # Capture stays acquired until the request is done.
+        timeline = Timeline()
+        self.recorder.acquire_capture()
         self.recognizer.reset()
-        self.recorder.add_processor(self.recognizer)
+        for stage in self.audio_stages:
+            stage.reset()
+        self.recorder.get_graph().add_stage(
+            self.audio_sink, preroll_s=self.preroll_s if preroll else 0)
+
+        # Open the request and get TTS ready while the trigger sound plays.
+        timeline.begin('speech')
+        self.recognizer.prewarm(lambda: timeline.end('speech'))
+        timeline.begin('tts')
+        threading.Thread(target=self._prewarm_tts, args=(timeline,)).start()
+        timeline.begin('sound')
+        self.status_ui.status('listening')
+        timeline.end('sound')
+        self._timeline = timeline
         # Tell recognizer to run
         self.recognizer_event.set()
 
+    def _prewarm_tts(self, timeline):
+        # The prompts said when a request goes wrong.
+        aiy.audio.prewarm_say([
+            _('Unexpected error. Try again or check the logs.'),
+            _("I don’t know how to answer that."),
+            _("Could you try that again?"),
+        ])
+        timeline.end('tts')
+
     def endpointer_cb(self):
-        self.recorder.remove_processor(self.recognizer)
+        self.recorder.get_graph().remove_stage(self.audio_sink)
+        if self._timeline:
+            logger.info('timeline: %s', self._timeline.summary('sound'))
+        for stage in self.audio_stages:
+            if hasattr(stage, 'get_stats'):
+                logger.info('%s: %s', type(stage).__name__, stage.get_stats())
+        logger.info('recorder: %s', self.recorder.get_stats())
+        for stage, stats in self.recorder.get_graph().get_stats().items():
+            logger.info('graph stage %s: %s', type(stage).__name__, stats)
+        logger.info('local endpointer: %s', self.recognizer.get_endpoint_stats())
         self.status_ui.status('thinking')
 
     def _recognize(self):
@@ -374,13 +645,18 @@ class SyncMicRecognizer(object):
             except speech.Error:
                 logger.exception('Unexpected error')
                 self.say(_('Unexpected error. Try again or check the logs.'))
+            logger.info('speech connections: %s', self.recognizer.get_connection_stats())
 
             self.recognizer_event.clear()
             if self.recognizer.dialog_follow_on:
-                self.recognize()
+                # The audio before a follow-on turn is our own response.
+                self.recognize(preroll=False)
             else:
                 self.triggerer.start()
                 self.status_ui.status('ready')
+            # Paired with the acquire in recognize(), after any follow-on turn
+            # has acquired capture again.
+            self.recorder.release_capture()
 
     def _handle_result(self, result):
         if result.transcript and self.actor.handle(result.transcript):
@@ -12,41 +12,257 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Detect claps in the audio stream."""
+"""Detect claps in the audio stream.
+
+To measure false triggers and CPU time on synthetic audio, or on a 16-bit
+mono WAV file with Audacity labels, where claps are labelled "clap":
+    python3 -m triggers.clap [--wav audio.wav --labels labels.txt]
+"""
 
 import logging
+import threading
+
 import numpy as np
 
+import aiy._drivers._graph
+import triggers.transient
+from triggers.transient import FULL_SCALE
 from triggers.trigger import Trigger
 
 logger = logging.getLogger('trigger')
 
 
+class ClapDetector(triggers.transient.TransientDetector):
+
+    """Finds claps: broadband transients that end within decay_s.
+
+    What the onset adds to the spectrum must have at least min_high_ratio of
+    its energy above 1 kHz, and a spectral flatness from 1 to 6 kHz of at
+    least min_flatness. Slammed doors fail the high-frequency and decay
+    tests, tonal clinks the flatness test, and speech mostly the decay test.
+    """
+
+    def __init__(self, sample_rate_hz=16000, frame_s=0.02, min_flatness=0.35,
+                 min_high_ratio=0.5, **kwargs):
+        super().__init__(sample_rate_hz, frame_s, **kwargs)
+        self.min_flatness = min_flatness
+        self.min_high_ratio = min_high_ratio
+        self._high = self.freqs >= 1000
+        self._band = self._high & (self.freqs <= 6000)
+        self.last_features = None
+
+    def accept(self, power):
+        band = power[self._band]
+        flatness = np.exp(np.mean(np.log(band))) / np.mean(band)
+        high_ratio = power[self._high].sum() / power.sum()
+        self.last_features = (float(flatness), float(high_ratio))
+        return flatness >= self.min_flatness and high_ratio >= self.min_high_ratio
+
+
 class ClapTrigger(Trigger):
 
-    """Detect claps in the audio stream."""
+    """Detect claps in the audio stream.
+
+    It runs as a stage of the recorder's audio graph, on FRAME_S frames of
+    int16 samples. The detector runs all the time, to keep track of the
+    noise, but the trigger only fires after start(). The callback runs on
+    its own thread, to keep it off the capture thread.
+    """
+
+    FRAME_S = 0.02
+    # Frames are queued for a worker thread, so a slow frame doesn't hold up
+    # capture; up to QUEUE_S of audio waits before the oldest is dropped.
+    QUEUE_S = 0.5
+    DTYPE = aiy._drivers._graph.INT16
 
     def __init__(self, recorder):
         super().__init__()
 
         self.have_clap = True  # don't start yet
-        self.prev_sample = 0
-        recorder.add_processor(self)
+        graph = recorder.get_graph()
+        self.detector = ClapDetector(graph.sample_rate_hz, self.FRAME_S)
+        graph.add_stage(self, queue_size=round(self.QUEUE_S / self.FRAME_S))
 
     def start(self):
-        self.prev_sample = 0
         self.have_clap = False
 
-    def add_data(self, data):
-        """ audio is mono 16bit signed at 16kHz """
-        audio = np.fromstring(data, 'int16')
-        if not self.have_clap:
-            # alternative: np.abs(audio).sum() > thresh
-            shifted = np.roll(audio, 1)
-            shifted[0] = self.prev_sample
-            val = np.max(np.abs(shifted - audio))
-            if val > (65536 // 4):  # quarter max delta
-                logger.info("clap detected")
-                self.have_clap = True
-                self.callback()
+    def add_data(self, audio):
+        """ audio is an int16 array of mono samples """
+        if self.detector.process(audio) and not self.have_clap:
+            logger.info("clap detected")
+            self.have_clap = True
+            threading.Thread(target=self.callback).start()
+
+
+def _synthesize(seconds, sample_rate_hz, rng):
+    """Returns int16 audio of claps among other sounds, and its labels as a
+    list of (start_s, end_s, name).
+    """
+    n = seconds * sample_rate_hz
+    t = np.arange(n) / sample_rate_hz
+
+    def band(noise, low_hz, high_hz):
+        spectrum = np.fft.rfft(noise)
+        freqs = np.fft.rfftfreq(len(noise), 1 / sample_rate_hz)
+        spectrum[(freqs < low_hz) | (freqs > high_hz)] = 0
+        return np.fft.irfft(spectrum, len(noise))
+
+    def normalize(x, dbfs):
+        return x * (FULL_SCALE * 10 ** (dbfs / 20) / np.abs(x).max())
+
+    def clap(length):
+        x = band(rng.randn(length), 600, 6000)
+        return x * np.exp(-np.arange(length) / (0.006 * sample_rate_hz))
+
+    def door(length):
+        k = np.arange(length) / sample_rate_hz
+        x = sum(np.sin(2 * np.pi * f * k) * np.exp(-k / 0.15)
+                for f in rng.uniform(50, 250, 4))
+        x += 0.5 * band(rng.randn(length), 0, 900) * np.exp(-k / 0.05)
+        return x + 1.5 * rng.randn(length) * np.exp(-k / 0.003)
+
+    def clink(length):
+        k = np.arange(length) / sample_rate_hz
+        return np.sin(2 * np.pi * rng.uniform(2000, 4000) * k) * np.exp(-k / 0.04)
+
+    def speech(length):
+        # Syllables with a plosive burst and a voiced vowel.
+        k = np.arange(length) / sample_rate_hz
+        f0 = rng.uniform(100, 220)
+        x = sum(np.sin(2 * np.pi * f0 * h * k) / h for h in range(1, 12))
+        x *= 0.5 + 0.5 * np.sin(2 * np.pi * 4 * k - np.pi / 2) ** 2
+        burst = int(0.01 * sample_rate_hz)
+        x[:burst] += 0.5 * band(rng.randn(burst), 1000, 7000)
+        return x
+
+    def car(length):
+        # A passing car: rumble swelling and fading over a few seconds.
+        swell = np.hanning(length) ** 2
+        return band(rng.randn(length), 20, 500) * swell
+
+    events = (
+        ('clap', 0.3, clap, (-30, -3)),
+        ('door', 1.5, door, (-12, -1)),
+        ('clink', 0.5, clink, (-30, -10)),
+        ('speech', 1.5, speech, (-30, -10)),
+        ('car', 6.0, car, (-25, -10)),
+    )
+
+    # Quiet room noise and a slowly varying hum of distant traffic.
+    audio = normalize(rng.randn(n), -55)
+    hum = band(rng.randn(n), 20, 400)
+    audio += normalize(hum, -30) * (0.5 + 0.5 * np.sin(2 * np.pi * t / 40))
+
+    labels = []
+    pos = sample_rate_hz
+    while True:
+        name, length_s, make, levels = events[rng.randint(len(events))]
+        length = int(length_s * sample_rate_hz)
+        if pos + length > n:
+            break
+        audio[pos:pos + length] += normalize(make(length), rng.uniform(*levels))
+        labels.append((pos / sample_rate_hz, (pos + length) / sample_rate_hz, name))
+        pos += length + int(rng.uniform(1.0, 3.0) * sample_rate_hz)
+
+    return np.clip(np.rint(audio), -FULL_SCALE, FULL_SCALE - 1).astype(np.int16), labels
+
+
+class _FixedThreshold(object):
+
+    """The detector ClapTrigger used to have, for comparison: a clap is a
+    jump between samples of more than a quarter of the full range."""
+
+    def __init__(self, refractory_frames):
+        self.prev_sample = 0
+        self.refractory_frames = refractory_frames
+        self._quiet = 0
+
+    def process(self, audio):
+        audio = audio.astype(np.int32)
+        shifted = np.roll(audio, 1)
+        shifted[0] = self.prev_sample
         self.prev_sample = audio[-1]
+        if self._quiet:
+            self._quiet -= 1
+            return False
+        if np.max(np.abs(shifted - audio)) > 65536 // 4:
+            self._quiet = self.refractory_frames
+            return True
+        return False
+
+
+def _main():
+    import argparse
+    import time
+    import wave
+
+    parser = argparse.ArgumentParser(description='Benchmark clap detection')
+    parser.add_argument('--wav', help='16-bit mono WAV file (default: synthetic)')
+    parser.add_argument('--labels', help='Audacity label file for --wav')
+    parser.add_argument('--seconds', type=int, default=600,
+                        help='Length of the synthetic audio')
+    args = parser.parse_args()
+
+    if args.wav:
+        if not args.labels:
+            parser.error('--wav needs --labels')
+        with wave.open(args.wav, 'rb') as wav:
+            sample_rate_hz = wav.getframerate()
+            if wav.getnchannels() != 1 or wav.getsampwidth() != 2:
+                parser.error('%s is not 16-bit mono' % args.wav)
+            audio = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+        with open(args.labels) as f:
+            labels = [(float(start), float(end), name.strip())
+                      for start, end, name in (line.split('\t', 2) for line in f
+                                               if line.strip())]
+    else:
+        sample_rate_hz = 16000
+        audio, labels = _synthesize(args.seconds, sample_rate_hz,
+                                    np.random.RandomState(0))
+
+    frame_s = ClapTrigger.FRAME_S
+    frame_len = int(round(frame_s * sample_rate_hz))
+    seconds = len(audio) / sample_rate_hz
+    claps = [label for label in labels if label[2] == 'clap']
+    print('%.0f s of audio, %d claps, %d other sounds' % (
+        seconds, len(claps), len(labels) - len(claps)))
+
+    detectors = (
+        ('fixed threshold', _FixedThreshold(int(0.3 / frame_s))),
+        ('adaptive', ClapDetector(sample_rate_hz, frame_s)),
+    )
+    for name, detector in detectors:
+        times = []
+        detections = []
+        for pos in range(0, len(audio) - frame_len + 1, frame_len):
+            frame = audio[pos:pos + frame_len]
+            start = time.perf_counter()
+            if detector.process(frame):
+                detections.append((pos + frame_len) / sample_rate_hz)
+            times.append(time.perf_counter() - start)
+
+        # A detection up to 0.2 s after the end of a sound is caused by it.
+        found = set()
+        false_by_cause = {}
+        for when in detections:
+            cause = next((label for label in labels
+                          if label[0] <= when <= label[1] + 0.2), None)
+            if cause and cause[2] == 'clap':
+                found.add(cause)
+            else:
+                cause_name = cause[2] if cause else 'background'
+                false_by_cause[cause_name] = false_by_cause.get(cause_name, 0) + 1
+        false_count = sum(false_by_cause.values())
+
+        times = np.array(times) * 1e6
+        print('%s:' % name)
+        print('  claps found: %d/%d' % (len(found), len(claps)))
+        print('  false triggers: %d (%.0f per hour)%s' % (
+            false_count, false_count * 3600 / seconds,
+            ''.join(', %s %d' % item for item in sorted(false_by_cause.items()))))
+        print('  CPU per %d ms frame: mean %.0f us, 99th percentile %.0f us' % (
+            frame_s * 1000, times.mean(), np.percentile(times, 99)))
+
+
+if __name__ == '__main__':
+    _main()
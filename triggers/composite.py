@@ -0,0 +1,85 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Run several triggers at once."""
+
+import logging
+import threading
+import time
+
+from triggers.trigger import Trigger
+
+logger = logging.getLogger('trigger')
+
+
+class CompositeTrigger(Trigger):
+
+    """Fires when any of several triggers fires.
+
+    triggers maps a name for each source, like 'gpio', to its Trigger. Like
+    the other triggers, this fires once per start(). Activations within
+    window_s of the one that fired, like a knock heard together with the
+    button press, are dropped, even after the next start(). source is the
+    name of the trigger that fired last.
+    """
+
+    def __init__(self, triggers, window_s=1.0):
+        super().__init__()
+
+        if not triggers:
+            raise ValueError('need at least one trigger')
+        self.triggers = dict(triggers)
+        self.window_s = window_s
+        self.source = None
+        self.fired_s = None
+
+        self._lock = threading.Lock()
+        self._armed = False
+        self._fires = {name: 0 for name in self.triggers}
+        self._dropped = {name: 0 for name in self.triggers}
+        for name, trigger in self.triggers.items():
+            trigger.set_callback(lambda name=name: self._fire(name))
+
+    def set_wake_callback(self, wake_callback):
+        super().set_wake_callback(wake_callback)
+        for trigger in self.triggers.values():
+            trigger.set_wake_callback(wake_callback)
+
+    def start(self):
+        with self._lock:
+            self._armed = True
+        for trigger in self.triggers.values():
+            trigger.start()
+
+    def get_stats(self):
+        stats = {'fires': dict(self._fires), 'dropped': dict(self._dropped)}
+        for name, trigger in self.triggers.items():
+            if hasattr(trigger, 'get_stats'):
+                stats[name] = trigger.get_stats()
+        return stats
+
+    def _fire(self, name):
+        now = time.monotonic()
+        with self._lock:
+            if (not self._armed or
+                    self.fired_s is not None and now - self.fired_s < self.window_s):
+                self._dropped[name] += 1
+                logger.info('%s trigger dropped, after %s', name, self.source)
+                return
+            self._armed = False
+            self.source = name
+            self.fired_s = now
+            self._fires[name] += 1
+        logger.info('triggered by %s', name)
+        self.callback()
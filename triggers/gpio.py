@@ -14,47 +14,61 @@
 
 """Detect edges on the given GPIO channel."""
 
-import time
-
-import RPi.GPIO as GPIO
-
+import aiy._drivers._gpio as gpio
 from triggers.trigger import Trigger
 
 
 class GpioTrigger(Trigger):
 
-    """Detect edges on the given GPIO channel."""
+    """Detect edges on the given GPIO channel.
+
+    The input has to hold the value after the edge for DEBOUNCE_TIME, to
+    avoid false triggers on short pulses. This is checked with a timer
+    started from the edge's timestamp, so no thread sleeps in the meantime.
+    """
 
     DEBOUNCE_TIME = 0.05
 
-    def __init__(self, channel, polarity=GPIO.FALLING,
-                 pull_up_down=GPIO.PUD_UP):
+    def __init__(self, channel, polarity=gpio.FALLING,
+                 pull_up_down=gpio.PUD_UP, backend=None):
         super().__init__()
 
         self.channel = channel
         self.polarity = polarity
-
-        if polarity not in [GPIO.FALLING, GPIO.RISING]:
-            raise ValueError('polarity must be GPIO.FALLING or GPIO.RISING')
-
-        self.expected_value = polarity == GPIO.RISING
+        self.pull_up_down = pull_up_down
+        self.expected_value = gpio.pressed_value(polarity)
+        self.backend = backend or gpio.get_backend()
+        self.debouncer = gpio.Debouncer(self.DEBOUNCE_TIME, self._settled,
+                                        on_noise=self._wake_done)
         self.event_detect_added = False
-
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(channel, GPIO.IN, pull_up_down=pull_up_down)
+        self._waking = False
 
     def start(self):
         if not self.event_detect_added:
-            GPIO.add_event_detect(self.channel, self.polarity, callback=self.debounce)
+            self.backend.watch(self.channel, self.pull_up_down, self._edge)
+            self.debouncer.value = self.backend.read(self.channel)
             self.event_detect_added = True
 
-    def debounce(self, _):
-        """Check that the input holds the expected value for the debounce period,
-        to avoid false trigger on short pulses."""
-        start = time.time()
-        while time.time() < start + self.DEBOUNCE_TIME:
-            if GPIO.input(self.channel) != self.expected_value:
-                return
-            time.sleep(0.01)
-
-        self.callback()
+    def _edge(self, value, timestamp_s):
+        # Wake on a press, not on the bounces of a release.
+        if (value == self.expected_value and not self._waking and
+                self.debouncer.value != self.expected_value):
+            self._waking = True
+            if self.wake_callback:
+                self.wake_callback(True)
+        self.debouncer.edge(value, timestamp_s)
+
+    def _settled(self, value, _):
+        if value == self.expected_value:
+            try:
+                self.callback()
+            finally:
+                self._wake_done()
+        else:
+            self._wake_done()
+
+    def _wake_done(self):
+        if self._waking:
+            self._waking = False
+            if self.wake_callback:
+                self.wake_callback(False)
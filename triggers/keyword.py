@@ -0,0 +1,394 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Detect a spoken keyword, like "doorman", in the audio stream.
+
+The keyword is matched against templates: recordings of it, as 16-bit mono
+WAV files at the recorder's sample rate, in a directory per keyword:
+    ~/.config/voice-recognizer/keywords/doorman/*.wav
+
+Record the templates with the same microphone the trigger will use, a
+few of them, said the way visitors would say it. To record them:
+    python3 -m triggers.keyword --record 5 doorman
+To run the trigger over WAV files with the replay recorder, and see what it
+finds and how much CPU it needs:
+    python3 -m triggers.keyword doorman test1.wav test2.wav
+"""
+
+import glob
+import logging
+import os
+import threading
+import time
+import wave
+
+import numpy as np
+
+import aiy._drivers._graph
+from triggers.trigger import Trigger
+
+logger = logging.getLogger('trigger')
+
+CONFIG_DIR = os.getenv('XDG_CONFIG_HOME') or os.path.expanduser('~/.config')
+KEYWORD_DIR = os.path.join(CONFIG_DIR, 'voice-recognizer', 'keywords')
+
+
+def _mel(hz):
+    return 2595 * np.log10(1 + hz / 700.0)
+
+
+def _mel_filters(num_filters, nfft, sample_rate_hz, low_hz=20, high_hz=7600):
+    """Returns a (num_filters, nfft // 2 + 1) matrix of triangular filters."""
+    high_hz = min(high_hz, sample_rate_hz / 2)
+    mels = np.linspace(_mel(low_hz), _mel(high_hz), num_filters + 2)
+    edges = 700 * (10 ** (mels / 2595) - 1)
+    freqs = np.fft.rfftfreq(nfft, 1.0 / sample_rate_hz)
+    filters = np.zeros((num_filters, len(freqs)), dtype=np.float32)
+    for i in range(num_filters):
+        low, mid, high = edges[i:i + 3]
+        filters[i] = np.maximum(0, np.minimum((freqs - low) / (mid - low),
+                                              (high - freqs) / (high - mid)))
+    return filters
+
+
+class Mfcc(object):
+
+    """Computes the MFCCs of a stream of audio, one vector per hop_s.
+
+    Frames of frame_s seconds are pre-emphasized and Hamming windowed. The
+    log energies of num_filters mel bands are turned into num_ceps liftered
+    cepstral coefficients, leaving out c0, which depends on the level.
+    process() can be fed any amount of audio, and carries over what is left
+    for the next frame.
+    """
+
+    def __init__(self, sample_rate_hz=16000, frame_s=0.025, hop_s=0.01,
+                 num_filters=26, num_ceps=12):
+        self.frame_len = int(round(frame_s * sample_rate_hz))
+        self.hop = int(round(hop_s * sample_rate_hz))
+        self.num_ceps = num_ceps
+        self._nfft = 1 << (self.frame_len - 1).bit_length()
+        self._window = np.hamming(self.frame_len).astype(np.float32)
+        self._filters = _mel_filters(num_filters, self._nfft, sample_rate_hz).T
+
+        # Orthonormal DCT-II, without c0.
+        n = np.arange(num_filters)
+        k = np.arange(1, num_ceps + 1)[:, None]
+        self._dct = (np.cos(np.pi * k * (n + 0.5) / num_filters) *
+                     np.sqrt(2.0 / num_filters)).T.astype(np.float32)
+        self._dct *= 1 + (num_ceps + 10) / 2.0 * np.sin(np.pi * k.T / (num_ceps + 10))
+        self.reset()
+
+    def reset(self):
+        self._pending = np.zeros(self.frame_len - self.hop, dtype=np.float32)
+        self._last = 0.0
+
+    def process(self, samples):
+        """Returns (ceps, energy_db): an (n, num_ceps) array of MFCCs and the
+        level of each of the n frames that samples completed.
+        """
+
+        x = np.asarray(samples, dtype=np.float32)
+        data = np.empty(len(self._pending) + len(x), dtype=np.float32)
+        data[:len(self._pending)] = self._pending
+        emphasized = data[len(self._pending):]
+        if len(x):
+            emphasized[0] = x[0] - 0.97 * self._last
+            np.subtract(x[1:], 0.97 * x[:-1], out=emphasized[1:])
+            self._last = float(x[-1])
+
+        count = (len(data) - self.frame_len) // self.hop + 1
+        if count <= 0:
+            self._pending = data
+            return np.empty((0, self.num_ceps), dtype=np.float32), np.empty(0)
+
+        frames = np.lib.stride_tricks.as_strided(
+            data, (count, self.frame_len), (self.hop * data.strides[0], data.strides[0]),
+            writeable=False)
+        self._pending = data[count * self.hop:].copy()
+
+        windowed = frames * self._window
+        energy_db = 10 * np.log10(np.mean(windowed * windowed, axis=1) + 1.0)
+        power = np.abs(np.fft.rfft(windowed, self._nfft)) ** 2
+        ceps = np.log(power @ self._filters + 1.0) @ self._dct
+        return ceps, energy_db
+
+
+def load_template(path, sample_rate_hz=16000, trim_db=30.0):
+    """Returns the normalized MFCCs of a WAV file of the keyword, without the
+    frames more than trim_db below its loudest frame at either end.
+    """
+
+    with wave.open(path, 'rb') as wav:
+        if (wav.getnchannels() != 1 or wav.getsampwidth() != 2 or
+                wav.getframerate() != sample_rate_hz):
+            raise ValueError('%s is not 16-bit mono at %d Hz' % (path, sample_rate_hz))
+        samples = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+
+    ceps, energy_db = Mfcc(sample_rate_hz).process(samples)
+    loud = np.flatnonzero(energy_db >= energy_db.max() - trim_db)
+    if not len(loud):
+        raise ValueError('%s is silent' % path)
+    ceps = ceps[loud[0]:loud[-1] + 1]
+    return ceps / (np.linalg.norm(ceps, axis=1, keepdims=True) + 1e-9)
+
+
+class TemplateMatcher(object):
+
+    """Matches a stream of MFCC vectors against templates with subsequence
+    dynamic time warping.
+
+    A match can start at any frame. Each input frame may stay on the same
+    template frame, move to the next one, or skip one, so the keyword may be
+    said up to twice as fast as in the template, or any slower. The cost
+    of a frame is the cosine distance between the MFCC vectors, doubled when
+    a template frame is skipped. The score of a match is its cost divided by
+    the template's length.
+
+    All templates are laid out in one array, so each input frame costs the
+    same few NumPy operations however many templates there are.
+    """
+
+    def __init__(self, templates):
+        if not templates:
+            raise ValueError('no templates')
+        # Each template is preceded by two states: unreachable, and the
+        # start, which costs nothing.
+        sizes = [len(t) + 2 for t in templates]
+        starts = np.cumsum([0] + sizes[:-1])
+        dims = templates[0].shape[1]
+
+        self._features = np.zeros((sum(sizes), dims), dtype=np.float32)
+        for start, template in zip(starts, templates):
+            self._features[start + 2:start + 2 + len(template)] = template
+        self._unreachable = starts
+        self._start = starts + 1
+        self._ends = starts + np.array(sizes) - 1
+        self._lengths = np.array([len(t) for t in templates], dtype=np.float32)
+
+        self._cost = np.empty(sum(sizes), dtype=np.float32)
+        self._next = np.empty_like(self._cost)
+        self._dist = np.empty_like(self._cost)
+        self.reset()
+
+    def reset(self):
+        """Forgets partial matches."""
+        self._cost.fill(np.inf)
+        self._cost[self._start] = 0
+
+    def step(self, frame):
+        """Takes a normalized MFCC vector. Returns the best score of a match
+        of a whole template that ends with it.
+        """
+
+        dist, cost, new = self._dist, self._cost, self._next
+        np.dot(self._features, frame, out=dist)
+        np.subtract(1, dist, out=dist)
+
+        # Stay, or come from the previous template frame...
+        np.minimum(cost[2:], cost[1:-1], out=new[2:])
+        new[2:] += dist[2:]
+        # ...or skip one, at twice the cost.
+        dist[2:] *= 2
+        dist[2:] += cost[:-2]
+        np.minimum(new[2:], dist[2:], out=new[2:])
+
+        new[self._unreachable] = np.inf
+        new[self._start] = 0
+        self._cost, self._next = new, cost
+        return float(np.min(new[self._ends] / self._lengths))
+
+
+class KeywordTrigger(Trigger):
+
+    """Detect a spoken keyword in the audio stream.
+
+    Incoming audio is turned into MFCCs every 10 ms and matched against the
+    keyword's templates (see TemplateMatcher). The keyword is detected when
+    a match scores below threshold while there is speech, ie the audio was
+    recently speech_db above the noise floor, once the score stops
+    improving. After a detection, matches are forgotten and new ones ignored
+    for refractory_s. detected_s is how far into the audio the last
+    detection was.
+
+    It runs as a stage of the recorder's audio graph, on FRAME_S frames of
+    int16 samples. It runs all the time, to keep its matches current, but
+    the trigger only fires after start(). The callback runs on its own
+    thread, to keep it off the capture thread.
+    """
+
+    FRAME_S = 0.05
+    # Matching can take longer than a frame; the worker thread lets it catch up.
+    QUEUE_S = 0.5
+    DTYPE = aiy._drivers._graph.INT16
+
+    def __init__(self, recorder=None, keyword='doorman', keyword_dir=KEYWORD_DIR,
+                 threshold=0.2, speech_db=10.0, refractory_s=1.0):
+        super().__init__()
+
+        graph = recorder.get_graph() if recorder else None
+        sample_rate_hz = graph.sample_rate_hz if graph else 16000
+
+        paths = sorted(glob.glob(os.path.join(keyword_dir, keyword, '*.wav')))
+        if not paths:
+            raise ValueError('no templates for "%s" in %s' % (
+                keyword, os.path.join(keyword_dir, keyword)))
+        self.keyword = keyword
+        self.threshold = threshold
+        self.speech_db = speech_db
+
+        self._sample_rate_hz = sample_rate_hz
+        self.mfcc = Mfcc(sample_rate_hz)
+        self.matcher = TemplateMatcher([load_template(p, sample_rate_hz) for p in paths])
+        hop_s = self.mfcc.hop / sample_rate_hz
+        self._refractory_frames = int(round(refractory_s / hop_s))
+        # The speech level is held for about the length of a keyword.
+        self._level_fall_db = 10 * hop_s
+        self._floor_rise_db = 3 * hop_s
+
+        self.have_keyword = True  # don't start yet
+        self.frames = 0
+        self.detections = 0
+        self.best_score = None
+        self.detected_s = None
+        self.busy_s = 0.0
+        self._audio_s = 0.0
+        self._level_db = None
+        self._floor_db = None
+        self._quiet_until = 0
+        self._candidate = None
+
+        logger.info('listening for "%s" with %d templates', keyword, len(paths))
+        if graph:
+            graph.add_stage(self, queue_size=round(self.QUEUE_S / self.FRAME_S))
+
+    def start(self):
+        self.have_keyword = False
+
+    def get_stats(self):
+        return {
+            'frames': self.frames,
+            'detections': self.detections,
+            'best_score': self.best_score,
+            'cpu_load': self.busy_s / self._audio_s if self._audio_s else None,
+        }
+
+    def process(self, audio):
+        """Takes the next frame. Returns the score of a detection, or None."""
+
+        start = time.perf_counter()
+        detected = None
+        ceps, energy_db = self.mfcc.process(audio)
+        ceps /= np.linalg.norm(ceps, axis=1, keepdims=True) + 1e-9
+        for i, (frame, level) in enumerate(zip(ceps, energy_db.tolist())):
+            if self._floor_db is None:
+                self._floor_db = self._level_db = level
+            self._floor_db = min(self._floor_db + self._floor_rise_db, level)
+            self._level_db = max(self._level_db - self._level_fall_db, level)
+
+            score = self.matcher.step(frame)
+            self.frames += 1
+            if self.frames < self._quiet_until:
+                continue
+            if self.best_score is None or score < self.best_score:
+                self.best_score = score
+            if (score < self.threshold and (self._candidate is None or score < self._candidate) and
+                    self._level_db > self._floor_db + self.speech_db):
+                # Wait for the score to stop improving.
+                self._candidate = score
+            elif self._candidate is not None:
+                self.detections += 1
+                detected = self._candidate
+                self.detected_s = self._audio_s + (i + 1) * self.mfcc.hop / self._sample_rate_hz
+                self._candidate = None
+                self.matcher.reset()
+                self._quiet_until = self.frames + self._refractory_frames
+
+        self._audio_s += len(audio) / self._sample_rate_hz
+        self.busy_s += time.perf_counter() - start
+        return detected
+
+    def add_data(self, audio):
+        """ audio is an int16 array of mono samples """
+        score = self.process(audio)
+        if score is not None and not self.have_keyword:
+            logger.info('"%s" detected (score %.2f)', self.keyword, score)
+            self.have_keyword = True
+            threading.Thread(target=self.callback).start()
+
+
+def _main():
+    import argparse
+
+    import aiy.audio
+    import aiy._drivers._replay
+
+    logging.basicConfig(level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description='Record or test keyword templates')
+    parser.add_argument('keyword', help='Keyword, eg doorman')
+    parser.add_argument('paths', nargs='*', help='WAV files to look for the keyword in')
+    parser.add_argument('--keyword-dir', default=KEYWORD_DIR,
+                        help='Directory of template directories')
+    parser.add_argument('--record', type=int, metavar='N',
+                        help='Record N templates with the microphone')
+    parser.add_argument('--seconds', type=float, default=2.0,
+                        help='Length of each recorded template')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Highest score that counts as a detection')
+    args = parser.parse_args()
+
+    if args.record:
+        directory = os.path.join(args.keyword_dir, args.keyword)
+        os.makedirs(directory, exist_ok=True)
+        # A Recorder can only be started once, so all takes share a session.
+        recorder = aiy.audio.get_recorder()
+        with recorder:
+            for _ in range(args.record):
+                path = os.path.join(directory, '%d.wav' % int(time.time() * 1000))
+                input('Press Enter, then say "%s"' % args.keyword)
+                with aiy.audio._WaveDump(path, args.seconds) as dumper:  # pylint: disable=protected-access
+                    recorder.add_processor(dumper, queue_size=16)
+                    while not dumper.is_done():
+                        time.sleep(0.1)
+                    recorder.remove_processor(dumper)
+                print('Saved', path)
+        return
+    if not args.paths:
+        parser.error('give WAV files to test, or --record')
+
+    # The files replay as fast as possible, so the trigger runs on the
+    # capture thread, without a queue that would drop frames, and detections
+    # are taken from process() rather than the callback thread.
+    recorder = aiy._drivers._replay.ReplayRecorder(args.paths, speed=0)
+    trigger = KeywordTrigger(None, args.keyword, args.keyword_dir, args.threshold)
+    detections = []
+
+    class Tester(object):
+        def add_data(self, audio):
+            if trigger.process(audio) is not None:
+                detections.append(trigger.detected_s)
+    recorder.get_graph().add_stage(Tester(), frame_s=trigger.FRAME_S, dtype=trigger.DTYPE)
+    with recorder:
+        recorder.wait()
+
+    for time_s in detections:
+        print('"%s" at %.2f s' % (args.keyword, time_s))
+    stats = trigger.get_stats()
+    print('%d detections, best score %.3f, %.1f%% of a core' % (
+        stats['detections'], stats['best_score'], stats['cpu_load'] * 100))
+
+
+if __name__ == '__main__':
+    _main()
@@ -0,0 +1,247 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Detect knocking on a door in the audio stream.
+
+To see which knock patterns are found in synthetic audio, or in a 16-bit
+mono WAV file:
+    python3 -m triggers.knock [audio.wav]
+"""
+
+import collections
+import logging
+import threading
+
+import numpy as np
+
+import aiy._drivers._graph
+import triggers.transient
+from triggers.trigger import Trigger
+
+logger = logging.getLogger('trigger')
+
+
+class KnockDetector(triggers.transient.TransientDetector):
+
+    """Finds single knocks: transients that end within decay_s and whose
+    energy is mostly below 1 kHz, the thud of a door panel.
+
+    Knocks follow each other quickly, so onsets are only ignored for
+    refractory_s after each one.
+    """
+
+    def __init__(self, sample_rate_hz=16000, frame_s=0.02, min_low_ratio=0.4,
+                 decay_s=0.1, refractory_s=0.08, **kwargs):
+        super().__init__(sample_rate_hz, frame_s, decay_s=decay_s,
+                         refractory_s=refractory_s, **kwargs)
+        self.min_low_ratio = min_low_ratio
+        self._low = self.freqs < 1000
+        self.last_low_ratio = None
+
+    def accept(self, power):
+        self.last_low_ratio = float(power[self._low].sum() / power.sum())
+        return self.last_low_ratio >= self.min_low_ratio
+
+
+class KnockTrigger(Trigger):
+
+    """Detect a knocking pattern in the audio stream.
+
+    A pattern is min_knocks to max_knocks knocks, at most max_gap_s apart
+    and within window_s, at a steady rhythm: the longest gap is at most
+    1 + rhythm_tolerance times the shortest. It is recognized once no knock
+    follows for max_gap_s, so a longer run of knocks, like hammering, is not
+    mistaken for one.
+
+    It runs as a stage of the recorder's audio graph, on FRAME_S frames of
+    int16 samples, and keeps the times of the last max_knocks + 1 knocks.
+    The detector runs all the time, to keep track of the noise, but the
+    trigger only fires after start(). The callback runs on its own thread,
+    to keep it off the capture thread.
+    """
+
+    FRAME_S = 0.02
+    QUEUE_S = 0.5  # audio waiting for the worker thread before frames drop
+    DTYPE = aiy._drivers._graph.INT16
+
+    def __init__(self, recorder=None, min_knocks=2, max_knocks=4, max_gap_s=0.7,
+                 window_s=2.0, rhythm_tolerance=1.0):
+        super().__init__()
+
+        if not 1 <= min_knocks <= max_knocks:
+            raise ValueError('need 1 <= min_knocks <= max_knocks')
+        self.min_knocks = min_knocks
+        self.max_knocks = max_knocks
+        self.max_gap_s = max_gap_s
+        self.window_s = window_s
+        self.rhythm_tolerance = rhythm_tolerance
+
+        self.have_knock = True  # don't start yet
+        self.patterns = 0
+        self._knocks = collections.deque(maxlen=max_knocks + 1)
+        self._time_s = 0.0
+
+        graph = recorder.get_graph() if recorder else None
+        sample_rate_hz = graph.sample_rate_hz if graph else 16000
+        self.detector = KnockDetector(sample_rate_hz, self.FRAME_S)
+        # A knock is reported after it ends, and its spectrum checked.
+        self._report_delay_s = self.detector.decay_s + 2 * self.FRAME_S
+        if graph:
+            graph.add_stage(self, queue_size=round(self.QUEUE_S / self.FRAME_S))
+
+    def start(self):
+        self.have_knock = False
+
+    def get_stats(self):
+        stats = self.detector.get_stats()
+        stats['patterns'] = self.patterns
+        return stats
+
+    def process(self, audio):
+        """Takes the next frame. Returns the number of knocks when a pattern
+        has been recognized, or 0.
+        """
+        count = 0
+        if self.detector.process(audio):
+            onset_s = self.detector.onset_s
+            if self._knocks and onset_s - self._knocks[-1] > self.max_gap_s:
+                count = self._end_sequence()
+            self._knocks.append(onset_s)
+
+        self._time_s += self.FRAME_S
+        if (self._knocks and
+                self._time_s - self._knocks[-1] > self.max_gap_s + self._report_delay_s):
+            count = self._end_sequence() or count
+        return count
+
+    def add_data(self, audio):
+        """ audio is an int16 array of mono samples """
+        count = self.process(audio)
+        if count and not self.have_knock:
+            logger.info("%d knocks detected", count)
+            self.have_knock = True
+            threading.Thread(target=self.callback).start()
+
+    def _end_sequence(self):
+        knocks = list(self._knocks)
+        self._knocks.clear()
+        if not self.min_knocks <= len(knocks) <= self.max_knocks:
+            return 0
+        if knocks[-1] - knocks[0] > self.window_s:
+            return 0
+        if len(knocks) > 2:
+            gaps = np.diff(knocks)
+            if gaps.max() > (1 + self.rhythm_tolerance) * gaps.min():
+                return 0
+        self.patterns += 1
+        return len(knocks)
+
+
+def _synthesize(sample_rate_hz, rng):
+    """Returns int16 audio of knocking and other sounds, and a list of
+    (time_s, description, expected knocks or 0).
+    """
+
+    def knock(length):
+        k = np.arange(length) / sample_rate_hz
+        x = sum(np.sin(2 * np.pi * f * k) * np.exp(-k / 0.025)
+                for f in rng.uniform(120, 500, 3))
+        click = rng.randn(min(length, int(0.004 * sample_rate_hz)))
+        x[:len(click)] += 0.5 * click
+        return x
+
+    def clap(length):
+        spectrum = np.fft.rfft(rng.randn(length))
+        freqs = np.fft.rfftfreq(length, 1 / sample_rate_hz)
+        spectrum[(freqs < 600) | (freqs > 6000)] = 0
+        x = np.fft.irfft(spectrum, length)
+        return x * np.exp(-np.arange(length) / (0.006 * sample_rate_hz))
+
+    def door(length):
+        k = np.arange(length) / sample_rate_hz
+        x = sum(np.sin(2 * np.pi * f * k) * np.exp(-k / 0.15)
+                for f in rng.uniform(50, 250, 4))
+        return x + 1.5 * rng.randn(length) * np.exp(-k / 0.003)
+
+    def normalize(x, dbfs):
+        return x * (triggers.transient.FULL_SCALE * 10 ** (dbfs / 20) / np.abs(x).max())
+
+    scenes = [
+        ('2 knocks', [0.0, 0.35], knock, 2),
+        ('3 knocks', [0.0, 0.3, 0.6], knock, 3),
+        ('4 knocks', [0.0, 0.25, 0.5, 0.75], knock, 4),
+        ('fast 3 knocks', [0.0, 0.15, 0.3], knock, 3),
+        ('single knock', [0.0], knock, 0),
+        ('hammering', [0.25 * i for i in range(10)], knock, 0),
+        ('uneven knocks', [0.0, 0.15, 0.65], knock, 0),
+        ('2 claps', [0.0, 0.4], clap, 0),
+        ('door slam', [0.0], door, 0),
+    ]
+
+    seconds = len(scenes) * 2 * 4.0
+    audio = normalize(rng.randn(int(seconds * sample_rate_hz)), -55)
+    events = []
+    pos_s = 1.0
+    for _ in range(2):
+        for name, times, make, expected in scenes:
+            level = rng.uniform(-30, -6)
+            length = int(0.4 * sample_rate_hz)
+            for t in times:
+                start = int((pos_s + t) * sample_rate_hz)
+                audio[start:start + length] += normalize(make(length), level)
+            events.append((pos_s, name, expected))
+            pos_s += 4.0
+    return np.clip(np.rint(audio), -32768, 32767).astype(np.int16), events
+
+
+def _main():
+    import sys
+    import wave
+
+    sample_rate_hz = 16000
+    if len(sys.argv) > 1:
+        with wave.open(sys.argv[1], 'rb') as wav:
+            sample_rate_hz = wav.getframerate()
+            if wav.getnchannels() != 1 or wav.getsampwidth() != 2:
+                sys.exit('%s is not 16-bit mono' % sys.argv[1])
+            audio = np.frombuffer(wav.readframes(wav.getnframes()), dtype=np.int16)
+        events = []
+    else:
+        audio, events = _synthesize(sample_rate_hz, np.random.RandomState(0))
+
+    trigger = KnockTrigger()
+    frame_len = int(trigger.FRAME_S * sample_rate_hz)
+    found = []
+    for pos in range(0, len(audio) - frame_len + 1, frame_len):
+        count = trigger.process(audio[pos:pos + frame_len])
+        if count:
+            found.append(((pos + frame_len) / sample_rate_hz, count))
+
+    for time_s, count in found:
+        print('%6.2f s: %d knocks' % (time_s, count))
+    if events:
+        correct = 0
+        for i, (start_s, name, expected) in enumerate(events):
+            end_s = events[i + 1][0] if i + 1 < len(events) else len(audio) / sample_rate_hz
+            counts = [count for time_s, count in found if start_s <= time_s < end_s]
+            ok = counts == ([expected] if expected else [])
+            correct += ok
+            print('%-14s expected %s, found %s%s' % (
+                name, expected or 'none', counts or 'none', '' if ok else '  <- wrong'))
+        print('%d/%d correct' % (correct, len(events)))
+    print(trigger.get_stats())
+
+
+if __name__ == '__main__':
+    _main()
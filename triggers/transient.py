@@ -0,0 +1,225 @@
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Find short, sharp sounds like claps and knocks in the audio stream."""
+
+import numpy as np
+
+FULL_SCALE = 32768.0
+
+# A transient has ended when the level is back within this of where it
+# started.
+SETTLED_DB = 3.0
+
+
+class TransientDetector(object):
+
+    """Finds transients in a stream of int16 frames of frame_s seconds.
+
+    Each frame is split into blocks of block_s seconds, high-passed with a
+    first difference first if high_pass is set. A transient is:
+    - a sharp onset: a block at least onset_db above the noise floor,
+      rise_db above the block before it, and louder than min_dbfs
+    - accepted by accept(), which subclasses override to check the spectrum
+      of what the onset added to the audio before it
+    - short: within decay_s, the level before high-passing falls decay_db
+      below its peak or back to where it was before the onset, where a voice
+      or a slammed door keeps ringing
+
+    The noise floor follows the quietest block of each frame down quickly,
+    and rises by at most floor_rise_db per second, so steady or slowly
+    changing noise like traffic raises the threshold instead of setting it
+    off. After a transient, onsets are ignored for refractory_s.
+
+    The spectrum is checked one frame after the onset, so a transient is
+    reported one or two frames after it ends; onset_s is when it started.
+    Frames without a loud block cost a few vectorized operations on buffers
+    allocated up front.
+    """
+
+    def __init__(self, sample_rate_hz=16000, frame_s=0.02, block_s=0.005,
+                 high_pass=True, onset_db=20.0, rise_db=10.0, min_dbfs=-50.0,
+                 decay_db=15.0, decay_s=0.1, floor_rise_db=6.0, refractory_s=0.3):
+        self.frame_len = frame_len = int(round(sample_rate_hz * frame_s))
+        self._block_len = block_len = int(round(sample_rate_hz * block_s))
+        if frame_len % block_len:
+            raise ValueError('frame_s must be a multiple of block_s')
+
+        self.block_s = block_s
+        self.high_pass = high_pass
+        self.onset_db = onset_db
+        self.rise_db = rise_db
+        self.min_dbfs = min_dbfs
+        self.decay_db = decay_db
+        self.decay_s = decay_s
+        self._decay_blocks = int(round(decay_s / block_s))
+        self._refractory_blocks = int(round(refractory_s / block_s))
+        self._floor_fall = float(1 - np.exp(-frame_s / 0.2))
+        self._floor_rise_db = floor_rise_db * frame_s
+
+        # The last three frames, oldest first, for the spectrum around an
+        # onset in the middle one.
+        self._samples = np.zeros(3 * frame_len, dtype=np.float32)
+        self._raw_blocks = self._samples[2 * frame_len:].reshape(-1, block_len)
+        self._raw_level = np.empty(len(self._raw_blocks), dtype=np.float32)
+        if high_pass:
+            self._diff = np.empty(frame_len, dtype=np.float32)
+            self._blocks = self._diff.reshape(-1, block_len)
+            self._level = np.empty(len(self._blocks), dtype=np.float32)
+        else:
+            self._level = self._raw_level
+        self._level_scale = 1 / (block_len * FULL_SCALE ** 2)
+        self._window = np.hanning(frame_len).astype(np.float32)
+
+        # Frequency of each bin of the spectra passed to accept().
+        self.freqs = np.fft.rfftfreq(frame_len, 1 / sample_rate_hz)
+
+        self.floor_dbfs = None
+        self.frames = 0
+        self.onsets = 0
+        self.transients = 0
+        self.onset_s = None
+        self._block = 0
+        self._prev_level = None
+        self._prev_raw_level = None
+        self._quiet_until = 0
+        # Block of an onset whose spectrum is checked with the next frame.
+        self._onset = None
+        # While waiting for an onset to end: its peak and starting level.
+        self._peak = None
+        self._base = None
+        self._deadline = 0
+        self._ended = False
+
+    def get_stats(self):
+        return {
+            'frames': self.frames,
+            'onsets': self.onsets,
+            'transients': self.transients,
+            'floor_dbfs': self.floor_dbfs,
+        }
+
+    def accept(self, power):
+        """Returns whether an onset is wanted, given the power spectrum it
+        added. Accepts every onset.
+        """
+        return True
+
+    def process(self, audio):
+        """Takes the next frame of int16 samples. Returns True when a
+        transient has ended.
+        """
+
+        n = self.frame_len
+        samples = self._samples
+        samples[:n] = samples[n:2 * n]
+        samples[n:2 * n] = samples[2 * n:]
+        np.copyto(samples[2 * n:], audio)
+
+        self._levels(self._raw_blocks, self._raw_level)
+        if self.high_pass:
+            np.subtract(samples[2 * n:], samples[2 * n - 1:-1], out=self._diff)
+            self._levels(self._blocks, self._level)
+        level = self._level
+        quietest = float(level.min())
+        if self.floor_dbfs is None:
+            self.floor_dbfs = quietest
+        threshold = max(self.floor_dbfs + self.onset_db, self.min_dbfs)
+
+        found = False
+        if self._onset is not None:
+            found = self._check_onset()
+        if self._peak is not None or level.max() >= threshold:
+            found = self._check_blocks(threshold) or found
+        else:
+            self._block += len(level)
+        self._prev_level = float(level[-1])
+        self._prev_raw_level = float(self._raw_level[-1])
+
+        if quietest < self.floor_dbfs:
+            self.floor_dbfs += self._floor_fall * (quietest - self.floor_dbfs)
+        else:
+            self.floor_dbfs = min(self.floor_dbfs + self._floor_rise_db, quietest)
+        self.frames += 1
+        return found
+
+    def _levels(self, blocks, out):
+        """Returns the level of each block in dBFS, in out."""
+        np.einsum('ij,ij->i', blocks, blocks, out=out)
+        out *= self._level_scale
+        out += 1e-10
+        np.log10(out, out=out)
+        out *= 10
+        return out
+
+    def _check_blocks(self, threshold):
+        found = False
+        prev = self._prev_level
+        prev_raw = self._prev_raw_level
+        for value, raw in zip(self._level.tolist(), self._raw_level.tolist()):
+            if self._peak is not None and not self._ended:
+                # Waiting for an onset to decay, or to settle back to the
+                # level before it.
+                self._peak = max(self._peak, raw)
+                if raw <= max(self._peak - self.decay_db, self._base + SETTLED_DB):
+                    self._ended = True
+                    if self._onset is None:
+                        found = self._found()
+                elif self._block >= self._deadline:
+                    self._peak = None
+                    self._onset = None
+            elif (self._peak is None and self._block >= self._quiet_until and
+                  value >= threshold and prev is not None and
+                  value - prev >= self.rise_db):
+                self.onsets += 1
+                self.onset_s = self._block * self.block_s
+                self._onset = self._block
+                self._peak = raw
+                self._base = prev_raw
+                self._deadline = self._block + self._decay_blocks
+                self._ended = False
+            prev = value
+            prev_raw = raw
+            self._block += 1
+        return found
+
+    def _check_onset(self):
+        """Checks the spectrum around the onset in the previous frame."""
+
+        # Centre a frame on the block after the onset, where a transient is
+        # loudest, and compare it to the frame before that.
+        n = self.frame_len
+        blocks_per_frame = n // self._block_len
+        start = (n + (self._onset - self._block + blocks_per_frame) * self._block_len +
+                 self._block_len - n // 2)
+        self._onset = None
+        before = max(start - n, 0)
+        power = np.abs(np.fft.rfft(self._samples[start:start + n] * self._window)) ** 2
+        power -= np.abs(np.fft.rfft(self._samples[before:before + n] * self._window)) ** 2
+        np.maximum(power, 1e-3, out=power)
+
+        if not self.accept(power):
+            # Let the rest of the sound pass.
+            self._peak = None
+            self._quiet_until = self._deadline
+            return False
+        if self._ended:
+            return self._found()
+        return False
+
+    def _found(self):
+        self._peak = None
+        self._quiet_until = self._block + self._refractory_blocks
+        self.transients += 1
+        return True
@@ -21,9 +21,18 @@ class Trigger(object):
 
     def __init__(self):
         self.callback = None
+        self.wake_callback = None
 
     def set_callback(self, callback):
         self.callback = callback
 
+    def set_wake_callback(self, wake_callback):
+        """Sets a function to call with True as soon as a trigger may be
+        starting, eg on a button edge before it's debounced, and with False
+        once it has fired or turned out to be noise. This gives the recorder a
+        head start on opening the microphone.
+        """
+        self.wake_callback = wake_callback
+
     def start(self):
         pass